@@ -0,0 +1,179 @@
+"""
+Контроль допуска и сброс нагрузки.
+
+Каждый запрос относится к классу (дешёвое чтение, поиск, похожие, запись, экспорт).
+У класса свой лимит одновременных запросов и ограниченная очередь ожидания:
+когда очередь полна или ожидание дольше ADMISSION_QUEUE_TIMEOUT, запрос сразу
+получает 503 с Retry-After, а не висит в общем пуле потоков до каскада таймаутов.
+Дорогие /similar и поиск упираются в свои лимиты и не отнимают потоки у GET /notes/{id}.
+
+Опционально (ADMISSION_RATE > 0) — token bucket на клиента в Redis: 429 с Retry-After.
+"""
+import asyncio
+import math
+import os
+import re
+from typing import Dict, Optional, Tuple
+
+import orjson
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from . import cache
+
+ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))  # секунд в очереди, потом 503
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+RATE = float(os.getenv("ADMISSION_RATE", "0"))  # запросов в секунду на клиента; 0 — без лимита
+BURST = int(os.getenv("ADMISSION_BURST", "20"))
+# за балансировщиком клиент определяется по X-Forwarded-For; без прокси заголовок легко подделать
+TRUST_PROXY = os.getenv("ADMISSION_TRUST_PROXY", "0") == "1"
+
+# класс -> (одновременно, в очереди)
+DEFAULT_LIMITS: Dict[str, Tuple[int, int]] = {
+    "read": (32, 128),
+    "search": (8, 32),
+    "similar": (4, 16),
+    "write": (8, 32),
+    "export": (2, 2),
+}
+
+_SIMILAR = re.compile(r"^/notes/\d+/(similar|related)$|^/tags/[^/]+/related$|^/search/semantic$")
+_SEARCH = re.compile(r"^/notes$|^/notes/facets$|^/search$")
+# POST-запросы, которые только читают (тело вместо длинной query-строки)
+READ_POSTS = ("/notes/batch-get",)
+_EXEMPT = ("/health", "/ping", "/docs", "/redoc", "/openapi.json", "/web", "/events", "/admin")
+
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """Класс запроса; None — без ограничений (статика, health, долгоживущие потоки событий)."""
+    if path == "/" or path.startswith(_EXEMPT):
+        return None
+    if method in ("POST", "PUT", "PATCH", "DELETE") and path not in READ_POSTS:
+        return "write"
+    if path == "/notes/export":
+        return "export"
+    if _SIMILAR.match(path):
+        return "similar"
+    if _SEARCH.match(path):
+        return "search"
+    return "read"
+
+
+def _limits(name: str) -> Tuple[int, int]:
+    concurrency, queue = DEFAULT_LIMITS[name]
+    prefix = f"ADMISSION_{name.upper()}"
+    return int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)), int(os.getenv(f"{prefix}_QUEUE", queue))
+
+
+class Limiter:
+    """Семафор с ограниченной очередью; работает в event loop, без блокировок потоков."""
+
+    def __init__(self, concurrency: int, queue: int):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._sem = asyncio.Semaphore(concurrency)
+
+    async def acquire(self, timeout: float) -> bool:
+        if self._sem.locked():
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._sem.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._sem.acquire()
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self._sem.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "concurrency": self.concurrency,
+            "queue": self.queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+_limiters: Dict[str, Limiter] = {name: Limiter(*_limits(name)) for name in DEFAULT_LIMITS}
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+def client_id(scope: Scope) -> str:
+    if TRUST_PROXY:
+        for name, value in scope.get("headers") or []:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+async def _take_token(client: str) -> float:
+    """0 — запрос разрешён, иначе через сколько секунд появится токен."""
+    return await cache.take_token(f"ratelimit:{client}", RATE, BURST)
+
+
+async def _reject(send: Send, status: int, detail: str, retry_after: int) -> None:
+    body = orjson.dumps({"detail": detail})
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(retry_after).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """ASGI-middleware: слот класса держится до конца ответа, включая потоковые."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not ENABLED or scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        name = route_class(scope["method"], scope["path"])
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        if RATE > 0:
+            try:
+                wait = await _take_token(client_id(scope))
+            except Exception:
+                wait = 0.0  # Redis недоступен — не режем трафик
+            if wait > 0:
+                await _reject(send, 429, "Rate limit exceeded", max(1, math.ceil(wait)))
+                return
+
+        limiter = _limiters[name]
+        if not await limiter.acquire(QUEUE_TIMEOUT):
+            await _reject(send, 503, f"Server is overloaded ({name}), retry later", RETRY_AFTER)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,91 @@
+"""
+Встроенные (in-process) реализации хранилищ — для одноузловых установок, тестов и бенчмарков.
+
+Каждый модуль хранилища выбирает реализацию по своей переменной окружения:
+
+    NOTES_BACKEND     postgres | sqlite    (api/db.py)
+    CACHE_BACKEND     redis    | memory    (api/cache.py)
+    VERSIONS_BACKEND  mongo    | sqlite    (api/mongo_versions.py)
+    VECTORS_BACKEND   qdrant   | numpy     (api/qdrant_vectors.py)
+    GRAPH_BACKEND     neo4j    | memory    (api/graph.py)
+    QUEUE_BACKEND     rabbitmq | memory    (api/queue.py)
+
+STORAGE_BACKEND=local включает все встроенные сразу (отдельные переменные важнее).
+Встроенная реализация подменяет публичные функции модуля из своего __all__,
+поэтому routes и scripts вызывают те же db.fetch_note, cache.cache_note и т. д.
+Состояние memory-бэкендов живёт в процессе: запускать один воркер uvicorn.
+"""
+import os
+import sqlite3
+import threading
+from types import ModuleType
+from typing import Any, Dict, Tuple
+
+from dotenv import load_dotenv
+
+# выбор бэкенда происходит при импорте модулей хранилищ, раньше create_app — поэтому .env читаем здесь
+load_dotenv()
+
+# хранилище -> (переменная, внешний сервер, встроенная реализация)
+STORES: Dict[str, Tuple[str, str, str]] = {
+    "notes": ("NOTES_BACKEND", "postgres", "sqlite"),
+    "cache": ("CACHE_BACKEND", "redis", "memory"),
+    "versions": ("VERSIONS_BACKEND", "mongo", "sqlite"),
+    "vectors": ("VECTORS_BACKEND", "qdrant", "numpy"),
+    "graph": ("GRAPH_BACKEND", "neo4j", "memory"),
+    "queue": ("QUEUE_BACKEND", "rabbitmq", "memory"),
+}
+
+DATA_DIR = os.getenv("LOCAL_DATA_DIR", ".local_data")
+
+
+def selected(store: str) -> str:
+    env, external, local = STORES[store]
+    value = os.getenv(env, "").strip().lower()
+    if not value:
+        value = local if os.getenv("STORAGE_BACKEND", "").strip().lower() == "local" else external
+    if value not in (external, local):
+        raise ValueError(f"{env}={value!r}: expected {external} or {local}")
+    return value
+
+
+def is_local(store: str) -> bool:
+    return selected(store) == STORES[store][2]
+
+
+def summary() -> Dict[str, str]:
+    """Выбранные реализации всех хранилищ — для /health."""
+    return {store: selected(store) for store in STORES}
+
+
+def install(namespace: Dict[str, Any], module: ModuleType) -> None:
+    """Подменить функции модуля хранилища реализациями из module.__all__."""
+    for name in module.__all__:
+        namespace[name] = getattr(module, name)
+
+
+def data_path(name: str) -> str:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, name)
+
+
+class SQLiteConnections:
+    """
+    Соединение SQLite на поток (sqlite3 не разрешает делить соединение между потоками).
+    WAL: читатели не ждут писателя; busy_timeout вместо немедленного "database is locked".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("PRAGMA busy_timeout=5000;")
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,426 @@
+"""
+Кэш в памяти процесса (CACHE_BACKEND=memory) вместо Redis.
+
+Ключи те же, что в Redis (с префиксом арендатора), значения — те же записи (CACHE_NOTE_FORMAT,
+CACHE_NOTE_LAYOUT: хэш note:{id}:fields хранится словарём полей), поэтому и расход памяти на заметку тот же.
+Строковые ключи живут до TTL и вытесняются по LRU сверх CACHE_MAX_ENTRIES;
+sorted set-ы (популярность, снимок тегов) — словари member -> score без TTL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .. import cache, cache_codec, tenants
+from ..etags import note_etag
+
+__all__ = [
+    "get_client",
+    "get_async_client",
+    "cache_note",
+    "cache_notes",
+    "get_cached_etag",
+    "get_cached_note_with_etag",
+    "get_cached_notes_raw",
+    "get_cached_notes",
+    "get_cached_note",
+    "get_cached_note_and_epoch",
+    "bump_vector_epoch",
+    "get_cached_similar",
+    "cache_similar",
+    "invalidate_note",
+    "invalidate_notes",
+    "iter_cached_etags",
+    "get_popular_ids",
+    "remove_popular",
+    "get_latest_version",
+    "remember_latest_version",
+    "apply_tag_changes",
+    "tag_index_ready",
+    "replace_tag_counts",
+    "acquire_tag_rebuild_lock",
+    "get_tags",
+    "bump_popularity",
+    "bump_popularity_many",
+    "get_top_popular",
+    "set_if_absent",
+    "get_raw",
+    "replace_if_equal",
+    "delete_if_equal",
+    "take_token",
+    "mark_pending",
+    "claim_pending",
+    "discard_pending",
+    "pending_count",
+    "pending_tenants",
+]
+
+MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "100000"))
+
+
+class _Store:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.values: "OrderedDict[str, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self.zsets: Dict[str, Dict[Any, float]] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key: str) -> Any:
+        item = self.values.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.values[key]
+            return None
+        self.values.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.values[key] = (value, time.monotonic() + ttl if ttl else None)
+        self.values.move_to_end(key)
+        while len(self.values) > self.max_entries:
+            self.values.popitem(last=False)
+
+    def get(self, key: str) -> Any:
+        with self.lock:
+            return self._get(key)
+
+    def mget(self, keys: Sequence[str]) -> List[Any]:
+        with self.lock:
+            return [self._get(key) for key in keys]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, nx: bool = False) -> bool:
+        with self.lock:
+            if nx and self._get(key) is not None:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def set_many(self, items: Sequence[Tuple[str, Any]], ttl: Optional[float] = None) -> None:
+        with self.lock:
+            for key, value in items:
+                self._set(key, value, ttl)
+
+    def delete(self, *keys: str) -> None:
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+                self.zsets.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self.lock:
+            value = int(self._get(key) or 0) + 1
+            item = self.values.get(key)
+            self._set(key, value)
+            if item is not None and item[1] is not None:
+                self.values[key] = (value, item[1])
+            return value
+
+    def zincrby(self, key: str, pairs: Sequence[Tuple[Any, float]]) -> None:
+        with self.lock:
+            zset = self.zsets.setdefault(key, {})
+            for member, inc in pairs:
+                zset[member] = zset.get(member, 0.0) + inc
+
+    def zitems(self, key: str) -> List[Tuple[Any, float]]:
+        with self.lock:
+            return list(self.zsets.get(key, {}).items())
+
+    def zrem(self, key: str, members: Sequence[Any]) -> None:
+        with self.lock:
+            zset = self.zsets.get(key)
+            if zset:
+                for member in members:
+                    zset.pop(member, None)
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return list(self.values)
+
+
+_store = _Store(MAX_ENTRIES)
+
+
+def get_client(decode_responses: bool = True):
+    raise RuntimeError("Redis is not used: CACHE_BACKEND=memory")
+
+
+def get_async_client():
+    raise RuntimeError("Redis is not used: CACHE_BACKEND=memory")
+
+
+def _note_items(note: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    note_id = note["id"]
+    if cache.NOTE_LAYOUT == "hash":
+        entry = (cache.note_fields_key(note_id), cache.note_fields(note))
+    else:
+        entry = (cache.note_key(note_id), cache.encode_cached_note(note))
+    return [entry, (cache.etag_key(note_id), note_etag(note))]
+
+
+def _drop_other_layout(note_ids: Sequence[int]) -> None:
+    other = cache.note_key if cache.NOTE_LAYOUT == "hash" else cache.note_fields_key
+    _store.delete(*[other(nid) for nid in note_ids])
+
+
+def cache_note(note: Dict[str, Any]) -> None:
+    _drop_other_layout([note["id"]])
+    _store.set_many(_note_items(note), cache.NOTE_TTL)
+
+
+def cache_notes(notes: List[Dict[str, Any]]) -> None:
+    _drop_other_layout([note["id"] for note in notes])
+    _store.set_many([item for note in notes for item in _note_items(note)], cache.NOTE_TTL)
+
+
+def _get_entries(
+    note_ids: Sequence[int], extra_keys: Sequence[str] = (), fields: Optional[Sequence[str]] = None
+) -> Tuple[List[Any], List[Any]]:
+    # то же, что cache._get_entries: записи (m + c, только m или пара (m, p)) и extra_keys
+    if cache.NOTE_LAYOUT != "hash":
+        values = _store.mget([cache.note_key(nid) for nid in note_ids] + list(extra_keys))
+        return values[: len(note_ids)], values[len(note_ids) :]
+    content, preview = cache.needs_content(fields)
+    values = _store.mget([cache.note_fields_key(nid) for nid in note_ids] + list(extra_keys))
+    entries: List[Any] = []
+    for item in values[: len(note_ids)]:
+        if not item:
+            entries.append(None)
+        elif content:
+            entries.append(item["m"] + item["c"])
+        else:
+            entries.append((item["m"], item["p"]) if preview else item["m"])
+    return entries, values[len(note_ids) :]
+
+
+def get_cached_etag(note_id: int) -> Optional[str]:
+    return _store.get(cache.etag_key(note_id))
+
+
+def get_cached_note_with_etag(note_id: int) -> Tuple[Optional[bytes], Optional[str]]:
+    (raw,), (etag,) = _get_entries([note_id], [cache.etag_key(note_id)])
+    body = cache_codec.to_json(raw)
+    if not body or not etag:
+        return None, None
+    return body, etag
+
+
+def get_cached_notes_raw(note_ids: Sequence[int]) -> Dict[int, bytes]:
+    entries, _ = _get_entries(note_ids)
+    bodies = ((nid, cache_codec.to_json(raw)) for nid, raw in zip(note_ids, entries))
+    return {nid: body for nid, body in bodies if body}
+
+
+def get_cached_notes(note_ids: Sequence[int], fields: Optional[Sequence[str]] = None) -> Dict[int, Dict[str, Any]]:
+    entries, _ = _get_entries(note_ids, fields=fields)
+    notes = ((nid, cache.unpack_entry(entry, fields)) for nid, entry in zip(note_ids, entries))
+    return {nid: note for nid, note in notes if note is not None}
+
+
+def get_cached_note(note_id: int) -> Optional[Dict[str, Any]]:
+    (raw,), _ = _get_entries([note_id])
+    return cache_codec.unpack(raw)
+
+
+def get_cached_note_and_epoch(note_id: int) -> Tuple[Optional[Dict[str, Any]], int]:
+    (raw,), (epoch,) = _get_entries([note_id], [cache.tenant_key(cache.VECTOR_EPOCH_KEY)])
+    return cache_codec.unpack(raw), int(epoch or 0)
+
+
+def bump_vector_epoch() -> None:
+    _store.incr(cache.tenant_key(cache.VECTOR_EPOCH_KEY))
+
+
+def get_cached_similar(key: str) -> Optional[bytes]:
+    return _store.get(key)
+
+
+def cache_similar(key: str, body: bytes) -> None:
+    _store.set(key, body, cache.SIMILAR_TTL)
+
+
+def invalidate_note(note_id: int) -> None:
+    invalidate_notes([note_id])
+
+
+def invalidate_notes(note_ids: List[int]) -> None:
+    keys: List[str] = []
+    for note_id in note_ids:
+        keys.extend(
+            [cache.note_key(note_id), cache.note_fields_key(note_id), cache.etag_key(note_id), cache.latest_version_key(note_id)]
+        )
+    _store.delete(*keys)
+
+
+def iter_cached_etags(batch: int = 1000) -> Iterator[Dict[int, str]]:
+    prefix = cache.tenant_key("note:")
+    chunk: Dict[int, str] = {}
+    for key in _store.keys():
+        if not key.startswith(prefix) or not key.endswith(":etag"):
+            continue
+        note_id = key[len(prefix) : -len(":etag")]
+        etag = _store.get(key)
+        if not note_id.isdigit() or etag is None:
+            continue
+        chunk[int(note_id)] = etag
+        if len(chunk) >= batch:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+def _by_score_desc(items: List[Tuple[Any, float]]) -> List[Tuple[Any, float]]:
+    # как ZREVRANGE: по убыванию score, при равенстве — по убыванию member
+    return sorted(items, key=lambda item: (item[1], str(item[0])), reverse=True)
+
+
+def get_popular_ids() -> List[int]:
+    return [int(member) for member, _ in reversed(_by_score_desc(_store.zitems(cache.tenant_key(cache.POPULAR_KEY))))]
+
+
+def remove_popular(note_ids: List[int]) -> None:
+    _store.zrem(cache.tenant_key(cache.POPULAR_KEY), [int(nid) for nid in note_ids])
+
+
+def get_latest_version(note_id: int) -> Optional[int]:
+    raw = _store.get(cache.latest_version_key(note_id))
+    return int(raw) if raw else None
+
+
+def remember_latest_version(note_id: int, version: int) -> None:
+    key = cache.latest_version_key(note_id)
+    with _store.lock:
+        if int(_store._get(key) or 0) < version:
+            _store._set(key, version, cache.NOTE_TTL)
+
+
+def apply_tag_changes(old_tags: Optional[List[str]], new_tags: Optional[List[str]]) -> None:
+    old, new = set(old_tags or []), set(new_tags or [])
+    if old == new or _store.get(cache.tenant_key(cache.TAG_READY_KEY)) is None:
+        return
+    key = cache.tenant_key(cache.TAG_COUNTS_KEY)
+    with _store.lock:
+        counts = _store.zsets.setdefault(key, {})
+        for tag in old - new:
+            counts[tag] = counts.get(tag, 0) - 1
+            if counts[tag] <= 0:
+                del counts[tag]
+        for tag in new - old:
+            counts[tag] = counts.get(tag, 0) + 1
+
+
+def tag_index_ready() -> bool:
+    return _store.get(cache.tenant_key(cache.TAG_READY_KEY)) is not None
+
+
+def replace_tag_counts(counts: Dict[str, int]) -> None:
+    with _store.lock:
+        _store.zsets[cache.tenant_key(cache.TAG_COUNTS_KEY)] = {name: float(cnt) for name, cnt in counts.items()}
+        _store._set(cache.tenant_key(cache.TAG_READY_KEY), 1)
+
+
+def acquire_tag_rebuild_lock(ttl: int) -> bool:
+    return _store.set(cache.tenant_key(cache.TAG_REBUILD_LOCK_KEY), 1, ttl, nx=True)
+
+
+def get_tags(limit: int = 100, prefix: Optional[str] = None, sort: str = "name") -> List[Tuple[str, int]]:
+    return cache.select_tags(_store.zitems(cache.tenant_key(cache.TAG_COUNTS_KEY)), limit, prefix, sort)
+
+
+def bump_popularity(note_id: int, inc: float = 1.0) -> None:
+    _store.zincrby(cache.tenant_key(cache.POPULAR_KEY), [(int(note_id), inc)])
+
+
+def bump_popularity_many(note_ids: Sequence[int], inc: float = 1.0) -> None:
+    _store.zincrby(cache.tenant_key(cache.POPULAR_KEY), [(int(nid), inc) for nid in note_ids])
+
+
+def get_top_popular(limit: int = 10) -> List[Tuple[int, float]]:
+    items = _by_score_desc(_store.zitems(cache.tenant_key(cache.POPULAR_KEY)))
+    return [(int(member), score) for member, score in items[:limit]]
+
+
+def set_if_absent(key: str, value: bytes, ttl: int) -> bool:
+    return _store.set(key, value, ttl, nx=True)
+
+
+def get_raw(key: str) -> Optional[bytes]:
+    return _store.get(key)
+
+
+def replace_if_equal(key: str, expected: bytes, value: bytes, ttl: int) -> bool:
+    with _store.lock:
+        if _store._get(key) != expected:
+            return False
+        _store._set(key, value, ttl)
+        return True
+
+
+def delete_if_equal(key: str, expected: bytes) -> bool:
+    with _store.lock:
+        if _store._get(key) != expected:
+            return False
+        del _store.values[key]
+        return True
+
+
+_buckets: Dict[str, Tuple[float, float]] = {}
+
+
+async def take_token(key: str, rate: float, burst: int) -> float:
+    """Тот же token bucket, что и Lua-скрипт в Redis, но в памяти процесса."""
+    now = time.monotonic()
+    with _store.lock:
+        tokens, ts = _buckets.get(key, (float(burst), now))
+        tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        _buckets[key] = (tokens, now)
+        if len(_buckets) > MAX_ENTRIES:
+            _buckets.pop(next(iter(_buckets)))
+    return wait
+
+
+def mark_pending(note_id: int, now: float, window: float, max_delay: float) -> float:
+    key, first_key = cache.tenant_key(cache.PENDING_SYNC_KEY), cache.tenant_key(cache.PENDING_FIRST_KEY)
+    with _store.lock:
+        first = _store.zsets.setdefault(first_key, {}).setdefault(note_id, now)
+        due = min(now + window, first + max_delay)
+        _store.zsets.setdefault(key, {})[note_id] = due
+        _store.zsets.setdefault(cache.PENDING_TENANTS_KEY, {})[tenants.current()["name"]] = 0
+    return due
+
+
+def claim_pending(now: float, limit: int) -> List[int]:
+    key, first_key = cache.tenant_key(cache.PENDING_SYNC_KEY), cache.tenant_key(cache.PENDING_FIRST_KEY)
+    with _store.lock:
+        pending = _store.zsets.get(key, {})
+        due = sorted((score, note_id) for note_id, score in pending.items() if score <= now)[:limit]
+        first = _store.zsets.get(first_key, {})
+        for _, note_id in due:
+            pending.pop(note_id, None)
+            first.pop(note_id, None)
+        if not pending:
+            _store.zsets.get(cache.PENDING_TENANTS_KEY, {}).pop(tenants.current()["name"], None)
+    return [note_id for _, note_id in due]
+
+
+def discard_pending(note_ids: Sequence[int]) -> None:
+    _store.zrem(cache.tenant_key(cache.PENDING_SYNC_KEY), note_ids)
+    _store.zrem(cache.tenant_key(cache.PENDING_FIRST_KEY), note_ids)
+
+
+def pending_count() -> int:
+    with _store.lock:
+        return len(_store.zsets.get(cache.tenant_key(cache.PENDING_SYNC_KEY), {}))
+
+
+def pending_tenants() -> List[str]:
+    with _store.lock:
+        return sorted(_store.zsets.get(cache.PENDING_TENANTS_KEY, {}))
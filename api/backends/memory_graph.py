@@ -0,0 +1,209 @@
+"""
+Граф тегов в памяти процесса (GRAPH_BACKEND=memory) вместо Neo4j.
+
+Та же модель, что в графе: заметка -> теги, тег -> заметки, Tag.note_count и веса
+рёбер CO_OCCURS (у каждого тега — словарь соседей). Всё поддерживается инкрементально при записи,
+поэтому related_notes / related_tags не обходят граф целиком.
+Отдельный граф на арендатора (как метки Note_<t>/Tag_<t> в Neo4j).
+"""
+import math
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Set, Tuple
+
+from .. import graph, tenants
+from ..checksums import fold_checksums, tags_digest, updated_ms
+
+__all__ = [
+    "get_driver",
+    "ensure_constraints",
+    "upsert_note_with_tags",
+    "upsert_notes_with_tags",
+    "delete_note",
+    "delete_notes",
+    "rebuild_tag_stats",
+    "related_notes",
+    "related_tags",
+    "range_checksums",
+    "range_fingerprints",
+    "get_notes_by_tag",
+    "tag_counts",
+    "list_tags",
+]
+
+
+class _Graph:
+    def __init__(self) -> None:
+        self.notes: Dict[int, Dict[str, Any]] = {}
+        self.tag_notes: Dict[str, Set[int]] = defaultdict(set)
+        self.co_occurs: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.lock = threading.RLock()
+
+    def _apply(self, old_tags: Set[str], new_tags: Set[str]) -> None:
+        # те же дельты, что graph._tag_deltas применяет к рёбрам CO_OCCURS; соседи хранятся в обе стороны
+        old_pairs, new_pairs = graph._tag_pairs(old_tags), graph._tag_pairs(new_tags)
+        for a, b in new_pairs - old_pairs:
+            for x, y in ((a, b), (b, a)):
+                self.co_occurs[x][y] = self.co_occurs[x].get(y, 0) + 1
+        for a, b in old_pairs - new_pairs:
+            for x, y in ((a, b), (b, a)):
+                count = self.co_occurs[x].get(y, 0) - 1
+                if count > 0:
+                    self.co_occurs[x][y] = count
+                else:
+                    self.co_occurs[x].pop(y, None)
+
+    def upsert(self, note_id: int, row: Dict[str, Any]) -> None:
+        old = self.notes.get(note_id)
+        old_tags = set(old["tags"]) if old else set()
+        new_tags = set(row["tags"])
+        for tag in old_tags - new_tags:
+            self.tag_notes[tag].discard(note_id)
+        for tag in new_tags - old_tags:
+            self.tag_notes[tag].add(note_id)
+        self._apply(old_tags, new_tags)
+        self.notes[note_id] = row
+
+    def delete(self, note_id: int) -> None:
+        old = self.notes.pop(note_id, None)
+        if old is None:
+            return
+        for tag in set(old["tags"]):
+            self.tag_notes[tag].discard(note_id)
+        self._apply(set(old["tags"]), set())
+
+    def note_count(self, tag: str) -> int:
+        return len(self.tag_notes.get(tag, ()))
+
+
+_graphs: Dict[str, _Graph] = {}
+_graphs_lock = threading.Lock()
+
+
+def _graph() -> _Graph:
+    key = tenants.current()["name"]
+    g = _graphs.get(key)
+    if g is None:
+        with _graphs_lock:
+            g = _graphs.setdefault(key, _Graph())
+    return g
+
+
+def get_driver():
+    raise RuntimeError("Neo4j is not used: GRAPH_BACKEND=memory")
+
+
+def ensure_constraints() -> None:
+    pass
+
+
+def upsert_note_with_tags(note: dict) -> None:
+    upsert_notes_with_tags([note])
+
+
+def upsert_notes_with_tags(notes: List[dict]) -> None:
+    g = _graph()
+    with g.lock:
+        for n in notes:
+            g.upsert(
+                n["id"],
+                {
+                    "note_id": n["id"],
+                    "title": n.get("title", ""),
+                    "tags": list(n.get("tags") or []),
+                    "updated_ms": updated_ms(n["updated_at"]) if n.get("updated_at") else None,
+                    "tags_digest": tags_digest(n.get("tags") or []),
+                },
+            )
+
+
+def delete_note(note_id: int) -> None:
+    delete_notes([note_id])
+
+
+def delete_notes(note_ids: List[int]) -> None:
+    g = _graph()
+    with g.lock:
+        for note_id in note_ids:
+            g.delete(note_id)
+
+
+def rebuild_tag_stats() -> None:
+    """Пересчитать CO_OCCURS по текущим тегам заметок (note_count считается по множествам всегда точно)."""
+    g = _graph()
+    with g.lock:
+        g.co_occurs.clear()
+        for row in g.notes.values():
+            g._apply(set(), set(row["tags"]))
+
+
+def related_notes(note_id: int, limit: int = 10, per_tag: int = 200, method: str = "adamic_adar") -> List[Dict]:
+    g = _graph()
+    with g.lock:
+        note = g.notes.get(note_id)
+        if note is None:
+            return []
+        ntags = list(dict.fromkeys(note["tags"]))
+        candidates: Set[int] = set()
+        for tag in ntags:
+            # как LIMIT $per_tag в Cypher: не больше per_tag кандидатов на тег (самые новые id)
+            others = sorted((m for m in g.tag_notes.get(tag, ()) if m != note_id), reverse=True)
+            candidates.update(others[:per_tag])
+        result = []
+        for m in candidates:
+            mtags = g.notes[m]["tags"]
+            shared = [t for t in ntags if t in mtags]
+            union_size = len(ntags) + len(mtags) - len(shared)
+            result.append(
+                {
+                    "note_id": m,
+                    "shared_tags": shared,
+                    "jaccard": len(shared) / (union_size if union_size > 0 else 1),
+                    "adamic_adar": sum(1.0 / math.log(1.0 + max(g.note_count(t), 1)) for t in shared),
+                }
+            )
+    metric = "jaccard" if method == "jaccard" else "adamic_adar"
+    result.sort(key=lambda r: (r[metric], r["note_id"]), reverse=True)
+    return result[:limit]
+
+
+def related_tags(tag: str, limit: int = 10) -> List[Dict]:
+    g = _graph()
+    with g.lock:
+        base = max(g.note_count(tag), 1)
+        result = []
+        for other, together in g.co_occurs.get(tag, {}).items():
+            score = together / math.sqrt(base * max(g.note_count(other), 1))
+            result.append({"tag": other, "count": together, "score": score})
+    result.sort(key=lambda r: (-r["score"], -r["count"], r["tag"]))
+    return result[:limit]
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    g = _graph()
+    with g.lock:
+        return {
+            note_id: (int(row["updated_ms"] or 0), int(row["tags_digest"] or 0))
+            for note_id, row in g.notes.items()
+            if start_id <= note_id < end_id
+        }
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    return fold_checksums(range_fingerprints(start_id, end_id), start_id, width)
+
+
+def get_notes_by_tag(tag: str, limit: int = 20) -> List[int]:
+    g = _graph()
+    with g.lock:
+        return sorted(g.tag_notes.get(tag, ()), reverse=True)[:limit]
+
+
+def tag_counts() -> Dict[str, int]:
+    g = _graph()
+    with g.lock:
+        return {tag: len(ids) for tag, ids in g.tag_notes.items() if ids}
+
+
+def list_tags(limit: int = 100) -> List[str]:
+    return sorted(tag_counts())[:limit]
@@ -0,0 +1,62 @@
+"""
+События заметок внутри процесса (QUEUE_BACKEND=memory) вместо RabbitMQ.
+
+publish_note_event формирует то же тело события (queue.encode_event), что ушло бы в RabbitMQ, кладёт его
+в ограниченный буфер очереди (последние QUEUE_MEMORY_MAXLEN, старые вытесняются)
+и синхронно передаёт подписчикам из subscribe. Подписчик вызывается в потоке
+запроса и не должен блокироваться; drain забирает накопленные сообщения.
+"""
+import os
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from .. import queue as mq
+
+__all__ = ["get_connection", "publish_note_event", "subscribe", "drain"]
+
+MAXLEN = int(os.getenv("QUEUE_MEMORY_MAXLEN", "10000"))
+
+_queues: Dict[str, Deque[bytes]] = {}
+_subscribers: List[Callable[[str, bytes], None]] = []
+_lock = threading.Lock()
+
+
+def get_connection():
+    raise RuntimeError("RabbitMQ is not used: QUEUE_BACKEND=memory")
+
+
+def publish_note_event(action: str, note: Dict) -> None:
+    queue_name = mq.get_queue_name()
+    body = mq.encode_event(action, note)
+    with _lock:
+        _queues.setdefault(queue_name, deque(maxlen=MAXLEN)).append(body)
+        subscribers = list(_subscribers)
+    for callback in subscribers:
+        try:
+            callback(queue_name, body)
+        except Exception as exc:
+            print(f"[queue] subscriber failed: {exc}")
+
+
+def subscribe(callback: Callable[[str, bytes], None]) -> Callable[[], None]:
+    """callback(queue_name, body) на каждое событие; возвращает функцию отписки."""
+    with _lock:
+        _subscribers.append(callback)
+
+    def unsubscribe() -> None:
+        with _lock:
+            if callback in _subscribers:
+                _subscribers.remove(callback)
+
+    return unsubscribe
+
+
+def drain(queue_name: Optional[str] = None, limit: Optional[int] = None) -> List[bytes]:
+    """Забрать накопленные сообщения очереди (по умолчанию — очереди текущего арендатора)."""
+    with _lock:
+        buf = _queues.get(queue_name or mq.get_queue_name())
+        if not buf:
+            return []
+        count = len(buf) if limit is None else min(limit, len(buf))
+        return [buf.popleft() for _ in range(count)]
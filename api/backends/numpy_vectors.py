@@ -0,0 +1,379 @@
+"""
+Векторный индекс в памяти процесса на NumPy (VECTORS_BACKEND=numpy) вместо Qdrant.
+
+Точный поиск перебором. Векторы коллекции лежат в одной матрице float32 (n x size).
+Векторы нормированы, поэтому скоры запроса — одно умножение матрицы на вектор (косинус).
+Top-k берётся через argpartition. Фильтры по тегам и времени — маска по payload до выбора top-k.
+Матрица растёт удвоением ёмкости. Удаление переносит последнюю строку на место удалённой.
+
+VECTORS_DIR — каталог, куда коллекции сохраняются в .npy (после пакетной записи и при выходе
+процесса) и откуда загружаются при первом обращении. VECTORS_MMAP=1 — матрица открывается
+через memory map только для чтения, копия в RAM делается при первой записи.
+"""
+import atexit
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import orjson
+
+from .. import qdrant_vectors
+from ..checksums import fold_checksums, updated_ms
+
+__all__ = [
+    "get_client",
+    "get_vector_size",
+    "ensure_collection",
+    "serves_live",
+    "switch_alias",
+    "embed_note",
+    "upsert_note_vector",
+    "upsert_note_vectors",
+    "search_similar",
+    "search_text",
+    "delete_note_vector",
+    "delete_note_vectors",
+    "iter_range_fingerprints",
+    "range_fingerprints",
+    "range_checksums",
+]
+
+VECTORS_DIR = os.getenv("VECTORS_DIR", "")
+MMAP = os.getenv("VECTORS_MMAP", "0") == "1"
+DEFAULT_SIZE = 128
+
+
+class _Index:
+    def __init__(self, size: int):
+        self.size = size
+        self.count = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, size), dtype=np.float32)
+        self.payloads: List[Dict[str, Any]] = []
+        self.rows: Dict[int, int] = {}
+        self.writable = True
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _reserve(self, extra: int) -> None:
+        """Место ещё под extra строк; read-only memory map при этом копируется в RAM."""
+        need = self.count + extra
+        if self.writable and need <= len(self.ids):
+            return
+        capacity = max(need, 2 * len(self.ids), 64)
+        vectors = np.zeros((capacity, self.size), dtype=np.float32)
+        vectors[: self.count] = self.vectors[: self.count]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[: self.count] = self.ids[: self.count]
+        self.vectors, self.ids, self.writable = vectors, ids, True
+
+    def upsert(self, points: Sequence[Tuple[int, List[float], Dict[str, Any]]]) -> None:
+        with self.lock:
+            self._reserve(len(points))
+            for point_id, vector, payload in points:
+                row = self.rows.get(point_id)
+                if row is None:
+                    row = self.rows[point_id] = self.count
+                    self.count += 1
+                    self.payloads.append(payload)
+                else:
+                    self.payloads[row] = payload
+                self.ids[row] = point_id
+                self.vectors[row] = vector
+            self.dirty = True
+
+    def delete(self, point_ids: Sequence[int]) -> None:
+        with self.lock:
+            for point_id in point_ids:
+                row = self.rows.pop(point_id, None)
+                if row is None:
+                    continue
+                self._reserve(0)
+                last = self.count - 1
+                if row != last:
+                    moved = int(self.ids[last])
+                    self.ids[row] = moved
+                    self.vectors[row] = self.vectors[last]
+                    self.payloads[row] = self.payloads[last]
+                    self.rows[moved] = row
+                self.payloads.pop()
+                self.count = last
+                self.dirty = True
+
+    def vector(self, point_id: int) -> Optional[np.ndarray]:
+        with self.lock:
+            row = self.rows.get(point_id)
+            return None if row is None else np.array(self.vectors[row])
+
+    def search(
+        self,
+        query: Sequence[float],
+        limit: int,
+        predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        exclude_ids: Sequence[int] = (),
+    ) -> List[Tuple[int, float, Dict[str, Any]]]:
+        with self.lock:
+            n = self.count
+            if n == 0 or limit <= 0:
+                return []
+            scores = self.vectors[:n] @ np.asarray(query, dtype=np.float32)
+            if predicate is not None:
+                mask = np.fromiter((predicate(p) for p in self.payloads[:n]), dtype=bool, count=n)
+                scores[~mask] = -np.inf
+            for point_id in exclude_ids:
+                row = self.rows.get(point_id)
+                if row is not None:
+                    scores[row] = -np.inf
+            k = min(limit, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(int(self.ids[i]), float(scores[i]), self.payloads[i]) for i in top if scores[i] != -np.inf]
+
+    def fingerprints(self, start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+        with self.lock:
+            return {
+                point_id: (int(p.get("updated_ms") or 0), int(p.get("tags_digest") or 0))
+                for point_id, p in ((pid, self.payloads[row]) for pid, row in self.rows.items())
+                if start_id <= point_id < end_id
+            }
+
+
+_indexes: Dict[str, _Index] = {}
+_aliases: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def _path(name: str) -> str:
+    return os.path.join(VECTORS_DIR, name)
+
+
+def _load(name: str) -> Optional[_Index]:
+    if not VECTORS_DIR or not os.path.exists(_path(f"{name}.vectors.npy")):
+        return None
+    vectors = np.load(_path(f"{name}.vectors.npy"), mmap_mode="r" if MMAP else None)
+    index = _Index(vectors.shape[1])
+    index.vectors = vectors
+    index.ids = np.load(_path(f"{name}.ids.npy"))
+    with open(_path(f"{name}.payloads.json"), "rb") as fh:
+        index.payloads = orjson.loads(fh.read())
+    index.count = len(index.ids)
+    index.rows = {int(pid): row for row, pid in enumerate(index.ids)}
+    index.writable = not MMAP
+    return index
+
+
+def _save(name: str, index: _Index) -> None:
+    """Атомарно: запись во временные файлы и os.replace (открытый memory map продолжает читать старые)."""
+    if not VECTORS_DIR:
+        return
+    os.makedirs(VECTORS_DIR, exist_ok=True)
+    with index.lock:
+        n = index.count
+        files = {
+            f"{name}.vectors.npy": lambda fh: np.save(fh, np.ascontiguousarray(index.vectors[:n])),
+            f"{name}.ids.npy": lambda fh: np.save(fh, index.ids[:n]),
+            f"{name}.payloads.json": lambda fh: fh.write(orjson.dumps(index.payloads[:n])),
+        }
+        for filename, write in files.items():
+            tmp = _path(f"{filename}.tmp")
+            with open(tmp, "wb") as fh:
+                write(fh)
+            os.replace(tmp, _path(filename))
+        index.dirty = False
+
+
+def _load_aliases() -> None:
+    if VECTORS_DIR and os.path.exists(_path("aliases.json")):
+        with open(_path("aliases.json"), encoding="utf-8") as fh:
+            _aliases.update(json.load(fh))
+
+
+def _resolve(name: Optional[str]) -> str:
+    name = name or qdrant_vectors.get_collection_name()
+    return _aliases.get(name, name)
+
+
+def _get_index(name: Optional[str] = None, size: Optional[int] = None, create: bool = True) -> Optional[_Index]:
+    name = _resolve(name)
+    index = _indexes.get(name)
+    if index is None:
+        with _lock:
+            index = _indexes.get(name)
+            if index is None:
+                index = _load(name)
+                if index is None:
+                    if not create:
+                        return None
+                    index = _Index(size or _env_size() or DEFAULT_SIZE)
+                _indexes[name] = index
+    return index
+
+
+@atexit.register
+def _save_all() -> None:
+    for name, index in list(_indexes.items()):
+        if index.dirty:
+            _save(name, index)
+
+
+def get_client():
+    raise RuntimeError("Qdrant is not used: VECTORS_BACKEND=numpy")
+
+
+def _env_size() -> Optional[int]:
+    try:
+        return int(os.getenv("QDRANT_VECTOR_SIZE", ""))
+    except ValueError:
+        return None
+
+
+def get_vector_size(client: Any = None) -> int:
+    size = _env_size()
+    if size:
+        return size
+    index = _get_index(create=False)
+    return index.size if index is not None else DEFAULT_SIZE
+
+
+def ensure_collection(collection: Optional[str] = None, size: Optional[int] = None) -> None:
+    _get_index(collection, size)
+
+
+def serves_live(collection: Optional[str]) -> bool:
+    return _resolve(collection) == _resolve(None)
+
+
+def switch_alias(alias: str, collection: str) -> None:
+    _aliases[alias] = collection
+    if VECTORS_DIR:
+        os.makedirs(VECTORS_DIR, exist_ok=True)
+        with open(_path("aliases.json"), "w", encoding="utf-8") as fh:
+            json.dump(_aliases, fh)
+    qdrant_vectors._vectors_changed()
+
+
+def embed_note(note: Dict[str, Any]) -> List[float]:
+    return qdrant_vectors.embed_text(qdrant_vectors.note_text(note), get_vector_size())
+
+
+def _points(notes: List[Dict[str, Any]], size: int) -> List[Tuple[int, List[float], Dict[str, Any]]]:
+    return [
+        (note["id"], qdrant_vectors.embed_text(qdrant_vectors.note_text(note), size), qdrant_vectors.build_payload(note))
+        for note in notes
+    ]
+
+
+def upsert_note_vector(note: Dict[str, Any]) -> None:
+    index = _get_index()
+    index.upsert(_points([note], index.size))
+    qdrant_vectors._vectors_changed()
+
+
+def upsert_note_vectors(
+    notes: List[Dict[str, Any]],
+    collection: Optional[str] = None,
+    size: Optional[int] = None,
+) -> None:
+    if not notes:
+        return
+    index = _get_index(collection, size)
+    index.upsert(_points(notes, index.size))
+    _save(_resolve(collection), index)
+    if serves_live(collection):
+        qdrant_vectors._vectors_changed()
+
+
+def _predicate(
+    tags: Optional[Sequence[str]],
+    tags_mode: str,
+    updated_from: Optional[datetime],
+    updated_to: Optional[datetime],
+) -> Optional[Callable[[Dict[str, Any]], bool]]:
+    """Та же семантика, что у qdrant_vectors.build_filter, но проверкой payload в Python."""
+    if not tags and updated_from is None and updated_to is None:
+        return None
+    wanted = set(tags or [])
+    low = updated_ms(updated_from) if updated_from is not None else None
+    high = updated_ms(updated_to) if updated_to is not None else None
+
+    def check(payload: Dict[str, Any]) -> bool:
+        if wanted:
+            have = set(payload.get("tags") or [])
+            if not (wanted <= have if tags_mode == "all" else wanted & have):
+                return False
+        if low is not None or high is not None:
+            upd = payload.get("updated_ms")
+            if upd is None or (low is not None and upd < low) or (high is not None and upd >= high):
+                return False
+        return True
+
+    return check
+
+
+def _hits(found: List[Tuple[int, float, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    return [
+        {"score": score, "note_id": payload.get("note_id", point_id), "title": payload.get("title"), "tags": payload.get("tags")}
+        for point_id, score, payload in found
+    ]
+
+
+def search_similar(
+    note: Dict[str, Any],
+    limit: int = 5,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    index = _get_index()
+    vec = index.vector(note["id"])
+    if vec is None:
+        vec = qdrant_vectors.embed_text(qdrant_vectors.note_text(note), index.size)
+    predicate = _predicate(tags, tags_mode, updated_from, updated_to)
+    return _hits(index.search(vec, limit, predicate, exclude_ids=[note["id"]]))
+
+
+def search_text(
+    q: str,
+    limit: int = 50,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    index = _get_index()
+    vec = qdrant_vectors.embed_query(q, index.size)
+    return _hits(index.search(vec, limit, _predicate(tags, tags_mode, updated_from, updated_to)))
+
+
+def delete_note_vector(note_id: int) -> None:
+    _get_index().delete([note_id])
+    qdrant_vectors._vectors_changed()
+
+
+def delete_note_vectors(note_ids: List[int], collection: Optional[str] = None) -> None:
+    if not note_ids:
+        return
+    _get_index(collection).delete(note_ids)
+    if serves_live(collection):
+        qdrant_vectors._vectors_changed()
+
+
+def iter_range_fingerprints(
+    start_id: int, end_id: int, collection: Optional[str] = None, batch: int = 1000
+) -> Iterator[Tuple[int, Tuple[int, int]]]:
+    return iter(sorted(range_fingerprints(start_id, end_id, collection=collection).items()))
+
+
+def range_fingerprints(start_id: int, end_id: int, collection: Optional[str] = None, batch: int = 1000) -> Dict[int, Tuple[int, int]]:
+    return _get_index(collection).fingerprints(start_id, end_id)
+
+
+def range_checksums(start_id: int, end_id: int, width: int, collection: Optional[str] = None) -> Dict[int, Tuple[int, int, int, int]]:
+    return fold_checksums(range_fingerprints(start_id, end_id, collection=collection), start_id, width)
+
+
+_load_aliases()
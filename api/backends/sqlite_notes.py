@@ -0,0 +1,427 @@
+"""
+Заметки в SQLite (NOTES_BACKEND=sqlite) вместо Postgres.
+
+Та же таблица на арендатора, что и в Postgres; теги хранятся JSON-массивом и дублируются
+в таблицу <table>_tags (tag, note_id) — её обслуживает фильтр по тегам и фасеты.
+Полнотекстовый поиск — FTS5 (<table>_fts, external content), ранг — bm25.
+Обе вспомогательные таблицы поддерживаются триггерами. Даты — ISO 8601 в UTC
+с микросекундами, поэтому сортировка строк совпадает с хронологической.
+"""
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from . import SQLiteConnections, data_path
+from .. import db
+from ..checksums import fold_checksums, note_fingerprint
+
+__all__ = [
+    "build_select_list",
+    "build_filters",
+    "schema_ready",
+    "ensure_table_exists",
+    "insert_note",
+    "fetch_note",
+    "fetch_notes_by_ids",
+    "rank_notes",
+    "search_notes",
+    "tag_facets",
+    "get_id_bounds",
+    "fetch_notes_in_range",
+    "range_checksums",
+    "range_fingerprints",
+    "iter_notes",
+    "update_note_with_previous_tags",
+    "delete_note_returning_tags",
+]
+
+_FTS_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '[]',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_{table}_created_at_id ON {table} (created_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS {table}_tags (
+    tag TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_{table}_tags_note ON {table}_tags (note_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+    title, content, content='{table}', content_rowid='id', tokenize='unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS trg_{table}_ai AFTER INSERT ON {table} BEGIN
+    INSERT INTO {table}_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+    INSERT OR IGNORE INTO {table}_tags (tag, note_id) SELECT value, new.id FROM json_each(new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_ad AFTER DELETE ON {table} BEGIN
+    INSERT INTO {table}_fts ({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    DELETE FROM {table}_tags WHERE note_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_au_text AFTER UPDATE OF title, content ON {table} BEGIN
+    INSERT INTO {table}_fts ({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    INSERT INTO {table}_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_au_tags AFTER UPDATE OF tags ON {table} BEGIN
+    DELETE FROM {table}_tags WHERE note_id = old.id;
+    INSERT OR IGNORE INTO {table}_tags (tag, note_id) SELECT value, new.id FROM json_each(new.tags);
+END;
+"""
+
+_schema_ready: Dict[str, bool] = {}
+
+
+@lru_cache(maxsize=1)
+def _connections() -> SQLiteConnections:
+    return SQLiteConnections(os.getenv("SQLITE_PATH") or data_path("notes.sqlite3"))
+
+
+def _ts(value: datetime) -> str:
+    """Каноничная строка времени: UTC, микросекунды; naive-значения считаются UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _row(row: sqlite3.Row) -> Dict[str, Any]:
+    note = dict(row)
+    if "tags" in note:
+        note["tags"] = json.loads(note["tags"])
+    for key in ("created_at", "updated_at"):
+        if key in note:
+            note[key] = datetime.fromisoformat(note[key])
+    return note
+
+
+def build_select_list(fields: Optional[Sequence[str]] = None) -> str:
+    fields = db.normalize_fields(fields)
+    if fields is None:
+        return ", ".join(db.NOTE_COLUMNS)
+    return ", ".join(
+        f"substr(content, 1, {db.PREVIEW_LENGTH}) AS preview" if f == "preview" else f for f in fields
+    )
+
+
+def build_filters(
+    q: Optional[str] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> Tuple[str, List[Any]]:
+    """Та же семантика, что у db.build_filters; теги ищутся по индексной таблице <table>_tags."""
+    table = db.get_table_name()
+    conditions: List[str] = []
+    params: List[Any] = []
+    if q:
+        like = f"%{q}%"
+        conditions.append("(title LIKE ? OR content LIKE ?)")
+        params.extend([like, like])
+    if tags:
+        wanted = list(dict.fromkeys(tags))
+        marks = ", ".join("?" for _ in wanted)
+        if tags_mode == "all":
+            conditions.append(
+                f"id IN (SELECT note_id FROM {table}_tags WHERE tag IN ({marks}) "
+                f"GROUP BY note_id HAVING COUNT(*) = ?)"
+            )
+            params.extend(wanted + [len(wanted)])
+        else:
+            conditions.append(f"id IN (SELECT note_id FROM {table}_tags WHERE tag IN ({marks}))")
+            params.extend(wanted)
+    if updated_from is not None:
+        conditions.append("updated_at >= ?")
+        params.append(_ts(updated_from))
+    if updated_to is not None:
+        conditions.append("updated_at < ?")
+        params.append(_ts(updated_to))
+    if not conditions:
+        return "", params
+    return "WHERE " + " AND ".join(conditions), params
+
+
+def schema_ready() -> bool:
+    return _schema_ready.get(db.get_table_name(), False)
+
+
+def ensure_table_exists() -> None:
+    table = db.get_table_name()
+    if _schema_ready.get(table):
+        return
+    _connections().get().executescript(_SCHEMA.format(table=table))
+    _schema_ready[table] = True
+
+
+def insert_note(title: str, content: str, tags: Optional[List[str]]) -> Dict[str, Any]:
+    table = db.get_table_name()
+    now = _ts(datetime.now(timezone.utc))
+    conn = _connections().get()
+    cur = conn.execute(
+        f"INSERT INTO {table} (title, content, tags, created_at, updated_at) VALUES (?, ?, ?, ?, ?);",
+        (title, content, json.dumps(tags or [], ensure_ascii=False), now, now),
+    )
+    created = datetime.fromisoformat(now)
+    return {
+        "id": cur.lastrowid,
+        "title": title,
+        "content": content,
+        "tags": list(tags or []),
+        "created_at": created,
+        "updated_at": created,
+    }
+
+
+def fetch_note(note_id: int) -> Optional[Dict[str, Any]]:
+    table = db.get_table_name()
+    row = (
+        _connections()
+        .get()
+        .execute(f"SELECT {', '.join(db.NOTE_COLUMNS)} FROM {table} WHERE id = ?;", (note_id,))
+        .fetchone()
+    )
+    return _row(row) if row else None
+
+
+def fetch_notes_by_ids(note_ids: Sequence[int], fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    if not note_ids:
+        return []
+    table = db.get_table_name()
+    # список id одним параметром: без лимита SQLite на число placeholder-ов
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"SELECT {build_select_list(fields)} FROM {table} WHERE id IN (SELECT value FROM json_each(?));",
+            (json.dumps(list(note_ids)),),
+        )
+        .fetchall()
+    )
+    by_id = {row["id"]: _row(row) for row in rows}
+    return [by_id[nid] for nid in note_ids if nid in by_id]
+
+
+def _fts_query(q: str) -> str:
+    # термы в кавычках через пробел — все должны встретиться (как AND у websearch_to_tsquery)
+    return " ".join('"' + token.replace('"', '""') + '"' for token in _FTS_TOKEN_RE.findall(q))
+
+
+def rank_notes(
+    q: str,
+    limit: int = 50,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    timeout_ms: Optional[int] = None,
+) -> List[Tuple[int, float]]:
+    """FTS5 + bm25 (меньше — лучше, поэтому ранг отдаём со знаком минус). timeout_ms прерывает запрос."""
+    match = _fts_query(q)
+    if not match:
+        return []
+    table = db.get_table_name()
+    where, params = build_filters(None, tags, tags_mode)
+    where = (where + " AND " if where else "WHERE ") + f"{table}_fts MATCH ?"
+    conn = _connections().get()
+    if timeout_ms:
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10_000)
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT id, bm25({table}_fts) AS rank
+            FROM {table}_fts JOIN {table} ON {table}.id = {table}_fts.rowid
+            {where}
+            ORDER BY rank, id DESC
+            LIMIT ?;
+            """,
+            [*params, match, limit],
+        ).fetchall()
+    finally:
+        if timeout_ms:
+            conn.set_progress_handler(None, 0)
+    return [(int(row[0]), -float(row[1])) for row in rows]
+
+
+def search_notes(
+    q: Optional[str],
+    limit: int = 20,
+    offset: int = 0,
+    fields: Optional[Sequence[str]] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    cursor: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    table = db.get_table_name()
+    where, params = build_filters(q, tags, tags_mode)
+    if cursor:
+        created_at, note_id = db.decode_cursor(cursor)
+        where = (where + " AND " if where else "WHERE ") + "(created_at, id) < (?, ?)"
+        params.extend([_ts(created_at), note_id])
+        offset = 0
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"""
+            SELECT {build_select_list(fields)}
+            FROM {table}
+            {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?;
+            """,
+            params + [limit, offset],
+        )
+        .fetchall()
+    )
+    return [_row(row) for row in rows]
+
+
+def tag_facets(
+    q: Optional[str] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    limit: int = 50,
+) -> List[Dict[str, Any]]:
+    table = db.get_table_name()
+    where, params = build_filters(q, tags, tags_mode)
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"""
+            SELECT t.tag AS tag, COUNT(*) AS count
+            FROM {table}_tags AS t
+            JOIN (SELECT id FROM {table} {where}) AS n ON n.id = t.note_id
+            GROUP BY t.tag
+            ORDER BY count DESC, tag
+            LIMIT ?;
+            """,
+            params + [limit],
+        )
+        .fetchall()
+    )
+    return [dict(row) for row in rows]
+
+
+def get_id_bounds() -> Tuple[int, int]:
+    table = db.get_table_name()
+    low, high = _connections().get().execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table};").fetchone()
+    return int(low), int(high)
+
+
+def fetch_notes_in_range(start_id: int, end_id: int) -> List[Dict[str, Any]]:
+    table = db.get_table_name()
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"SELECT {', '.join(db.NOTE_COLUMNS)} FROM {table} WHERE id >= ? AND id < ? ORDER BY id;",
+            (start_id, end_id),
+        )
+        .fetchall()
+    )
+    return [_row(row) for row in rows]
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    table = db.get_table_name()
+    rows = (
+        _connections()
+        .get()
+        .execute(f"SELECT id, tags, updated_at FROM {table} WHERE id >= ? AND id < ?;", (start_id, end_id))
+        .fetchall()
+    )
+    return {int(row["id"]): note_fingerprint(_row(row)) for row in rows}
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    return fold_checksums(range_fingerprints(start_id, end_id), start_id, width)
+
+
+def iter_notes(
+    q: Optional[str] = None,
+    tag: Optional[str] = None,
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Все подходящие заметки по возрастанию id пачками по EXPORT_ITERSIZE. Отдельное соединение:
+    потоковый ответ дочитывает генератор из разных потоков пула.
+    """
+    table = db.get_table_name()
+    where, params = build_filters(q, [tag] if tag else None, "all", updated_from, updated_to)
+    conn = sqlite3.connect(_connections().path, timeout=5.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        cur = conn.execute(f"SELECT {build_select_list(fields)} FROM {table} {where} ORDER BY id;", params)
+        while True:
+            rows = cur.fetchmany(db.EXPORT_ITERSIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield _row(row)
+    finally:
+        conn.close()
+
+
+def update_note_with_previous_tags(
+    note_id: int, title: Optional[str], content: Optional[str], tags: Optional[List[str]]
+) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+    table = db.get_table_name()
+    fields: List[str] = []
+    params: List[Any] = []
+    if title is not None:
+        fields.append("title = ?")
+        params.append(title)
+    if content is not None:
+        fields.append("content = ?")
+        params.append(content)
+    if tags is not None:
+        fields.append("tags = ?")
+        params.append(json.dumps(tags, ensure_ascii=False))
+    if not fields:
+        note = fetch_note(note_id)
+        return note, note["tags"] if note else None
+
+    fields.append("updated_at = ?")
+    params.extend([_ts(datetime.now(timezone.utc)), note_id])
+    conn = _connections().get()
+    # BEGIN IMMEDIATE берёт блокировку записи сразу: старые теги и UPDATE видят одно состояние
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        prev = conn.execute(f"SELECT tags FROM {table} WHERE id = ?;", (note_id,)).fetchone()
+        if prev is None:
+            conn.execute("ROLLBACK;")
+            return None, None
+        conn.execute(f"UPDATE {table} SET {', '.join(fields)} WHERE id = ?;", params)
+        row = conn.execute(f"SELECT {', '.join(db.NOTE_COLUMNS)} FROM {table} WHERE id = ?;", (note_id,)).fetchone()
+        conn.execute("COMMIT;")
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+    return _row(row), json.loads(prev["tags"])
+
+
+def delete_note_returning_tags(note_id: int) -> Optional[List[str]]:
+    table = db.get_table_name()
+    conn = _connections().get()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        row = conn.execute(f"SELECT tags FROM {table} WHERE id = ?;", (note_id,)).fetchone()
+        if row is not None:
+            conn.execute(f"DELETE FROM {table} WHERE id = ?;", (note_id,))
+        conn.execute("COMMIT;")
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+    return json.loads(row["tags"]) if row else None
@@ -0,0 +1,241 @@
+"""
+Версии заметок во встроенном SQLite (VERSIONS_BACKEND=sqlite) вместо MongoDB.
+
+Коллекция арендатора — таблица (note_id, version, doc) с первичным ключом (note_id, version):
+те же выборки «последние версии заметки», что обслуживает индекс Mongo.
+Документ версии хранится JSON-ом и возвращается в том же виде, что из Mongo;
+_id — строка "<note_id>:<version>".
+"""
+import os
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from . import SQLiteConnections, data_path
+from .. import mongo_versions
+from ..checksums import fold_checksums, tags_digest, updated_ms
+
+__all__ = [
+    "get_client",
+    "ensure_indexes",
+    "save_version",
+    "backfill_initial_versions",
+    "get_versions",
+    "get_latest_version",
+    "get_versions_for_notes",
+    "get_version",
+    "delete_versions",
+    "delete_versions_for_notes",
+    "range_checksums",
+    "range_fingerprints",
+]
+
+_DATETIME_FIELDS = ("created_at", "updated_at", "saved_at")
+_ready: Dict[str, bool] = {}
+
+
+@lru_cache(maxsize=1)
+def _connections() -> SQLiteConnections:
+    return SQLiteConnections(os.getenv("VERSIONS_SQLITE_PATH") or data_path("versions.sqlite3"))
+
+
+def get_client():
+    raise RuntimeError("MongoDB is not used: VERSIONS_BACKEND=sqlite")
+
+
+def _collection() -> str:
+    return mongo_versions.get_db_and_collection()["collection"]
+
+
+def ensure_indexes() -> None:
+    coll = _collection()
+    if _ready.get(coll):
+        return
+    _connections().get().execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {coll} (
+            note_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            doc TEXT NOT NULL,
+            PRIMARY KEY (note_id, version)
+        ) WITHOUT ROWID;
+        """
+    )
+    _ready[coll] = True
+
+
+def _make_doc(note: Dict[str, Any], version: int, saved_at: datetime) -> Dict[str, Any]:
+    return {
+        "note_id": note["id"],
+        "version": version,
+        "title": note.get("title"),
+        "content": note.get("content"),
+        "tags": note.get("tags", []),
+        "tags_digest": tags_digest(note.get("tags") or []),
+        "created_at": note.get("created_at"),
+        "updated_at": note.get("updated_at"),
+        "saved_at": saved_at,
+    }
+
+
+def _encode(doc: Dict[str, Any]) -> str:
+    return orjson.dumps(doc, default=str).decode("utf-8")
+
+
+def _decode(raw: str, with_id: bool = True) -> Dict[str, Any]:
+    doc = orjson.loads(raw)
+    for key in _DATETIME_FIELDS:
+        if isinstance(doc.get(key), str):
+            doc[key] = datetime.fromisoformat(doc[key])
+    if with_id:
+        doc["_id"] = f"{doc['note_id']}:{doc['version']}"
+    return doc
+
+
+def save_version(note: Dict[str, Any]) -> Dict[str, Any]:
+    ensure_indexes()
+    coll = _collection()
+    conn = _connections().get()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        (last,) = conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {coll} WHERE note_id = ?;", (note["id"],)).fetchone()
+        doc = _make_doc(note, int(last) + 1, datetime.utcnow())
+        conn.execute(f"INSERT INTO {coll} (note_id, version, doc) VALUES (?, ?, ?);", (doc["note_id"], doc["version"], _encode(doc)))
+        conn.execute("COMMIT;")
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+    return doc
+
+
+def backfill_initial_versions(notes: List[Dict[str, Any]]) -> int:
+    if not notes:
+        return 0
+    ensure_indexes()
+    coll = _collection()
+    now = datetime.utcnow()
+    conn = _connections().get()
+    rows = [(note["id"], 1, _encode(_make_doc(note, 1, now))) for note in notes]
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        # версия 1 вставляется только заметкам, у которых версий нет вовсе
+        before = conn.total_changes
+        conn.executemany(
+            f"""
+            INSERT INTO {coll} (note_id, version, doc)
+            SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM {coll} WHERE note_id = ?1);
+            """,
+            rows,
+        )
+        inserted = conn.total_changes - before
+        conn.execute("COMMIT;")
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+    return inserted
+
+
+def get_versions(note_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+    ensure_indexes()
+    rows = (
+        _connections()
+        .get()
+        .execute(f"SELECT doc FROM {_collection()} WHERE note_id = ? ORDER BY version DESC LIMIT ?;", (note_id, limit))
+        .fetchall()
+    )
+    return [_decode(row["doc"]) for row in rows]
+
+
+def get_latest_version(note_id: int) -> int:
+    ensure_indexes()
+    (last,) = (
+        _connections()
+        .get()
+        .execute(f"SELECT COALESCE(MAX(version), 0) FROM {_collection()} WHERE note_id = ?;", (note_id,))
+        .fetchone()
+    )
+    return int(last)
+
+
+def get_versions_for_notes(note_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    result: Dict[int, List[Dict[str, Any]]] = {nid: [] for nid in note_ids}
+    if not note_ids:
+        return result
+    ensure_indexes()
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"""
+            SELECT note_id, doc FROM {_collection()}
+            WHERE note_id IN (SELECT value FROM json_each(?))
+            ORDER BY note_id, version DESC;
+            """,
+            (orjson.dumps(list(note_ids)).decode("ascii"),),
+        )
+        .fetchall()
+    )
+    for row in rows:
+        result.setdefault(row["note_id"], []).append(_decode(row["doc"], with_id=False))
+    return result
+
+
+def get_version(note_id: int, version: int) -> Optional[Dict[str, Any]]:
+    ensure_indexes()
+    row = (
+        _connections()
+        .get()
+        .execute(f"SELECT doc FROM {_collection()} WHERE note_id = ? AND version = ?;", (note_id, version))
+        .fetchone()
+    )
+    return _decode(row["doc"]) if row else None
+
+
+def delete_versions(note_id: int) -> int:
+    return delete_versions_for_notes([note_id])
+
+
+def delete_versions_for_notes(note_ids: List[int]) -> int:
+    if not note_ids:
+        return 0
+    ensure_indexes()
+    cur = (
+        _connections()
+        .get()
+        .execute(
+            f"DELETE FROM {_collection()} WHERE note_id IN (SELECT value FROM json_each(?));",
+            (orjson.dumps(list(note_ids)).decode("ascii"),),
+        )
+    )
+    return cur.rowcount
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    """Отпечатки последних версий заметок диапазона."""
+    ensure_indexes()
+    coll = _collection()
+    rows = (
+        _connections()
+        .get()
+        .execute(
+            f"""
+            SELECT note_id, doc FROM {coll} AS v
+            WHERE note_id >= ? AND note_id < ?
+              AND version = (SELECT MAX(version) FROM {coll} WHERE note_id = v.note_id);
+            """,
+            (start_id, end_id),
+        )
+        .fetchall()
+    )
+    result: Dict[int, Tuple[int, int]] = {}
+    for row in rows:
+        doc = orjson.loads(row["doc"])
+        upd = updated_ms(doc["updated_at"]) if doc.get("updated_at") else 0
+        result[int(row["note_id"])] = (upd, int(doc.get("tags_digest") or 0))
+    return result
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    return fold_checksums(range_fingerprints(start_id, end_id), start_id, width)
@@ -1,51 +1,588 @@
-import json
+import functools
+import hashlib
 import os
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import orjson
 import redis
+import redis.asyncio
 
+from . import backends, cache_codec, tenants
+from .db import PREVIEW_LENGTH
+from .etags import note_etag
 
-def get_client() -> redis.Redis:
+
+def get_client(decode_responses: bool = True) -> redis.Redis:
+    """Общий клиент процесса (внутри — пул соединений redis-py); арендаторов разделяют префиксы ключей."""
+    return _client(bool(decode_responses))
+
+
+@functools.lru_cache(maxsize=None)
+def _client(decode_responses: bool) -> redis.Redis:
     return redis.Redis(
         host=os.getenv("REDIS_HOST", "localhost"),
         port=int(os.getenv("REDIS_PORT", "6379")),
         db=int(os.getenv("REDIS_DB", "0")),
-        decode_responses=True,  # работаем со строками
+        decode_responses=decode_responses,  # по умолчанию работаем со строками
+        socket_connect_timeout=3,
+        socket_timeout=3,
+    )
+
+
+def get_async_client() -> "redis.asyncio.Redis":
+    """Клиент для кода, работающего прямо в event loop (middleware): не занимает поток пула."""
+    return redis.asyncio.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        db=int(os.getenv("REDIS_DB", "0")),
+        decode_responses=True,
         socket_connect_timeout=3,
         socket_timeout=3,
     )
 
 
 NOTE_TTL = int(os.getenv("REDIS_NOTE_TTL", "120"))  # секунд
+# Формат записи заметки: json — готовые байты ответа, попадание в кэш отдаётся без разбора (по умолчанию);
+# packed — компактный (api/cache_codec.py): меньше памяти Redis ценой сборки JSON на каждом попадании.
+# Раскладка: blob — строка note:{id}; hash — хэш note:{id}:fields с полями m (заголовок и метаданные),
+# p (первые NOTES_PREVIEW_LENGTH символов content) и c (content): проекции без content читают только m и p.
+NOTE_FORMAT = os.getenv("CACHE_NOTE_FORMAT", "json")
+NOTE_LAYOUT = os.getenv("CACHE_NOTE_LAYOUT", "blob")  # hash всегда в формате packed
 POPULAR_KEY = os.getenv("REDIS_POPULAR_KEY", "popular_notes")
 
+# Готовые ответы /notes/{id}/similar. Любая запись в Qdrant увеличивает эпоху векторов,
+# эпоха входит в ключ — старые записи больше не читаются и просто истекают по TTL.
+VECTOR_EPOCH_KEY = os.getenv("REDIS_VECTOR_EPOCH_KEY", "vector_epoch")
+SIMILAR_TTL = int(os.getenv("REDIS_SIMILAR_TTL", "600"))  # секунд
+
+# Снимок тегов: TAG_COUNTS_KEY — tag -> число заметок (сортировка по частоте),
+# TAG_NAMES_KEY — те же теги со score 0 для ZRANGEBYLEX (автодополнение по префиксу).
+TAG_COUNTS_KEY = os.getenv("REDIS_TAG_COUNTS_KEY", "tag_counts")
+TAG_NAMES_KEY = f"{TAG_COUNTS_KEY}:names"
+TAG_READY_KEY = f"{TAG_COUNTS_KEY}:ready"
+TAG_REBUILD_LOCK_KEY = f"{TAG_COUNTS_KEY}:rebuild_lock"
+PREFIX_SCAN_LIMIT = 1000  # сколько тегов с префиксом сортировать по частоте
+
+# Инкрементальное обновление снимка: ARGV = [число снятых тегов, снятые..., добавленные...].
+# Пока снимок не собран (нет ready-ключа), дельты не применяем — их учтёт пересборка.
+_TAG_DELTA_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return 0
+end
+local removed = tonumber(ARGV[1])
+for i = 2, removed + 1 do
+    local cnt = tonumber(redis.call('ZINCRBY', KEYS[1], -1, ARGV[i]))
+    if cnt <= 0 then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    end
+end
+for i = removed + 2, #ARGV do
+    redis.call('ZINCRBY', KEYS[1], 1, ARGV[i])
+    redis.call('ZADD', KEYS[2], 0, ARGV[i])
+end
+return 1
+"""
+
+# Номер последней версии пишем только если он больше текущего,
+# чтобы параллельные сохранения не откатили ETag списка версий назад.
+_SET_MAX_SCRIPT = """
+local cur = tonumber(redis.call('GET', KEYS[1]) or '0')
+local new = tonumber(ARGV[1])
+if new > cur then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return new
+end
+return cur
+"""
+
+
+# Отложенная синхронизация (api/coalesce.py): PENDING_SYNC_KEY — note_id -> срок синхронизации,
+# PENDING_FIRST_KEY — note_id -> время первой несинхронизированной правки (срок не позже него + max_delay).
+# PENDING_TENANTS_KEY — общее (без префикса арендатора) множество арендаторов с отложенными заметками:
+# по нему поток любого воркера находит правки, отложенные другими воркерами.
+PENDING_SYNC_KEY = os.getenv("REDIS_PENDING_SYNC_KEY", "pending_sync")
+PENDING_FIRST_KEY = f"{PENDING_SYNC_KEY}:first"
+PENDING_TENANTS_KEY = f"{PENDING_SYNC_KEY}:tenants"
+
+# ARGV = [note_id, now, window, max_delay, tenant]; возвращает назначенный срок
+_MARK_PENDING_SCRIPT = """
+redis.call('ZADD', KEYS[2], 'NX', ARGV[2], ARGV[1])
+local first = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]))
+local due = math.min(tonumber(ARGV[2]) + tonumber(ARGV[3]), first + tonumber(ARGV[4]))
+redis.call('ZADD', KEYS[1], due, ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[5])
+return tostring(due)
+"""
+
+# Забрать наступившие id: чтение и удаление атомарны, поэтому каждый id достаётся одному воркеру.
+# Арендатор без отложенных заметок уходит из PENDING_TENANTS_KEY.
+_CLAIM_PENDING_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ids))
+    redis.call('ZREM', KEYS[2], unpack(ids))
+end
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+return ids
+"""
+
+
+# Сравнить-и-заменить для Idempotency-Key: менять/снимать значение, только если оно всё ещё наше
+# (иначе лок истёк и ключ занял другой запрос)
+_REPLACE_IF_EQUAL_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+_DELETE_IF_EQUAL_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Token bucket на клиента (admission): 0 — запрос разрешён, иначе через сколько секунд появится токен
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+def tenant_key(name: str) -> str:
+    """Ключ в пространстве текущего арендатора (у арендатора по умолчанию префикса нет)."""
+    return tenants.current()["redis_prefix"] + name
+
+
+def note_key(note_id: int) -> str:
+    return tenant_key(f"note:{note_id}")
+
+
+def etag_key(note_id: int) -> str:
+    return tenant_key(f"note:{note_id}:etag")
+
+
+def note_fields_key(note_id: int) -> str:
+    return tenant_key(f"note:{note_id}:fields")
+
+
+def latest_version_key(note_id: int) -> str:
+    return tenant_key(f"note:{note_id}:latest_version")
+
+
+def encode_note(note: Dict[str, Any]) -> bytes:
+    """
+    JSON заметки в том же виде, что отдаёт API (даты в ISO 8601, UTC как «Z» — как у NoteOut),
+    поэтому такие байты можно сразу отдавать клиенту.
+    """
+    return orjson.dumps(note, default=str, option=orjson.OPT_UTC_Z)
+
+
+def encode_cached_note(note: Dict[str, Any]) -> bytes:
+    """Запись заметки для строки note:{id} в формате CACHE_NOTE_FORMAT."""
+    return cache_codec.pack(note) if NOTE_FORMAT == "packed" else encode_note(note)
+
+
+def note_fields(note: Dict[str, Any]) -> Dict[str, bytes]:
+    """Поля хэша note:{id}:fields (CACHE_NOTE_LAYOUT=hash)."""
+    meta, content = cache_codec.split(cache_codec.pack(note))
+    preview = (note.get("content") or "")[:PREVIEW_LENGTH].encode("utf-8")
+    return {"m": meta, "p": preview, "c": content}
+
+
+def _queue_note(pipe, note: Dict[str, Any]) -> None:
+    # запись другой раскладки снимаем: при смене CACHE_NOTE_LAYOUT воркеры не прочитают устаревшую
+    note_id = note["id"]
+    if NOTE_LAYOUT == "hash":
+        pipe.hset(note_fields_key(note_id), mapping=note_fields(note))
+        pipe.expire(note_fields_key(note_id), NOTE_TTL)
+        pipe.delete(note_key(note_id))
+    else:
+        pipe.setex(note_key(note_id), NOTE_TTL, encode_cached_note(note))
+        pipe.delete(note_fields_key(note_id))
+    pipe.setex(etag_key(note_id), NOTE_TTL, note_etag(note))
+
 
 def cache_note(note: Dict[str, Any]) -> None:
-    """Сохранить заметку в кэш (JSON) с TTL."""
+    """Сохранить заметку в кэш и её ETag с одинаковым TTL."""
     client = get_client()
-    key = f"note:{note['id']}"
-    client.setex(key, NOTE_TTL, json.dumps(note, default=str))
+    pipe = client.pipeline(transaction=False)
+    _queue_note(pipe, note)
+    pipe.execute()
+
+
+def cache_notes(notes: List[Dict[str, Any]]) -> None:
+    """Положить пачку заметок в кэш одним pipeline (прогрев кэша)."""
+    if not notes:
+        return
+    client = get_client()
+    pipe = client.pipeline(transaction=False)
+    for note in notes:
+        _queue_note(pipe, note)
+    pipe.execute()
+
+
+def needs_content(fields: Optional[Sequence[str]]) -> Tuple[bool, bool]:
+    """Какие части записи нужны проекции fields: (content, preview). None — полная заметка."""
+    if fields is None or "content" in fields:
+        return True, False
+    return False, "preview" in fields
+
+
+def _get_entries(
+    client: redis.Redis,
+    note_ids: Sequence[int],
+    extra_keys: Sequence[str] = (),
+    fields: Optional[Sequence[str]] = None,
+) -> Tuple[List[Optional[bytes]], List[Any]]:
+    """
+    Записи заметок (или None) и значения extra_keys за один запрос: MGET для blob,
+    pipeline из HMGET для hash. В hash без content в проекции тело не читается, превью — отдельным полем.
+    """
+    if NOTE_LAYOUT != "hash":
+        values = client.mget([note_key(nid) for nid in note_ids] + list(extra_keys))
+        return values[: len(note_ids)], values[len(note_ids) :]
+    content, preview = needs_content(fields)
+    parts = ("m", "c") if content else ("m", "p") if preview else ("m",)
+    pipe = client.pipeline(transaction=False)
+    for nid in note_ids:
+        pipe.hmget(note_fields_key(nid), *parts)
+    if extra_keys:
+        pipe.mget(list(extra_keys))
+    replies = pipe.execute()
+    entries: List[Optional[bytes]] = []
+    for reply in replies[: len(note_ids)]:
+        # m + c — полная запись; без content читается только префикс m, для превью — пара (m, p)
+        if not reply[0]:
+            entries.append(None)
+        elif parts[-1] == "p":
+            entries.append((reply[0], reply[1] or b""))
+        else:
+            entries.append(b"".join(part or b"" for part in reply))
+    return entries, (replies[-1] if extra_keys else [])
+
+
+def unpack_entry(entry: Any, fields: Optional[Sequence[str]] = None) -> Optional[Dict[str, Any]]:
+    """Заметка из записи, прочитанной под проекцию fields (байты или пара (m, p) для превью)."""
+    if isinstance(entry, tuple):
+        meta, preview = entry
+        note = cache_codec.unpack(meta, with_content=False)
+        if note is not None:
+            note["preview"] = preview.decode("utf-8")
+        return note
+    return cache_codec.unpack(entry, with_content=any(needs_content(fields)))
+
+
+def get_cached_etag(note_id: int) -> Optional[str]:
+    """Только ETag — чтобы ответить 304, не вытаскивая тело заметки."""
+    client = get_client()
+    return client.get(etag_key(note_id))
+
+
+def get_cached_note_with_etag(note_id: int) -> Tuple[Optional[bytes], Optional[str]]:
+    """JSON закэшированной заметки в виде ответа API и её ETag за один запрос к Redis."""
+    client = get_client(decode_responses=False)
+    (raw,), (etag,) = _get_entries(client, [note_id], [etag_key(note_id)])
+    body = cache_codec.to_json(raw)
+    if not body or not etag:
+        return None, None
+    return body, etag.decode("utf-8")
+
+
+def get_cached_notes_raw(note_ids: Sequence[int]) -> Dict[int, bytes]:
+    """JSON нескольких заметок в виде ответа API за один запрос; промахи в результат не попадают."""
+    if not note_ids:
+        return {}
+    client = get_client(decode_responses=False)
+    entries, _ = _get_entries(client, note_ids)
+    bodies = ((nid, cache_codec.to_json(raw)) for nid, raw in zip(note_ids, entries))
+    return {nid: body for nid, body in bodies if body}
+
+
+def get_cached_notes(note_ids: Sequence[int], fields: Optional[Sequence[str]] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Заметки из кэша за один запрос; fields — проекция, под которую читать (без content в hash
+    тело не читается, preview приходит готовым полем). Промахи в результат не попадают.
+    """
+    if not note_ids:
+        return {}
+    client = get_client(decode_responses=False)
+    entries, _ = _get_entries(client, note_ids, fields=fields)
+    notes = ((nid, unpack_entry(entry, fields)) for nid, entry in zip(note_ids, entries))
+    return {nid: note for nid, note in notes if note is not None}
 
 
 def get_cached_note(note_id: int) -> Optional[Dict[str, Any]]:
+    client = get_client(decode_responses=False)
+    (raw,), _ = _get_entries(client, [note_id])
+    return cache_codec.unpack(raw)
+
+
+def similar_key(epoch: int, note: Dict[str, Any], params: str) -> str:
+    """Ключ ответа: эпоха векторов + версия исходной заметки (её ETag) + хэш параметров запроса."""
+    version = note_etag(note).strip('"')
+    digest = hashlib.md5(params.encode("utf-8")).hexdigest()[:16]
+    return tenant_key(f"similar:{epoch}:{version}:{digest}")
+
+
+def get_cached_note_and_epoch(note_id: int) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Заметка из кэша (или None) и текущая эпоха векторов одним MGET."""
+    client = get_client(decode_responses=False)
+    (raw,), (epoch,) = _get_entries(client, [note_id], [tenant_key(VECTOR_EPOCH_KEY)])
+    return cache_codec.unpack(raw), int(epoch or 0)
+
+
+def bump_vector_epoch() -> None:
+    client = get_client()
+    client.incr(tenant_key(VECTOR_EPOCH_KEY))
+
+
+def get_cached_similar(key: str) -> Optional[bytes]:
+    client = get_client(decode_responses=False)
+    return client.get(key)
+
+
+def cache_similar(key: str, body: bytes) -> None:
+    client = get_client()
+    client.setex(key, SIMILAR_TTL, body)
+
+
+def invalidate_note(note_id: int) -> None:
+    client = get_client()
+    client.delete(note_key(note_id), note_fields_key(note_id), etag_key(note_id), latest_version_key(note_id))
+
+
+def invalidate_notes(note_ids: List[int]) -> None:
+    if not note_ids:
+        return
+    client = get_client()
+    keys: List[str] = []
+    for note_id in note_ids:
+        keys.extend([note_key(note_id), note_fields_key(note_id), etag_key(note_id), latest_version_key(note_id)])
+    client.delete(*keys)
+
+
+def iter_cached_etags(batch: int = 1000) -> Iterator[Dict[int, str]]:
+    """Пачки {note_id: ETag} всех закэшированных заметок (SCAN, без блокировки Redis)."""
+    client = get_client()
+    ids: List[int] = []
+    prefix = tenants.current()["redis_prefix"]
+    for key in client.scan_iter(match=f"{prefix}note:*:etag", count=batch):
+        ids.append(int(key[len(prefix):].split(":")[1]))
+        if len(ids) >= batch:
+            yield dict(zip(ids, client.mget([etag_key(i) for i in ids])))
+            ids = []
+    if ids:
+        yield dict(zip(ids, client.mget([etag_key(i) for i in ids])))
+
+
+def get_popular_ids() -> List[int]:
+    client = get_client()
+    return [int(note_id) for note_id in client.zrange(tenant_key(POPULAR_KEY), 0, -1)]
+
+
+def remove_popular(note_ids: List[int]) -> None:
+    if note_ids:
+        get_client().zrem(tenant_key(POPULAR_KEY), *note_ids)
+
+
+def get_latest_version(note_id: int) -> Optional[int]:
+    client = get_client()
+    raw = client.get(latest_version_key(note_id))
+    return int(raw) if raw else None
+
+
+def remember_latest_version(note_id: int, version: int) -> None:
+    client = get_client()
+    client.eval(_SET_MAX_SCRIPT, 1, latest_version_key(note_id), version, NOTE_TTL)
+
+
+def apply_tag_changes(old_tags: Optional[List[str]], new_tags: Optional[List[str]]) -> None:
+    """Поправить снимок тегов после create (old=None), update или delete (new=None)."""
+    old, new = set(old_tags or []), set(new_tags or [])
+    removed, added = sorted(old - new), sorted(new - old)
+    if not removed and not added:
+        return
+    client = get_client()
+    keys = [tenant_key(TAG_COUNTS_KEY), tenant_key(TAG_NAMES_KEY), tenant_key(TAG_READY_KEY)]
+    client.eval(_TAG_DELTA_SCRIPT, 3, *keys, len(removed), *removed, *added)
+
+
+def tag_index_ready() -> bool:
+    return bool(get_client().exists(tenant_key(TAG_READY_KEY)))
+
+
+def replace_tag_counts(counts: Dict[str, int]) -> None:
+    """Полная пересборка снимка: пишем во временные ключи и атомарно подменяем RENAME."""
+    client = get_client()
+    counts_key, names_key = tenant_key(TAG_COUNTS_KEY), tenant_key(TAG_NAMES_KEY)
+    tmp_counts, tmp_names = f"{counts_key}:tmp", f"{names_key}:tmp"
+    pipe = client.pipeline(transaction=True)
+    pipe.delete(tmp_counts, tmp_names)
+    if counts:
+        pipe.zadd(tmp_counts, counts)
+        pipe.zadd(tmp_names, {name: 0 for name in counts})
+        pipe.rename(tmp_counts, counts_key)
+        pipe.rename(tmp_names, names_key)
+    else:
+        pipe.delete(counts_key, names_key)
+    pipe.set(tenant_key(TAG_READY_KEY), 1)
+    pipe.execute()
+
+
+def acquire_tag_rebuild_lock(ttl: int) -> bool:
+    """Пересборку делает один воркер на интервал: SET NX с TTL, лок не снимаем."""
+    return bool(get_client().set(tenant_key(TAG_REBUILD_LOCK_KEY), 1, nx=True, ex=ttl))
+
+
+def select_tags(
+    counts: Iterable[Tuple[str, int]], limit: int = 100, prefix: Optional[str] = None, sort: str = "name"
+) -> List[Tuple[str, int]]:
+    """Та же выборка, что у get_tags, но из готовых счётчиков в памяти."""
+    items = [(name, int(cnt)) for name, cnt in counts if not prefix or name.startswith(prefix)]
+    if sort == "count":
+        items.sort(key=lambda item: (-item[1], item[0]))
+    else:
+        # порядок кодовых точек совпадает с побайтовым порядком UTF-8 у ZRANGEBYLEX
+        items.sort()
+    return items[:limit]
+
+
+def get_tags(
+    limit: int = 100, prefix: Optional[str] = None, sort: str = "name"
+) -> List[Tuple[str, int]]:
+    """(tag, count) из снимка; prefix — автодополнение, sort: name | count."""
     client = get_client()
-    raw = client.get(f"note:{note_id}")
-    if not raw:
-        return None
-    try:
-        return json.loads(raw)
-    except Exception:
-        return None
+    counts_key, names_key = tenant_key(TAG_COUNTS_KEY), tenant_key(TAG_NAMES_KEY)
+    if prefix:
+        # все теги с префиксом идут подряд в побайтовом порядке; верхняя граница — префикс + байт 0xff
+        lower = b"[" + prefix.encode("utf-8")
+        upper = lower + b"\xff"
+        num = limit if sort == "name" else PREFIX_SCAN_LIMIT
+        names = client.zrangebylex(names_key, lower, upper, start=0, num=num)
+        if not names:
+            return []
+        scores = client.zmscore(counts_key, names)
+        items = [(name, int(score or 0)) for name, score in zip(names, scores)]
+        if sort == "count":
+            items.sort(key=lambda item: (-item[1], item[0]))
+        return items[:limit]
+    if sort == "count":
+        return [(name, int(score)) for name, score in client.zrevrange(counts_key, 0, limit - 1, withscores=True)]
+    names = client.zrangebylex(names_key, "-", "+", start=0, num=limit)
+    if not names:
+        return []
+    scores = client.zmscore(counts_key, names)
+    return [(name, int(score or 0)) for name, score in zip(names, scores)]
 
 
 def bump_popularity(note_id: int, inc: float = 1.0) -> None:
     """Увеличить счётчик популярности (sorted set)."""
     client = get_client()
-    client.zincrby(POPULAR_KEY, inc, note_id)
+    client.zincrby(tenant_key(POPULAR_KEY), inc, note_id)
+
+
+def bump_popularity_many(note_ids: Sequence[int], inc: float = 1.0) -> None:
+    """Увеличить счётчики нескольких заметок одним pipeline."""
+    if not note_ids:
+        return
+    key = tenant_key(POPULAR_KEY)
+    client = get_client()
+    pipe = client.pipeline(transaction=False)
+    for note_id in note_ids:
+        pipe.zincrby(key, inc, note_id)
+    pipe.execute()
 
 
 def get_top_popular(limit: int = 10) -> List[Tuple[int, float]]:
     """Вернуть список (note_id, score) по убыванию."""
     client = get_client()
-    items = client.zrevrange(POPULAR_KEY, 0, limit - 1, withscores=True)
+    items = client.zrevrange(tenant_key(POPULAR_KEY), 0, limit - 1, withscores=True)
     return [(int(note_id), score) for note_id, score in items]
+
+
+def set_if_absent(key: str, value: bytes, ttl: int) -> bool:
+    return bool(get_client(decode_responses=False).set(key, value, nx=True, ex=ttl))
+
+
+def get_raw(key: str) -> Optional[bytes]:
+    return get_client(decode_responses=False).get(key)
+
+
+def replace_if_equal(key: str, expected: bytes, value: bytes, ttl: int) -> bool:
+    return bool(get_client(decode_responses=False).eval(_REPLACE_IF_EQUAL_SCRIPT, 1, key, expected, value, ttl))
+
+
+def delete_if_equal(key: str, expected: bytes) -> bool:
+    return bool(get_client(decode_responses=False).eval(_DELETE_IF_EQUAL_SCRIPT, 1, key, expected))
+
+
+def mark_pending(note_id: int, now: float, window: float, max_delay: float) -> float:
+    """Отложить синхронизацию заметки до now + window, но не позже первой отложенной правки + max_delay."""
+    keys = [tenant_key(PENDING_SYNC_KEY), tenant_key(PENDING_FIRST_KEY), PENDING_TENANTS_KEY]
+    name = tenants.current()["name"]
+    return float(get_client().eval(_MARK_PENDING_SCRIPT, 3, *keys, note_id, now, window, max_delay, name))
+
+
+def claim_pending(now: float, limit: int) -> List[int]:
+    """Забрать до limit заметок, чей срок синхронизации наступил к now."""
+    keys = [tenant_key(PENDING_SYNC_KEY), tenant_key(PENDING_FIRST_KEY), PENDING_TENANTS_KEY]
+    bound = "+inf" if now == float("inf") else now
+    name = tenants.current()["name"]
+    return [int(note_id) for note_id in get_client().eval(_CLAIM_PENDING_SCRIPT, 3, *keys, bound, limit, name)]
+
+
+def discard_pending(note_ids: Sequence[int]) -> None:
+    if not note_ids:
+        return
+    pipe = get_client().pipeline(transaction=False)
+    pipe.zrem(tenant_key(PENDING_SYNC_KEY), *note_ids)
+    pipe.zrem(tenant_key(PENDING_FIRST_KEY), *note_ids)
+    pipe.execute()
+
+
+def pending_count() -> int:
+    return int(get_client().zcard(tenant_key(PENDING_SYNC_KEY)))
+
+
+def pending_tenants() -> List[str]:
+    """Арендаторы, у которых есть отложенные заметки (отложенные любым воркером)."""
+    return sorted(get_client().smembers(PENDING_TENANTS_KEY))
+
+
+_async_client = None
+
+
+async def take_token(key: str, rate: float, burst: int) -> float:
+    """Взять токен из bucket key; 0 — можно, иначе сколько секунд ждать следующий."""
+    global _async_client
+    if _async_client is None:
+        _async_client = get_async_client()
+    return float(await _async_client.eval(_TOKEN_BUCKET_SCRIPT, 1, key, rate, burst))
+
+
+# CACHE_BACKEND=memory: те же функции поверх словаря в процессе (api/backends/memory_cache.py)
+BACKEND = backends.selected("cache")
+if BACKEND == "memory":
+    from .backends import memory_cache as _backend
+
+    backends.install(globals(), _backend)
@@ -0,0 +1,176 @@
+"""
+Компактный формат заметки в кэше (CACHE_NOTE_FORMAT=packed).
+
+    заголовок (struct, 38 байт) | метаданные (orjson) | content (строка JSON, zlib от CACHE_COMPRESS_MIN_BYTES)
+
+В заголовке версия формата, флаги, id, created_at/updated_at в микросекундах UTC со смещением
+часового пояса — даты возвращаются из кэша datetime-ами, как из Postgres, а не строками.
+Метаданные — остальные поля. Content хранится готовым строковым литералом JSON: ответ GET /notes/{id}
+склеивается из него без декодирования и повторного экранирования текста. Content лежит последним,
+поэтому запись без него (CACHE_NOTE_LAYOUT=hash, поле m) — префикс полной записи: краткие чтения не трогают тело.
+
+Неизвестная версия читается как промах кэша, поэтому формат можно менять, не сбрасывая Redis.
+Записи прежнего формата (JSON, начинаются с «{») читаются как раньше.
+"""
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
+
+FORMAT_VERSION = 1
+COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", "1024"))  # content короче не сжимаем
+COMPRESS_LEVEL = int(os.getenv("CACHE_COMPRESS_LEVEL", "1"))
+
+# версия, флаги, id, created_us, updated_us, смещения created/updated в секундах, длина метаданных
+HEADER = struct.Struct(">BBqqqiiI")
+
+HAS_CONTENT = 1
+COMPRESSED = 2
+HAS_CREATED = 4
+HAS_UPDATED = 8
+
+NAIVE = -(2**31)  # смещение-метка для дат без часового пояса
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_TYPED = ("id", "content", "created_at", "updated_at")
+# порядок полей как в SELECT заметки — ответ из кэша совпадает с ответом из базы байт в байт
+_ORDER = ("id", "title", "content", "tags", "created_at", "updated_at")
+
+
+def _pack_time(value: datetime) -> Tuple[int, int]:
+    if value.tzinfo is None:
+        return (value.replace(tzinfo=timezone.utc) - _EPOCH) // timedelta(microseconds=1), NAIVE
+    offset = value.utcoffset() or timedelta(0)
+    return (value - _EPOCH) // timedelta(microseconds=1), int(offset.total_seconds())
+
+
+def _unpack_time(us: int, offset: int) -> datetime:
+    value = _EPOCH + timedelta(microseconds=us)
+    if offset == NAIVE:
+        return value.replace(tzinfo=None)
+    return value.astimezone(timezone(timedelta(seconds=offset)))
+
+
+def pack(note: Dict[str, Any]) -> bytes:
+    flags = 0
+    created = updated = (0, 0)
+    meta = {k: v for k, v in note.items() if k not in _TYPED}
+    # даты, пришедшие строками, остаются в метаданных как есть
+    if isinstance(note.get("created_at"), datetime):
+        flags |= HAS_CREATED
+        created = _pack_time(note["created_at"])
+    elif "created_at" in note:
+        meta["created_at"] = note["created_at"]
+    if isinstance(note.get("updated_at"), datetime):
+        flags |= HAS_UPDATED
+        updated = _pack_time(note["updated_at"])
+    elif "updated_at" in note:
+        meta["updated_at"] = note["updated_at"]
+
+    content = b""
+    if "content" in note and not isinstance(note["content"], str):
+        meta["content"] = note["content"]  # null и прочее редкое — тоже метаданными
+    elif "content" in note:
+        flags |= HAS_CONTENT
+        content = orjson.dumps(note["content"])
+        if len(content) >= COMPRESS_MIN_BYTES:
+            compressed = zlib.compress(content, COMPRESS_LEVEL)
+            if len(compressed) < len(content):
+                flags |= COMPRESSED
+                content = compressed
+
+    meta_bytes = orjson.dumps(meta, default=str) if meta else b""
+    header = HEADER.pack(
+        FORMAT_VERSION, flags, note["id"], created[0], updated[0], created[1], updated[1], len(meta_bytes)
+    )
+    return header + meta_bytes + content
+
+
+def split(data: bytes) -> Tuple[bytes, bytes]:
+    """Запись -> (заголовок с метаданными, content) для раскладки по полям хэша."""
+    end = HEADER.size + HEADER.unpack_from(data)[-1]
+    return data[:end], data[end:]
+
+
+def _read(data: bytes, with_content: bool) -> Optional[Tuple[Dict[str, Any], Optional[bytes]]]:
+    # поля записи без content и сам content строкой JSON (None — не нужен или его нет)
+    if data[0] != FORMAT_VERSION:
+        return None
+    _, flags, note_id, created_us, updated_us, created_off, updated_off, meta_len = HEADER.unpack_from(data)
+    meta_end = HEADER.size + meta_len
+    fields: Dict[str, Any] = {"id": note_id}
+    if flags & HAS_CREATED:
+        fields["created_at"] = _unpack_time(created_us, created_off)
+    if flags & HAS_UPDATED:
+        fields["updated_at"] = _unpack_time(updated_us, updated_off)
+    if meta_len:
+        fields.update(orjson.loads(data[HEADER.size : meta_end]))
+    content = None
+    if not with_content:
+        fields.pop("content", None)
+    elif flags & HAS_CONTENT:
+        content = data[meta_end:]
+        if flags & COMPRESSED:
+            content = zlib.decompress(content)
+    return fields, content
+
+
+def _ordered(fields: Dict[str, Any]) -> Dict[str, Any]:
+    note = {k: fields.pop(k) for k in _ORDER if k in fields}
+    note.update(fields)
+    return note
+
+
+def unpack(data: Optional[bytes], with_content: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Заметка из записи кэша; None — пусто, чужая версия или битые данные (то же, что промах).
+    with_content=False — без content (поле не выставляется, тело не распаковывается).
+    """
+    if not data:
+        return None
+    try:
+        if data[:1] == b"{":
+            note = orjson.loads(data)
+            if not with_content:
+                note.pop("content", None)
+            return note
+        read = _read(data, with_content)
+        if read is None:
+            return None
+        fields, content = read
+        if content is not None:
+            fields["content"] = orjson.loads(content)
+    except (struct.error, zlib.error, orjson.JSONDecodeError, OverflowError, ValueError):
+        return None
+    return _ordered(fields)
+
+
+def _dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=str, option=orjson.OPT_UTC_Z)
+
+
+def to_json(data: Optional[bytes]) -> Optional[bytes]:
+    """
+    JSON ответа API из записи кэша (те же байты, что у свежей заметки из базы).
+    Записи прежнего формата уже JSON и отдаются как есть.
+    """
+    if not data:
+        return None
+    if data[:1] == b"{":
+        return data
+    try:
+        read = _read(data, with_content=True)
+    except (struct.error, zlib.error, orjson.JSONDecodeError, OverflowError, ValueError):
+        return None
+    if read is None:
+        return None
+    fields, content = read
+    if content is None:
+        return _dumps(_ordered(fields))
+    # {поля до content, "content": <литерал из записи>, остальные поля}; id есть всегда, голова не пустая
+    head = {k: fields.pop(k) for k in _ORDER[: _ORDER.index("content")] if k in fields}
+    tail = _dumps(_ordered(fields))
+    body = _dumps(head)[:-1] + b',"content":' + content
+    return body + (b"," + tail[1:] if len(tail) > 2 else b"}")
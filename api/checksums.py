@@ -0,0 +1,97 @@
+"""
+Компактные отпечатки заметок для сверки хранилищ.
+
+Отпечаток заметки — (updated_ms, tags_digest). Контрольная сумма диапазона id —
+(count, sum(id), sum(updated_ms mod M), sum(tags_digest)): такие суммы умеет
+считать на своей стороне каждое хранилище (SQL, Cypher, агрегация Mongo),
+поэтому совпадающие диапазоны сверяются без выгрузки самих заметок.
+"""
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Tuple, Union
+
+CHECKSUM_MOD = 2_147_483_647  # 2^31 - 1: суммы остатков не переполняют int64 ни в одном хранилище
+TAGS_SEPARATOR = "\x1f"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+Fingerprint = Tuple[int, int]
+RangeChecksum = Tuple[int, int, int, int]
+
+
+def updated_ms(value: Union[datetime, str]) -> int:
+    """Миллисекунды с эпохи (точность BSON datetime в Mongo), с округлением вниз."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
+def tags_digest(tags: Iterable[str]) -> int:
+    """32 бита md5 от тегов в исходном порядке; совпадает с SQL в db.range_checksums."""
+    joined = TAGS_SEPARATOR.join(tags or [])
+    return int(hashlib.md5(joined.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def note_fingerprint(note: Dict[str, Any]) -> Fingerprint:
+    return updated_ms(note["updated_at"]), tags_digest(note.get("tags") or [])
+
+
+def fold_checksums(
+    fingerprints: Dict[int, Fingerprint], start: int, width: int
+) -> Dict[int, RangeChecksum]:
+    """Контрольные суммы по корзинам ширины width для хранилищ, которые не умеют агрегировать сами."""
+    buckets: Dict[int, list] = {}
+    for note_id, (upd, digest) in fingerprints.items():
+        acc = buckets.setdefault((note_id - start) // width, [0, 0, 0, 0])
+        acc[0] += 1
+        acc[1] += note_id
+        acc[2] += upd % CHECKSUM_MOD
+        acc[3] += digest
+    return {bucket: tuple(acc) for bucket, acc in buckets.items()}
+
+
+class ScannedRange:
+    """
+    Отпечатки хранилища без агрегаций (Qdrant), прочитанные одним проходом по диапазону id.
+    Корзины верхнего уровня, совпавшие с эталоном (Postgres), сразу забываются; отпечатки
+    разошедшихся остаются в памяти, и суммы всех уровней спуска и листовые отпечатки
+    считаются из них без повторного чтения. items — пары (id, отпечаток) по возрастанию id.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Tuple[int, Fingerprint]],
+        start: int,
+        width: int,
+        reference: Dict[int, RangeChecksum],
+    ):
+        self.start = start
+        self.width = width
+        self.top: Dict[int, RangeChecksum] = {}
+        self.kept: Dict[int, Fingerprint] = {}
+        bucket, pending = None, {}
+        for note_id, fingerprint in items:
+            current = (note_id - start) // width
+            if current != bucket:
+                self._close(bucket, pending, reference)
+                bucket, pending = current, {}
+            pending[note_id] = fingerprint
+        self._close(bucket, pending, reference)
+
+    def _close(self, bucket: Any, pending: Dict[int, Fingerprint], reference: Dict[int, RangeChecksum]) -> None:
+        if bucket is None:
+            return
+        checksum = fold_checksums(pending, self.start, self.width)[bucket]
+        self.top[bucket] = checksum
+        if checksum != reference.get(bucket):
+            self.kept.update(pending)
+
+    def fingerprints(self, start: int, end: int) -> Dict[int, Fingerprint]:
+        return {note_id: fp for note_id, fp in self.kept.items() if start <= note_id < end}
+
+    def checksums(self, start: int, end: int, width: int) -> Dict[int, RangeChecksum]:
+        if start == self.start and width == self.width:
+            return dict(self.top)
+        return fold_checksums(self.fingerprints(start, end), start, width)
@@ -0,0 +1,157 @@
+"""
+Схлопывание частых правок заметки (автосохранение редактора шлёт PUT каждые несколько секунд).
+
+При COALESCE_WINDOW > 0 PUT /notes/{id} сразу пишет Postgres, кэш и снимок тегов, а версию в Mongo,
+вектор в Qdrant, узел в Neo4j и событие note_updated откладывает: id заметки попадает в отложенное
+множество в Redis со сроком now + COALESCE_WINDOW. Каждая следующая правка сдвигает срок (синхронизация
+по окончании серии), но не дальше первой несинхронизированной правки + COALESCE_MAX_DELAY — так
+непрерывно редактируемая заметка всё равно синхронизируется хотя бы раз в COALESCE_MAX_DELAY.
+
+Фоновый поток каждого воркера (api/main.py) забирает наступившие id пачками до COALESCE_BATCH —
+забор атомарный, id достаётся одному воркеру — и синхронизирует хранилища по текущей заметке из
+primary Postgres: серия правок даёт одну версию и одну запись в каждое хранилище. Арендаторов с
+отложенными заметками поток берёт из общего множества в Redis, поэтому правку, отложенную
+воркером, который потом перезапустился, доберёт любой другой.
+Сбой Mongo возвращает заметку в множество; расхождения Qdrant/Neo4j чинит scripts/reconcile.py.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+from . import cache, db, graph, mongo_versions, qdrant_vectors, tenants
+from . import queue as mq
+
+WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))  # секунд тишины до синхронизации, 0 — отключено
+MAX_DELAY = float(os.getenv("COALESCE_MAX_DELAY", "60"))  # предел отсрочки при непрерывных правках
+BATCH = int(os.getenv("COALESCE_BATCH", "200"))
+FLUSH_INTERVAL = float(os.getenv("COALESCE_FLUSH_INTERVAL", "1"))  # как часто поток проверяет сроки
+
+_stats: Dict[str, int] = {"deferred": 0, "synced": 0, "retried": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return WINDOW > 0
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += n
+
+
+def stats() -> Dict[str, int]:
+    """Счётчики этого воркера: deferred / synced — насколько схлопываются правки."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def defer(note_id: int) -> bool:
+    """Отложить синхронизацию; False — Redis недоступен, вызывающий синхронизирует сразу."""
+    try:
+        cache.mark_pending(note_id, time.time(), WINDOW, MAX_DELAY)
+    except Exception as exc:
+        print(f"[coalesce] failed to defer note {note_id}: {exc}")
+        return False
+    _count("deferred")
+    return True
+
+
+def pending_tenants() -> List[str]:
+    """Кого обходит поток: арендаторы из TENANTS и все, у кого в Redis есть отложенные заметки."""
+    names = tenants.known()
+    try:
+        pending = cache.pending_tenants()
+    except Exception as exc:
+        print(f"[coalesce] failed to list pending tenants: {exc}")
+        return names
+    for name in pending:
+        try:
+            names.append(tenants.validate(name))
+        except (ValueError, LookupError):
+            pass  # арендатора убрали из TENANTS — его заметки остаются в Redis до возвращения
+    return list(dict.fromkeys(names))
+
+
+def discard(note_ids: Sequence[int]) -> None:
+    """Снять отложенную синхронизацию (заметка удалена или уже синхронизирована вызывающим)."""
+    try:
+        cache.discard_pending(note_ids)
+    except Exception:
+        pass  # поток синхронизирует заметку ещё раз или не найдёт её в Postgres
+
+
+def _retry(note_ids: List[int]) -> None:
+    now = time.time()
+    for note_id in note_ids:
+        try:
+            cache.mark_pending(note_id, now, WINDOW, MAX_DELAY)
+        except Exception as exc:
+            print(f"[coalesce] lost pending note {note_id}: {exc}")
+    _count("retried", len(note_ids))
+
+
+def flush_due(now: Optional[float] = None) -> int:
+    """
+    Синхронизировать одну пачку заметок текущего арендатора, чей срок наступил к now
+    (float("inf") — все отложенные, при остановке воркера). Возвращает размер пачки.
+    """
+    note_ids = cache.claim_pending(time.time() if now is None else now, BATCH)
+    if not note_ids:
+        return 0
+    # реплика может ещё не видеть последнюю правку — отложенные заметки читаем с primary
+    # (контекст потока синхронизации или остановки воркера, запросы клиентов это не затрагивает)
+    db.prefer_primary_until(float("inf"))
+    try:
+        # заметки, удалённые после правки, просто не найдутся
+        notes = db.fetch_notes_by_ids(note_ids)
+    except Exception as exc:
+        print(f"[coalesce] failed to load notes: {exc}")
+        _retry(note_ids)
+        return len(note_ids)
+
+    saved = []
+    for note in notes:
+        try:
+            version_doc = mongo_versions.save_version(note)
+        except Exception as exc:
+            print(f"[coalesce] failed to save version of note {note['id']}: {exc}")
+            _retry([note["id"]])
+            continue
+        saved.append(note)
+        try:
+            cache.remember_latest_version(version_doc["note_id"], version_doc["version"])
+        except Exception:
+            pass
+    if not saved:
+        return len(note_ids)
+
+    try:
+        qdrant_vectors.upsert_note_vectors(saved)
+    except Exception as exc:
+        _count("failed")
+        print(f"[coalesce] failed to upsert vectors: {exc}")
+    try:
+        graph.upsert_notes_with_tags(saved)
+    except Exception as exc:
+        _count("failed")
+        print(f"[coalesce] failed to update graph: {exc}")
+    for note in saved:
+        try:
+            mq.publish_note_event("note_updated", note)
+        except Exception as exc:
+            print(f"[rabbitmq] failed to publish note_updated: {exc}")
+    _count("synced", len(saved))
+    return len(note_ids)
+
+
+def flush_all_due(now: Optional[float] = None) -> int:
+    """Разобрать пачками всё наступившее у текущего арендатора."""
+    total = 0
+    while True:
+        retried = stats()["retried"]
+        n = flush_due(now)
+        total += n
+        # возвращённые в множество заметки при now=inf забирались бы снова и снова
+        if n < BATCH or stats()["retried"] != retried:
+            return total
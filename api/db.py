@@ -1,9 +1,23 @@
+import base64
+import contextlib
+import contextvars
+import functools
+import itertools
 import os
 import re
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import orjson
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+
+from . import backends, tenants
+from .checksums import CHECKSUM_MOD
 
 
 def sanitize_suffix(name: str) -> str:
@@ -25,22 +39,217 @@ def get_db_config() -> Dict[str, Any]:
 
 
 def get_table_name() -> str:
-    base = "notes"
-    student = os.getenv("STUDENT_NAME", "").strip()
-    if not student:
-        return base
-    return f"{base}_{sanitize_suffix(student.lower())}"
+    """Таблица заметок текущего арендатора (notes_<tenant>, по умолчанию — notes_<student>)."""
+    return tenants.current()["table"]
+
+
+NOTE_COLUMNS = ("id", "title", "content", "tags", "created_at", "updated_at")
+# view=summary: без тела заметки, только обрезанное превью, посчитанное в SQL
+SUMMARY_FIELDS = ("id", "title", "tags", "created_at", "updated_at", "preview")
+PREVIEW_LENGTH = int(os.getenv("NOTES_PREVIEW_LENGTH", "200"))
+
+
+def normalize_fields(fields: Optional[Sequence[str]]) -> Optional[List[str]]:
+    """Проверить список полей проекции; id добавляется всегда. None — все поля."""
+    if not fields:
+        return None
+    allowed = set(NOTE_COLUMNS) | {"preview"}
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    result = ["id"]
+    for f in fields:
+        if f not in result:
+            result.append(f)
+    return result
+
+
+def build_select_list(fields: Optional[Sequence[str]] = None) -> str:
+    """Список колонок для SELECT; превью считается в Postgres, content не читается."""
+    fields = normalize_fields(fields)
+    if fields is None:
+        return ", ".join(NOTE_COLUMNS)
+    columns = []
+    for f in fields:
+        if f == "preview":
+            columns.append(f"left(content, {PREVIEW_LENGTH}) AS preview")
+        else:
+            columns.append(f)
+    return ", ".join(columns)
+
+
+def project_note(note: Dict[str, Any], fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Та же проекция, что и build_select_list, но для уже загруженной заметки (например, из кэша)."""
+    fields = normalize_fields(fields)
+    if fields is None:
+        return note
+    result: Dict[str, Any] = {}
+    for f in fields:
+        if f == "preview":
+            # из кэша (раскладка hash) превью может прийти готовым, без content
+            result[f] = note["preview"] if "preview" in note else (note.get("content") or "")[:PREVIEW_LENGTH]
+        elif f in note:
+            result[f] = note[f]
+    return result
 
 
 def get_connection():
+    """Отдельное соединение с primary вне пула — для миграций и долгих служебных операций."""
     return psycopg2.connect(**get_db_config(), connect_timeout=5)
 
 
-def ensure_table_exists() -> None:
-    table = get_table_name()
-    with get_connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            f"""
+# Пулы соединений: один на primary и по одному на каждую реплику из POSTGRES_REPLICAS
+# ("host[:port],host[:port]"; пользователь, пароль и база — как у primary).
+POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", "20"))
+POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "5"))  # секунд ждать свободное соединение
+REPLICA_EJECT_SECONDS = float(os.getenv("POSTGRES_REPLICA_EJECT_SECONDS", "30"))
+# Сколько секунд после своей записи клиент читает только с primary (read-your-writes)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("POSTGRES_READ_YOUR_WRITES_SECONDS", "5"))
+
+
+class _Pool:
+    """ThreadedConnectionPool, который ждёт свободное соединение, а не падает с PoolError."""
+
+    def __init__(self, name: str, config: Dict[str, Any]):
+        self.name = name
+        self.pool = psycopg2.pool.ThreadedConnectionPool(0, POOL_MAX, **config, connect_timeout=5)
+        self.slots = threading.BoundedSemaphore(POOL_MAX)
+        self.ejected_until = 0.0
+
+    def get(self, timeout: float = POOL_TIMEOUT):
+        if not self.slots.acquire(timeout=timeout):
+            raise psycopg2.pool.PoolError(f"No free connection to {self.name} within {timeout}s")
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn, close: bool = False) -> None:
+        try:
+            self.pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self.slots.release()
+
+
+_pools: Dict[str, _Pool] = {}
+_pools_lock = threading.Lock()
+_replica_rr = itertools.count()
+_replicas_enabled = True
+
+# Момент (time.time()), до которого текущий запрос читает с primary. Выставляется
+# middleware из cookie клиента и самими функциями записи.
+_primary_until: contextvars.ContextVar[float] = contextvars.ContextVar("primary_until", default=0.0)
+
+
+@functools.lru_cache(maxsize=1)
+def _replica_configs() -> Tuple[Tuple[str, Dict[str, Any]], ...]:
+    result = []
+    for item in os.getenv("POSTGRES_REPLICAS", "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(":")
+        result.append((item, {**get_db_config(), "host": host, "port": int(port or 5432)}))
+    return tuple(result)
+
+
+def _get_pool(name: str, config: Dict[str, Any]) -> _Pool:
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = _Pool(name, config)
+    return pool
+
+
+def _primary_pool() -> _Pool:
+    return _get_pool("primary", get_db_config())
+
+
+def _pick_replica() -> Optional[_Pool]:
+    """Следующая по кругу живая реплика; None — реплик нет или все выведены из ротации."""
+    replicas = [_get_pool(name, config) for name, config in _replica_configs()]
+    if not replicas:
+        return None
+    now = time.monotonic()
+    start = next(_replica_rr)
+    for i in range(len(replicas)):
+        pool = replicas[(start + i) % len(replicas)]
+        if pool.ejected_until <= now:
+            return pool
+    return None
+
+
+def disable_replicas() -> None:
+    """Читать только с primary (скрипты сверки/переиндексации не должны видеть отставание реплик)."""
+    global _replicas_enabled
+    _replicas_enabled = False
+
+
+def stick_to_primary(seconds: float = READ_YOUR_WRITES_SECONDS) -> float:
+    """Читать с primary до конца окна; возвращает момент окончания (для cookie клиента)."""
+    until = time.time() + seconds
+    if until > _primary_until.get():
+        _primary_until.set(until)
+    return until
+
+
+def prefer_primary_until(until: float) -> None:
+    _primary_until.set(until)
+
+
+@contextlib.contextmanager
+def connection(read_only: bool = False) -> Iterator[Any]:
+    """
+    Соединение из пула на время одной транзакции (commit при успехе, rollback при ошибке).
+    read_only=True — чтение с реплики, если они настроены, живы и клиент недавно ничего не писал.
+    Реплика, к которой не удалось подключиться или которая оборвала соединение, выводится
+    из ротации на POSTGRES_REPLICA_EJECT_SECONDS; при неудачном подключении читаем с primary.
+    Если у реплики нет свободного соединения, чтение тоже идёт на primary — без ожидания и
+    без вывода реплики из ротации (она жива, просто занята).
+    """
+    pool = None
+    conn = None
+    if read_only and _replicas_enabled and _primary_until.get() <= time.time():
+        pool = _pick_replica()
+        if pool is not None:
+            try:
+                conn = pool.get(timeout=0)
+            except psycopg2.pool.PoolError:
+                conn = None
+            except psycopg2.OperationalError:
+                pool.ejected_until = time.monotonic() + REPLICA_EJECT_SECONDS
+                conn = None
+    if conn is None:
+        pool = _primary_pool()
+        conn = pool.get()
+    if not read_only:
+        stick_to_primary()
+    broken = False
+    try:
+        with conn:
+            yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        if pool.name != "primary":
+            pool.ejected_until = time.monotonic() + REPLICA_EJECT_SECONDS
+        raise
+    finally:
+        pool.put(conn, close=broken)
+
+
+# Версионированные миграции схемы. Каждый шаг применяется ровно один раз и
+# фиксируется в таблице <notes>_migrations. Шаги с concurrent=True выполняются
+# вне транзакции (нужно для CREATE INDEX CONCURRENTLY) и не блокируют запись.
+# Новые шаги добавляем только в конец списка, старые не меняем.
+MIGRATIONS: List[Dict[str, Any]] = [
+    {
+        "version": 1,
+        "name": "create_notes_table",
+        "concurrent": False,
+        "sql": """
             CREATE TABLE IF NOT EXISTS {table} (
                 id SERIAL PRIMARY KEY,
                 title TEXT NOT NULL,
@@ -49,10 +258,13 @@ def ensure_table_exists() -> None:
                 created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
                 updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
-            """
-        )
-        cur.execute(
-            f"""
+        """,
+    },
+    {
+        "version": 2,
+        "name": "updated_at_trigger",
+        "concurrent": False,
+        "sql": """
             CREATE OR REPLACE FUNCTION {table}_set_updated_at()
             RETURNS TRIGGER AS $$
             BEGIN
@@ -60,30 +272,168 @@ def ensure_table_exists() -> None:
                 RETURN NEW;
             END;
             $$ LANGUAGE plpgsql;
-            """
-        )
-        cur.execute(
-            f"""
             DROP TRIGGER IF EXISTS trg_{table}_set_updated_at ON {table};
             CREATE TRIGGER trg_{table}_set_updated_at
             BEFORE UPDATE ON {table}
             FOR EACH ROW
             EXECUTE FUNCTION {table}_set_updated_at();
-            """
-        )
-        cur.execute(
-            f"""
-            CREATE INDEX IF NOT EXISTS idx_{table}_tsv
+        """,
+    },
+    {
+        "version": 3,
+        "name": "tsv_index",
+        "concurrent": True,
+        "index": "idx_{table}_tsv",
+        "sql": """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_tsv
             ON {table}
             USING GIN (to_tsvector('simple', coalesce(title,'') || ' ' || coalesce(content,'')));
-            """
+        """,
+    },
+    {
+        "version": 4,
+        "name": "tags_gin_index",
+        "concurrent": True,
+        "index": "idx_{table}_tags",
+        "sql": """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_tags
+            ON {table}
+            USING GIN (tags);
+        """,
+    },
+    {
+        "version": 5,
+        "name": "created_at_id_index",
+        "concurrent": True,
+        "index": "idx_{table}_created_at_id",
+        "sql": """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_created_at_id
+            ON {table} (created_at DESC, id DESC);
+        """,
+    },
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1]["version"]
+MIGRATION_LOCK_POLL = float(os.getenv("POSTGRES_MIGRATION_LOCK_POLL", "0.5"))  # секунд между попытками взять лок
+
+# Таблицы, для которых в этом процессе уже подтверждена актуальная схема.
+_schema_ready: Dict[str, bool] = {}
+
+
+def get_migrations_table(table: str) -> str:
+    return f"{table}_migrations"
+
+
+def _current_schema_version(cur, table: str) -> int:
+    mtable = get_migrations_table(table)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (mtable,))
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute(f"SELECT COALESCE(MAX(version), 0) FROM {mtable};")
+    return int(cur.fetchone()[0])
+
+
+def _drop_invalid_index(cur, index: str) -> None:
+    # Упавший CREATE INDEX CONCURRENTLY оставляет невалидный индекс,
+    # который IF NOT EXISTS молча пропустит — удаляем его перед повтором.
+    cur.execute(
+        """
+        SELECT 1 FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid;
+        """,
+        (index,),
+    )
+    if cur.fetchone():
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index};")
+
+
+def _apply_migration(conn, table: str, migration: Dict[str, Any]) -> None:
+    mtable = get_migrations_table(table)
+    sql = migration["sql"].format(table=table)
+    if migration["concurrent"]:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            index = migration.get("index")
+            if index:
+                _drop_invalid_index(cur, index.format(table=table))
+            cur.execute(sql)
+            cur.execute(
+                f"INSERT INTO {mtable} (version, name) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+                (migration["version"], migration["name"]),
+            )
+        return
+
+    conn.autocommit = False
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        cur.execute(
+            f"INSERT INTO {mtable} (version, name) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+            (migration["version"], migration["name"]),
         )
-        conn.commit()
+    conn.commit()
+
+
+def schema_ready() -> bool:
+    """Схема таблицы текущего арендатора уже проверена в этом процессе."""
+    return _schema_ready.get(get_table_name(), False)
+
+
+def ensure_table_exists() -> None:
+    """
+    Довести схему до SCHEMA_VERSION.
+    Быстрый путь — один SELECT, если схема уже актуальна (или проверена в этом процессе).
+    Иначе берём advisory lock, чтобы мигрировал только один воркер, остальные ждут.
+    Лок берётся опросом pg_try_advisory_lock в autocommit: блокирующий pg_advisory_lock держал бы
+    снимок, а CREATE INDEX CONCURRENTLY мигрирующего воркера ждёт все старые снимки — взаимная
+    блокировка. Между попытками ожидающий не держит ни транзакции, ни снимка.
+    """
+    table = get_table_name()
+    if _schema_ready.get(table):
+        return
+
+    conn = get_connection()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            while True:
+                if _current_schema_version(cur, table) >= SCHEMA_VERSION:
+                    _schema_ready[table] = True
+                    return
+                cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (table,))
+                if cur.fetchone()[0]:
+                    break
+                time.sleep(MIGRATION_LOCK_POLL)
+
+            try:
+                cur.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {get_migrations_table(table)} (
+                        version INT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    );
+                    """
+                )
+                # пока ждали лок, другой воркер мог всё применить
+                current = _current_schema_version(cur, table)
+                for migration in MIGRATIONS:
+                    if migration["version"] > current:
+                        _apply_migration(conn, table, migration)
+            finally:
+                if not conn.autocommit:
+                    conn.rollback()
+                    conn.autocommit = True
+                with conn.cursor() as unlock_cur:
+                    unlock_cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (table,))
+        _schema_ready[table] = True
+    finally:
+        conn.close()
 
 
 def insert_note(title: str, content: str, tags: Optional[List[str]]) -> Dict[str, Any]:
     table = get_table_name()
-    with get_connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
             f"""
             INSERT INTO {table} (title, content, tags)
@@ -99,7 +449,7 @@ def insert_note(title: str, content: str, tags: Optional[List[str]]) -> Dict[str
 
 def fetch_note(note_id: int) -> Optional[Dict[str, Any]]:
     table = get_table_name()
-    with get_connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with connection(read_only=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
             f"""
             SELECT id, title, content, tags, created_at, updated_at
@@ -112,36 +462,278 @@ def fetch_note(note_id: int) -> Optional[Dict[str, Any]]:
         return dict(row) if row else None
 
 
-def search_notes(q: Optional[str], limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+def fetch_notes_by_ids(note_ids: Sequence[int], fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """Загрузить несколько заметок одним запросом; порядок как в note_ids, отсутствующие пропускаются."""
+    if not note_ids:
+        return []
     table = get_table_name()
-    sql: str
-    params: Tuple[Any, ...]
-    if q:
-        sql = f"""
-            SELECT id, title, content, tags, created_at, updated_at
+    columns = build_select_list(fields)
+    with connection(read_only=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            f"""
+            SELECT {columns}
             FROM {table}
-            WHERE title ILIKE %s OR content ILIKE %s
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s;
-        """
+            WHERE id = ANY(%s);
+            """,
+            (list(note_ids),),
+        )
+        by_id = {row["id"]: dict(row) for row in cur.fetchall()}
+    return [by_id[nid] for nid in note_ids if nid in by_id]
+
+
+def build_filters(
+    q: Optional[str] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> Tuple[str, List[Any]]:
+    """
+    WHERE-часть (с ключевым словом или пустая строка) и её параметры.
+    Теги фильтруются операторами && (any) и @> (all) — их обслуживает GIN-индекс по tags.
+    """
+    conditions: List[str] = []
+    params: List[Any] = []
+    if q:
         like = f"%{q}%"
-        params = (like, like, limit, offset)
-    else:
-        sql = f"""
-            SELECT id, title, content, tags, created_at, updated_at
-            FROM {table}
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s;
-        """
-        params = (limit, offset)
+        conditions.append("(title ILIKE %s OR content ILIKE %s)")
+        params.extend([like, like])
+    if tags:
+        operator = "@>" if tags_mode == "all" else "&&"
+        conditions.append(f"tags {operator} %s::text[]")
+        params.append(list(tags))
+    if updated_from is not None:
+        conditions.append("updated_at >= %s")
+        params.append(updated_from)
+    if updated_to is not None:
+        conditions.append("updated_at < %s")
+        params.append(updated_to)
+    if not conditions:
+        return "", params
+    return "WHERE " + " AND ".join(conditions), params
+
+
+# То же выражение, что в индексе idx_<table>_tsv (миграция 3): иначе индекс не используется
+TSV_EXPR = "to_tsvector('simple', coalesce(title,'') || ' ' || coalesce(content,''))"
+
+
+def rank_notes(
+    q: str,
+    limit: int = 50,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    timeout_ms: Optional[int] = None,
+) -> List[Tuple[int, float]]:
+    """
+    Полнотекстовый поиск по GIN-индексу tsv: (id, ts_rank_cd) по убыванию ранга.
+    timeout_ms ставит statement_timeout на запрос, чтобы отброшенный по таймауту
+    поиск не продолжал нагружать базу.
+    """
+    table = get_table_name()
+    where, params = build_filters(None, tags, tags_mode)
+    where = (where + " AND " if where else "WHERE ") + f"{TSV_EXPR} @@ query"
+    with connection(read_only=True) as conn, conn.cursor() as cur:
+        if timeout_ms:
+            cur.execute("SET LOCAL statement_timeout = %s;", (int(timeout_ms),))
+        cur.execute(
+            f"""
+            SELECT id, ts_rank_cd({TSV_EXPR}, query) AS rank
+            FROM {table}, websearch_to_tsquery('simple', %s) AS query
+            {where}
+            ORDER BY rank DESC, id DESC
+            LIMIT %s;
+            """,
+            [q, *params, limit],
+        )
+        return [(int(row[0]), float(row[1])) for row in cur.fetchall()]
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Курсор keyset-пагинации: позиция (created_at, id) последней строки страницы."""
+    raw = orjson.dumps([row["created_at"], row["id"]])
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, note_id = orjson.loads(raw)
+        return datetime.fromisoformat(created_at), int(note_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
 
-    with get_connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+
+def search_notes(
+    q: Optional[str],
+    limit: int = 20,
+    offset: int = 0,
+    fields: Optional[Sequence[str]] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    cursor: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Поиск/список по убыванию (created_at, id). С cursor страница начинается сразу после
+    закодированной в нём строки (keyset, без OFFSET), иначе — обычный OFFSET.
+    """
+    table = get_table_name()
+    columns = build_select_list(fields)
+    where, params = build_filters(q, tags, tags_mode)
+    if cursor:
+        created_at, note_id = decode_cursor(cursor)
+        where = (where + " AND " if where else "WHERE ") + "(created_at, id) < (%s, %s)"
+        params.extend([created_at, note_id])
+        offset = 0
+    sql = f"""
+        SELECT {columns}
+        FROM {table}
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s OFFSET %s;
+    """
+    params.extend([limit, offset])
+
+    with connection(read_only=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(sql, params)
         rows = cur.fetchall()
         return [dict(r) for r in rows]
 
 
+def tag_facets(
+    q: Optional[str] = None,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    limit: int = 50,
+) -> List[Dict[str, Any]]:
+    """Счётчики тегов (tag -> count) по всей выборке с теми же фильтрами, что и search_notes."""
+    table = get_table_name()
+    where, params = build_filters(q, tags, tags_mode)
+    with connection(read_only=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            f"""
+            SELECT tag, COUNT(*) AS count
+            FROM {table}, unnest(tags) AS tag
+            {where}
+            GROUP BY tag
+            ORDER BY count DESC, tag
+            LIMIT %s;
+            """,
+            params + [limit],
+        )
+        return [dict(r) for r in cur.fetchall()]
+
+
+def get_id_bounds() -> Tuple[int, int]:
+    """(min id, max id) таблицы заметок; (0, 0), если таблица пуста."""
+    table = get_table_name()
+    with connection(read_only=True) as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table};")
+        low, high = cur.fetchone()
+        return int(low), int(high)
+
+
+def fetch_notes_in_range(start_id: int, end_id: int) -> List[Dict[str, Any]]:
+    """Заметки с start_id <= id < end_id по первичному ключу — для переиндексации диапазонами."""
+    table = get_table_name()
+    with connection(read_only=True) as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            f"""
+            SELECT id, title, content, tags, created_at, updated_at
+            FROM {table}
+            WHERE id >= %s AND id < %s
+            ORDER BY id;
+            """,
+            (start_id, end_id),
+        )
+        return [dict(r) for r in cur.fetchall()]
+
+
+# Те же отпечатки, что api.checksums.note_fingerprint, но посчитанные в Postgres
+_UPDATED_MS_SQL = "floor(extract(epoch FROM updated_at) * 1000)::bigint"
+_TAGS_DIGEST_SQL = "('x' || left(md5(array_to_string(tags, chr(31))), 8))::bit(32)::bigint"
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    """Контрольные суммы корзин [start_id + k*width, ...) одним GROUP BY; пустые корзины отсутствуют."""
+    table = get_table_name()
+    with connection(read_only=True) as conn, conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT (id - %s) / %s AS bucket,
+                   COUNT(*),
+                   SUM(id),
+                   SUM(mod({_UPDATED_MS_SQL}, %s)),
+                   SUM({_TAGS_DIGEST_SQL})
+            FROM {table}
+            WHERE id >= %s AND id < %s
+            GROUP BY 1;
+            """,
+            (start_id, width, CHECKSUM_MOD, start_id, end_id),
+        )
+        return {int(row[0]): tuple(int(v) for v in row[1:]) for row in cur.fetchall()}
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    """id -> (updated_ms, tags_digest) для узкого диапазона, где суммы разошлись."""
+    table = get_table_name()
+    with connection(read_only=True) as conn, conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT id, {_UPDATED_MS_SQL}, {_TAGS_DIGEST_SQL}
+            FROM {table}
+            WHERE id >= %s AND id < %s;
+            """,
+            (start_id, end_id),
+        )
+        return {int(row[0]): (int(row[1]), int(row[2])) for row in cur.fetchall()}
+
+
+EXPORT_ITERSIZE = int(os.getenv("NOTES_EXPORT_ITERSIZE", "1000"))
+
+
+def iter_notes(
+    q: Optional[str] = None,
+    tag: Optional[str] = None,
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Все подходящие заметки по возрастанию id через именованный (server-side) курсор:
+    Postgres отдаёт строки пачками по EXPORT_ITERSIZE, память не растёт с размером таблицы.
+    Соединение из пула занято, пока генератор не исчерпан или не закрыт.
+    """
+    table = get_table_name()
+    columns = build_select_list(fields)
+    where, params = build_filters(q, [tag] if tag else None, "all", updated_from, updated_to)
+    with connection(read_only=True) as conn:
+        with conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            cur.execute(
+                f"""
+                SELECT {columns}
+                FROM {table}
+                {where}
+                ORDER BY id;
+                """,
+                params,
+            )
+            for row in cur:
+                yield dict(row)
+
+
 def update_note(note_id: int, title: Optional[str], content: Optional[str], tags: Optional[List[str]]) -> Optional[Dict[str, Any]]:
+    note, _ = update_note_with_previous_tags(note_id, title, content, tags)
+    return note
+
+
+def update_note_with_previous_tags(
+    note_id: int, title: Optional[str], content: Optional[str], tags: Optional[List[str]]
+) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+    """
+    Как update_note, но дополнительно возвращает теги до изменения (одним UPDATE ... FROM
+    под блокировкой строки) — для инкрементального пересчёта счётчиков тегов.
+    """
     table = get_table_name()
     fields = []
     params: List[Any] = []
@@ -155,38 +747,55 @@ def update_note(note_id: int, title: Optional[str], content: Optional[str], tags
         fields.append("tags = %s")
         params.append(tags)
     if not fields:
-        return fetch_note(note_id)
+        note = fetch_note(note_id)
+        return note, note["tags"] if note else None
 
     params.append(note_id)
     set_clause = ", ".join(fields)
 
-    with get_connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
             f"""
-            UPDATE {table}
+            UPDATE {table} AS n
             SET {set_clause}
-            WHERE id = %s
-            RETURNING id, title, content, tags, created_at, updated_at;
+            FROM (SELECT id, tags FROM {table} WHERE id = %s FOR UPDATE) AS prev
+            WHERE n.id = prev.id
+            RETURNING n.id, n.title, n.content, n.tags, n.created_at, n.updated_at, prev.tags AS previous_tags;
             """,
             params,
         )
         row = cur.fetchone()
         if not row:
-            return None
+            return None, None
         conn.commit()
-        return dict(row)
+        note = dict(row)
+        return note, note.pop("previous_tags")
 
 
 def delete_note(note_id: int) -> bool:
+    return delete_note_returning_tags(note_id) is not None
+
+
+def delete_note_returning_tags(note_id: int) -> Optional[List[str]]:
+    """Удалить заметку; вернуть её теги или None, если заметки не было."""
     table = get_table_name()
-    with get_connection() as conn, conn.cursor() as cur:
+    with connection() as conn, conn.cursor() as cur:
         cur.execute(
             f"""
             DELETE FROM {table}
-            WHERE id = %s;
+            WHERE id = %s
+            RETURNING tags;
             """,
             (note_id,),
         )
-        deleted = cur.rowcount
+        row = cur.fetchone()
         conn.commit()
-        return deleted > 0
+        return list(row[0]) if row else None
+
+
+# NOTES_BACKEND=sqlite: те же функции поверх встроенного SQLite (api/backends/sqlite_notes.py)
+BACKEND = backends.selected("notes")
+if BACKEND == "sqlite":
+    from .backends import sqlite_notes as _backend
+
+    backends.install(globals(), _backend)
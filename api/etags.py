@@ -0,0 +1,42 @@
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional, Union
+
+# Клиенты могут хранить ответ, но обязаны перепроверять его через If-None-Match
+CACHE_CONTROL = os.getenv("NOTES_CACHE_CONTROL", "private, no-cache")
+
+
+def _to_datetime(value: Union[datetime, str]) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def note_etag(note: Dict[str, Any]) -> str:
+    """Сильный ETag заметки: id + updated_at в микросекундах."""
+    updated = _to_datetime(note["updated_at"])
+    return f'"n{note["id"]}-{int(updated.timestamp() * 1_000_000)}"'
+
+
+def versions_etag(note_id: int, latest_version: int, limit: int) -> str:
+    """ETag списка версий: меняется с каждой новой версией; limit влияет на тело ответа."""
+    return f'"v{note_id}-{latest_version}-{limit}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Сравнение для If-None-Match (RFC 9110: слабое сравнение, поддержка списка и *)."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
@@ -0,0 +1,182 @@
+"""
+Лента изменений заметок по SSE (GET /events/stream).
+
+Воркер держит одну подписку на события (queue.subscribe: временная очередь на fanout exchange
+RabbitMQ или подписчик memory-очереди) и раздаёт каждое событие подключённым клиентам внутри
+event loop. Кадр SSE собирается один раз на событие из тела, пришедшего от брокера, и общий для всех клиентов.
+
+У клиента своя очередь на EVENTS_CLIENT_BUFFER кадров. Если клиент не успевает её разбирать,
+он отключается событием dropped — EventSource переподключится с Last-Event-ID.
+Последние EVENTS_REPLAY_SIZE событий хранятся в кольцевом буфере: по Last-Event-ID клиент
+получает пропущенное. Если такого id в буфере уже нет, приходит событие reset: состояние надо перечитать.
+Подписка на брокер открывается при первом клиенте, без клиентов лента ничего не стоит.
+"""
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+import orjson
+
+from . import queue as mq
+from . import tenants
+
+CLIENT_BUFFER = int(os.getenv("EVENTS_CLIENT_BUFFER", "256"))  # кадров на клиента до отключения
+REPLAY_SIZE = int(os.getenv("EVENTS_REPLAY_SIZE", "1000"))  # событий для Last-Event-ID
+HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))  # секунд между комментариями-пингами
+MAX_CLIENTS = int(os.getenv("EVENTS_MAX_CLIENTS", "10000"))  # на воркер
+RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", "3000"))  # пауза переподключения для EventSource
+
+
+def _frame(event_id: Optional[str], event_type: str, data: bytes) -> bytes:
+    # JSON тела события однострочный, поэтому кладётся в одно поле data как есть;
+    # без id — кадр не сдвигает Last-Event-ID клиента
+    head = b"id: %s\n" % event_id.encode() if event_id else b""
+    return head + b"event: %s\ndata: %s\n\n" % (event_type.encode(), data)
+
+
+class Client:
+    """Подключение к ленте: фильтры и ограниченная очередь кадров."""
+
+    def __init__(
+        self,
+        queue_name: str,
+        tags: Optional[List[str]] = None,
+        ids: Optional[List[int]] = None,
+        actions: Optional[List[str]] = None,
+    ):
+        self.queue_name = queue_name
+        self.tags = set(tags) if tags else None
+        self.ids = set(ids) if ids else None
+        self.actions = set(actions) if actions else None
+        self.buffer: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=CLIENT_BUFFER)
+        self.dropped = False
+
+    def matches(self, queue_name: str, event: Dict) -> bool:
+        if queue_name != self.queue_name:
+            return False
+        if self.actions is not None and event.get("action") not in self.actions:
+            return False
+        note = event.get("note") or {}
+        if self.ids is not None and note.get("id") not in self.ids:
+            return False
+        # у note_deleted есть только id — по тегам его не отфильтровать, такие события проходят
+        if self.tags is not None and "tags" in note and not self.tags.intersection(note.get("tags") or ()):
+            return False
+        return True
+
+
+class Hub:
+    def __init__(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.clients: Set[Client] = set()
+        # (имя очереди арендатора, id, событие, кадр)
+        self.ring: Deque[Tuple[str, str, Dict, bytes]] = deque(maxlen=REPLAY_SIZE)
+        self.delivered = 0
+        self.dropped = 0
+        self._unsubscribe = None
+        self._lock = threading.Lock()
+
+    def _ensure_subscribed(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+        with self._lock:
+            if self._unsubscribe is None:
+                self._unsubscribe = mq.subscribe(self._on_message)
+
+    def _on_message(self, queue_name: str, body: bytes) -> None:
+        # поток брокера (или поток запроса для memory-очереди) — в event loop только передаём
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._dispatch, queue_name, body)
+
+    def _dispatch(self, queue_name: str, body: bytes) -> None:
+        try:
+            event = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return
+        if not event.get("id"):
+            return  # опубликовано без id (старый воркер) — продолжить с него ленту нельзя
+        frame = _frame(str(event["id"]), str(event.get("action") or "message"), body)
+        self.ring.append((queue_name, str(event["id"]), event, frame))
+        for client in list(self.clients):
+            if not client.matches(queue_name, event):
+                continue
+            try:
+                client.buffer.put_nowait(frame)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # медленный клиент: больше не пишем, его генератор увидит флаг на следующем кадре
+                client.dropped = True
+                self.clients.discard(client)
+                self.dropped += 1
+
+    def connect(self, client: Client, last_event_id: Optional[str]) -> List[bytes]:
+        """
+        Зарегистрировать клиента и вернуть кадры для досылки после last_event_id.
+        Вызывается в event loop, поэтому между снимком буфера и регистрацией событие не потеряется.
+        """
+        if len(self.clients) >= MAX_CLIENTS:
+            raise OverflowError("Too many event stream clients")
+        self._ensure_subscribed()
+        replay: List[bytes] = []
+        if last_event_id:
+            position = next((i for i, item in enumerate(self.ring) if item[1] == last_event_id), None)
+            if position is None:
+                # продолжить ленту клиент сможет с самого свежего события буфера
+                newest = self.ring[-1][1] if self.ring else None
+                replay.append(_frame(newest, "reset", b'{"reason":"last_event_id not in replay buffer"}'))
+            else:
+                for queue_name, _, event, frame in list(self.ring)[position + 1 :]:
+                    if client.matches(queue_name, event):
+                        replay.append(frame)
+        self.clients.add(client)
+        return replay
+
+    def disconnect(self, client: Client) -> None:
+        self.clients.discard(client)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "clients": len(self.clients),
+            "replay_buffer": len(self.ring),
+            "delivered": self.delivered,
+            "dropped_clients": self.dropped,
+        }
+
+
+hub = Hub()
+
+
+def open_stream(
+    tags: Optional[List[str]] = None,
+    ids: Optional[List[int]] = None,
+    actions: Optional[List[str]] = None,
+    last_event_id: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """Подключить клиента текущего арендатора и вернуть поток кадров SSE (OverflowError — мест нет)."""
+    client = Client(tenants.current()["queue"], tags=tags, ids=ids, actions=actions)
+    replay = hub.connect(client, last_event_id)
+    return _frames(client, replay)
+
+
+async def _frames(client: Client, replay: List[bytes]) -> AsyncIterator[bytes]:
+    try:
+        yield b"retry: %d\n\n" % RETRY_MS
+        for frame in replay:
+            yield frame
+        while True:
+            try:
+                frame = await asyncio.wait_for(client.buffer.get(), timeout=HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if client.dropped:
+                yield _frame(None, "dropped", b'{"reason":"client too slow"}')
+                return
+            yield frame
+    finally:
+        hub.disconnect(client)
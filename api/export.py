@@ -0,0 +1,76 @@
+"""
+Потоковый экспорт заметок: строки из server-side курсора Postgres собираются
+в пачки, к пачке при необходимости одним запросом подтягиваются версии из Mongo,
+и пачка сразу кодируется в NDJSON/CSV (опционально gzip).
+"""
+import csv
+import io
+import os
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List
+
+import orjson
+
+from . import mongo_versions
+
+EXPORT_BATCH_SIZE = int(os.getenv("NOTES_EXPORT_BATCH_SIZE", "500"))
+CSV_COLUMNS = ["id", "title", "content", "tags", "created_at", "updated_at"]
+
+
+def batched(rows: Iterable[Dict[str, Any]], size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Dict[str, Any]]]:
+    batch: List[Dict[str, Any]] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def with_versions(batches: Iterable[List[Dict[str, Any]]]) -> Iterator[List[Dict[str, Any]]]:
+    for batch in batches:
+        versions = mongo_versions.get_versions_for_notes([note["id"] for note in batch])
+        for note in batch:
+            note["versions"] = versions.get(note["id"], [])
+        yield batch
+
+
+def ndjson_chunks(batches: Iterable[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield b"".join(orjson.dumps(note, default=str) + b"\n" for note in batch)
+
+
+def csv_chunks(batches: Iterable[List[Dict[str, Any]]], include_versions: bool = False) -> Iterator[bytes]:
+    columns = CSV_COLUMNS + (["versions"] if include_versions else [])
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue().encode("utf-8")
+    buf.seek(0)
+    buf.truncate()
+    for batch in batches:
+        for note in batch:
+            row = []
+            for col in columns:
+                value = note.get(col)
+                if col == "tags":
+                    value = ";".join(value or [])
+                elif col == "versions":
+                    value = orjson.dumps(value or [], default=str).decode("utf-8")
+                elif value is not None and not isinstance(value, (str, int)):
+                    value = value.isoformat() if hasattr(value, "isoformat") else str(value)
+                row.append(value)
+            writer.writerow(row)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 — формат gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,9 +1,14 @@
 import os
+import re
+from collections import defaultdict
 from functools import lru_cache
-from typing import List
+from typing import Dict, List, Tuple
 
 from neo4j import GraphDatabase
 
+from . import backends, tenants
+from .checksums import CHECKSUM_MOD, tags_digest, updated_ms
+
 
 @lru_cache(maxsize=1)
 def get_driver():
@@ -15,15 +20,38 @@ def get_driver():
     return GraphDatabase.driver(uri, auth=auth)
 
 
-@lru_cache(maxsize=1)
+_LABEL_RE = re.compile(r":(Note|Tag)\b")
+
+
+@lru_cache(maxsize=4096)
+def _scoped(query: str, suffix: str) -> str:
+    return _LABEL_RE.sub(lambda m: f":{m.group(1)}{suffix}", query)
+
+
+def _q(query: str) -> str:
+    """
+    Запрос в пространстве текущего арендатора: у арендатора по умолчанию метки Note/Tag,
+    у остальных — Note_<t>/Tag_<t>. Графы арендаторов не пересекаются, а запросы не меняются.
+    """
+    suffix = tenants.current()["neo4j_suffix"]
+    return _scoped(query, suffix) if suffix else query
+
+
 def ensure_constraints() -> None:
+    _ensure_constraints(tenants.current()["neo4j_suffix"])
+
+
+@lru_cache(maxsize=None)
+def _ensure_constraints(suffix: str) -> None:
     drv = get_driver()
     with drv.session() as session:
         session.run(
-            "CREATE CONSTRAINT note_id_unique IF NOT EXISTS FOR (n:Note) REQUIRE n.note_id IS UNIQUE"
+            f"CREATE CONSTRAINT note_id_unique{suffix} IF NOT EXISTS "
+            f"FOR (n:Note{suffix}) REQUIRE n.note_id IS UNIQUE"
         ).consume()
         session.run(
-            "CREATE CONSTRAINT tag_name_unique IF NOT EXISTS FOR (t:Tag) REQUIRE t.name IS UNIQUE"
+            f"CREATE CONSTRAINT tag_name_unique{suffix} IF NOT EXISTS "
+            f"FOR (t:Tag{suffix}) REQUIRE t.name IS UNIQUE"
         ).consume()
 
 
@@ -31,38 +59,285 @@ def upsert_note_with_tags(note: dict) -> None:
     """
     Создаёт/обновляет узел Note и связи с Tag для списка tags.
     Note хранит note_id, title, tags (для удобства) — основное хранилище остаётся в Postgres.
+    Связи с тегами, которых у заметки больше нет, снимаются — иначе счётчики тегов врут.
     """
+    upsert_notes_with_tags([note])
+
+
+def _tag_pairs(tags) -> set:
+    ordered = sorted(set(tags))
+    return {(a, b) for i, a in enumerate(ordered) for b in ordered[i + 1:]}
+
+
+def _tag_deltas(changes: List[Tuple[List[str], List[str]]]) -> Tuple[List[dict], List[dict]]:
+    """
+    Изменения Tag.note_count и CO_OCCURS.count по списку (старые теги, новые теги) заметок.
+    Пара тегов хранится одним ребром (a)-[:CO_OCCURS]->(b) с a < b.
+    """
+    counts: Dict[str, int] = defaultdict(int)
+    pairs: Dict[Tuple[str, str], int] = defaultdict(int)
+    for old_tags, new_tags in changes:
+        old, new = set(old_tags or []), set(new_tags or [])
+        for tag in new - old:
+            counts[tag] += 1
+        for tag in old - new:
+            counts[tag] -= 1
+        old_pairs, new_pairs = _tag_pairs(old), _tag_pairs(new)
+        for pair in new_pairs - old_pairs:
+            pairs[pair] += 1
+        for pair in old_pairs - new_pairs:
+            pairs[pair] -= 1
+    return (
+        [{"name": name, "delta": d} for name, d in counts.items() if d],
+        [{"a": a, "b": b, "delta": d} for (a, b), d in pairs.items() if d],
+    )
+
+
+def _apply_tag_deltas(tx, changes: List[Tuple[List[str], List[str]]]) -> None:
+    counts, pairs = _tag_deltas(changes)
+    if counts:
+        tx.run(
+            _q("""
+            UNWIND $counts AS c
+            MERGE (t:Tag {name: c.name})
+            SET t.note_count = coalesce(t.note_count, 0) + c.delta
+            """),
+            counts=counts,
+        ).consume()
+    if pairs:
+        tx.run(
+            _q("""
+            UNWIND $pairs AS p
+            MERGE (a:Tag {name: p.a})
+            MERGE (b:Tag {name: p.b})
+            MERGE (a)-[r:CO_OCCURS]->(b)
+            SET r.count = coalesce(r.count, 0) + p.delta
+            WITH r
+            WHERE r.count <= 0
+            DELETE r
+            """),
+            pairs=pairs,
+        ).consume()
+
+
+def _upsert_notes_tx(tx, rows: List[dict]) -> None:
+    # старые теги читаем в той же транзакции, что и запись, — по ним считаем дельты счётчиков
+    res = tx.run(
+        _q("""
+        UNWIND $rows AS row
+        MERGE (n:Note {note_id: row.id})
+        WITH n, row, coalesce(n.tags, []) AS old_tags
+        SET n.title = row.title,
+            n.tags = row.tags,
+            n.updated_ms = row.updated_ms,
+            n.tags_digest = row.tags_digest
+        RETURN row.id AS id, old_tags
+        """),
+        rows=rows,
+    )
+    old = {r["id"]: r["old_tags"] for r in res}
+    tx.run(
+        _q("""
+        UNWIND $rows AS row
+        MATCH (n:Note {note_id: row.id})
+        OPTIONAL MATCH (n)-[r:TAGGED_WITH]->(old:Tag)
+        WHERE NOT old.name IN row.tags
+        DELETE r
+        WITH DISTINCT n, row
+        UNWIND row.tags AS tag
+            MERGE (t:Tag {name: tag})
+            MERGE (n)-[:TAGGED_WITH]->(t)
+        """),
+        rows=rows,
+    ).consume()
+    _apply_tag_deltas(tx, [(old.get(row["id"], []), row["tags"]) for row in rows])
+
+
+def upsert_notes_with_tags(notes: List[dict]) -> None:
+    """
+    Пакетный вариант upsert_note_with_tags для переиндексации: одна транзакция на пачку (UNWIND).
+    Заодно снимает связи с тегами, которых у заметки больше нет, и поддерживает
+    Tag.note_count и веса рёбер CO_OCCURS.
+    """
+    if not notes:
+        return
     ensure_constraints()
     drv = get_driver()
-    tags = note.get("tags") or []
+    rows = [
+        {
+            "id": n["id"],
+            "title": n.get("title", ""),
+            "tags": n.get("tags") or [],
+            "updated_ms": updated_ms(n["updated_at"]) if n.get("updated_at") else None,
+            "tags_digest": tags_digest(n.get("tags") or []),
+        }
+        for n in notes
+    ]
     with drv.session() as session:
-        session.run(
-            """
-            MERGE (n:Note {note_id: $id})
-            SET n.title = $title,
-                n.tags = $tags
-            WITH n
-            UNWIND $tags AS tag
-                MERGE (t:Tag {name: tag})
-                MERGE (n)-[:TAGGED_WITH]->(t)
-            """,
-            id=note["id"],
-            title=note.get("title", ""),
-            tags=tags,
-        )
+        session.execute_write(_upsert_notes_tx, rows)
+
+
+def _delete_notes_tx(tx, note_ids: List[int]) -> None:
+    res = tx.run(
+        _q("""
+        UNWIND $ids AS id
+        MATCH (n:Note {note_id: id})
+        WITH n, coalesce(n.tags, []) AS old_tags
+        DETACH DELETE n
+        RETURN old_tags
+        """),
+        ids=list(note_ids),
+    )
+    _apply_tag_deltas(tx, [(r["old_tags"], []) for r in res])
 
 
 def delete_note(note_id: int) -> None:
+    delete_notes([note_id])
+
+
+def delete_notes(note_ids: List[int]) -> None:
+    if not note_ids:
+        return
     ensure_constraints()
     drv = get_driver()
     with drv.session() as session:
+        session.execute_write(_delete_notes_tx, note_ids)
+
+
+def rebuild_tag_stats() -> None:
+    """
+    Полный пересчёт Tag.note_count и рёбер CO_OCCURS по связям TAGGED_WITH.
+    Нужен один раз для графа, собранного до появления счётчиков, или после ручных правок.
+    """
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        session.run(
+            _q("""
+            MATCH (t:Tag)
+            OPTIONAL MATCH (t)<-[r:TAGGED_WITH]-(:Note)
+            WITH t, count(r) AS cnt
+            SET t.note_count = cnt
+            """)
+        ).consume()
+        session.run(_q("MATCH (:Tag)-[r:CO_OCCURS]->(:Tag) DELETE r")).consume()
         session.run(
-            """
-            MATCH (n:Note {note_id: $id})
-            DETACH DELETE n
-            """,
+            _q("""
+            MATCH (a:Tag)<-[:TAGGED_WITH]-(n:Note)-[:TAGGED_WITH]->(b:Tag)
+            WHERE a.name < b.name
+            WITH a, b, count(DISTINCT n) AS cnt
+            MERGE (a)-[r:CO_OCCURS]->(b)
+            SET r.count = cnt
+            """)
+        ).consume()
+
+
+def related_notes(note_id: int, limit: int = 10, per_tag: int = 200, method: str = "adamic_adar") -> List[Dict]:
+    """
+    Заметки с общими тегами, ранжированные по Adamic-Adar (общие редкие теги весят больше,
+    вес тега 1/log(1 + Tag.note_count)) или по Jaccard.
+    На каждый тег берём не больше per_tag кандидатов, поэтому стоимость запроса
+    ограничена даже для очень частых тегов.
+    """
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        res = session.run(
+            _q("""
+            MATCH (n:Note {note_id: $id})-[:TAGGED_WITH]->(t:Tag)
+            WITH n, collect(t) AS ntags
+            UNWIND ntags AS t
+            CALL {
+                WITH n, t
+                MATCH (t)<-[:TAGGED_WITH]-(m:Note)
+                WHERE m <> n
+                RETURN m
+                LIMIT $per_tag
+            }
+            WITH DISTINCT ntags, m
+            // общие теги считаем по свойству m.tags, а не по выборке кандидатов — это точно
+            WITH m, ntags, [x IN ntags WHERE x.name IN coalesce(m.tags, [])] AS shared
+            WITH m, shared, size(ntags) + size(coalesce(m.tags, [])) - size(shared) AS union_size
+            RETURN m.note_id AS note_id,
+                   [x IN shared | x.name] AS shared_tags,
+                   toFloat(size(shared)) / CASE WHEN union_size > 0 THEN union_size ELSE 1 END AS jaccard,
+                   reduce(
+                       s = 0.0, x IN shared |
+                       s + 1.0 / log(1.0 + CASE WHEN x.note_count > 1 THEN x.note_count ELSE 1 END)
+                   ) AS adamic_adar
+            ORDER BY CASE $method WHEN 'jaccard' THEN jaccard ELSE adamic_adar END DESC, note_id DESC
+            LIMIT $limit
+            """),
             id=note_id,
+            per_tag=per_tag,
+            method=method,
+            limit=limit,
+        )
+        return [r.data() for r in res]
+
+
+def related_tags(tag: str, limit: int = 10) -> List[Dict]:
+    """
+    Теги, чаще всего встречающиеся вместе с tag (по готовым рёбрам CO_OCCURS),
+    с нормировкой count / sqrt(note_count(a) * note_count(b)), чтобы не всплывали просто популярные теги.
+    """
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        res = session.run(
+            _q("""
+            MATCH (t:Tag {name: $tag})-[r:CO_OCCURS]-(o:Tag)
+            WITH o, r.count AS together,
+                 toFloat(r.count) / sqrt(toFloat(coalesce(t.note_count, 1)) * coalesce(o.note_count, 1)) AS score
+            RETURN o.name AS tag, together AS count, score
+            ORDER BY score DESC, count DESC, tag
+            LIMIT $limit
+            """),
+            tag=tag,
+            limit=limit,
         )
+        return [r.data() for r in res]
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    """Контрольные суммы корзин по узлам Note (range seek по индексу уникальности note_id)."""
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        res = session.run(
+            _q("""
+            MATCH (n:Note)
+            WHERE n.note_id >= $start AND n.note_id < $end
+            RETURN (n.note_id - $start) / $width AS bucket,
+                   count(n) AS cnt,
+                   sum(n.note_id) AS ids,
+                   sum(coalesce(n.updated_ms, 0) % $mod) AS upd,
+                   sum(coalesce(n.tags_digest, 0)) AS tags
+            """),
+            start=start_id,
+            end=end_id,
+            width=width,
+            mod=CHECKSUM_MOD,
+        )
+        return {r["bucket"]: (r["cnt"], r["ids"], r["upd"], r["tags"]) for r in res}
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        res = session.run(
+            _q("""
+            MATCH (n:Note)
+            WHERE n.note_id >= $start AND n.note_id < $end
+            RETURN n.note_id AS note_id,
+                   coalesce(n.updated_ms, 0) AS upd,
+                   coalesce(n.tags_digest, 0) AS tags
+            """),
+            start=start_id,
+            end=end_id,
+        )
+        return {r["note_id"]: (r["upd"], r["tags"]) for r in res}
 
 
 def get_notes_by_tag(tag: str, limit: int = 20) -> List[int]:
@@ -70,28 +345,50 @@ def get_notes_by_tag(tag: str, limit: int = 20) -> List[int]:
     drv = get_driver()
     with drv.session() as session:
         res = session.run(
-            """
+            _q("""
             MATCH (t:Tag {name: $tag})<-[:TAGGED_WITH]-(n:Note)
             RETURN n.note_id AS note_id
             LIMIT $limit
-            """,
+            """),
             tag=tag,
             limit=limit,
         )
         return [r["note_id"] for r in res]
 
 
+def tag_counts() -> Dict[str, int]:
+    """Число заметок на каждый тег — для полной пересборки снимка тегов в Redis."""
+    ensure_constraints()
+    drv = get_driver()
+    with drv.session() as session:
+        res = session.run(
+            _q("""
+            MATCH (t:Tag)<-[:TAGGED_WITH]-(n:Note)
+            RETURN t.name AS name, count(n) AS cnt
+            """)
+        )
+        return {r["name"]: r["cnt"] for r in res}
+
+
 def list_tags(limit: int = 100) -> List[str]:
     ensure_constraints()
     drv = get_driver()
     with drv.session() as session:
         res = session.run(
-            """
+            _q("""
             MATCH (t:Tag)
             RETURN t.name AS name
             ORDER BY name
             LIMIT $limit
-            """,
+            """),
             limit=limit,
         )
         return [r["name"] for r in res]
+
+
+# GRAPH_BACKEND=memory: граф тегов в памяти процесса (api/backends/memory_graph.py)
+BACKEND = backends.selected("graph")
+if BACKEND == "memory":
+    from .backends import memory_graph as _backend
+
+    backends.install(globals(), _backend)
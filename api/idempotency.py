@@ -0,0 +1,103 @@
+"""
+Idempotency-Key для записывающих запросов (POST /notes, PUT /notes/{id}, POST /notes/{id}/restore).
+
+Первый запрос с ключом ставит в Redis метку «выполняется» (SET NX) и после успеха
+заменяет её готовым ответом. Повтор с тем же ключом и телом получает сохранённый
+ответ без повторной записи во все хранилища; параллельный повтор ждёт, пока первая
+попытка закончится. Тот же ключ с другим телом — 422.
+Если первая попытка упала, метка снимается, и повтор выполняется заново.
+"""
+import hashlib
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from . import cache
+
+RESULT_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # сколько хранится ответ, секунд
+LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "30"))  # страховка, если воркер умер посреди запроса
+WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "10"))  # сколько повтор ждёт первую попытку
+POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+# Значение ключа: b"P" + отпечаток (32) + токен владельца — выполняется;
+#                 b"D" + отпечаток (32) + JSON ответа — готово.
+_PENDING = b"P"
+_DONE = b"D"
+_FP_LEN = 32
+
+
+def idempotency_key(scope: str, key: str) -> str:
+    return cache.tenant_key(f"idem:{scope}:{key}")
+
+
+def fingerprint(scope: str, payload: Dict[str, Any]) -> bytes:
+    raw = orjson.dumps([scope, payload], option=orjson.OPT_SORT_KEYS)
+    return hashlib.md5(raw).hexdigest().encode("ascii")
+
+
+def _replay(value: bytes, fp: bytes) -> Response:
+    if value[1 : 1 + _FP_LEN] != fp:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    return Response(
+        content=value[1 + _FP_LEN :],
+        media_type="application/json",
+        headers={"Idempotency-Replayed": "true"},
+    )
+
+
+def run(key: Optional[str], scope: str, payload: Dict[str, Any], handler: Callable[[], Dict[str, Any]]):
+    """
+    Выполнить handler не больше одного раза на ключ. Без ключа — просто вызвать handler.
+    Если Redis недоступен, запрос выполняется без защиты от повторов (как и кэш, она не критична).
+    """
+    if not key:
+        return handler()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+    rkey = idempotency_key(scope, key)
+    fp = fingerprint(scope, payload)
+    pending = _PENDING + fp + uuid.uuid4().hex.encode("ascii")
+    try:
+        acquired = cache.set_if_absent(rkey, pending, LOCK_TTL)
+    except Exception:
+        return handler()
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while not acquired:
+        value = cache.get_raw(rkey)
+        if value is None:
+            # первая попытка упала и сняла метку — пробуем выполнить сами
+            acquired = cache.set_if_absent(rkey, pending, LOCK_TTL)
+            continue
+        if value[:1] == _DONE:
+            return _replay(value, fp)
+        if value[1 : 1 + _FP_LEN] != fp:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key is still in progress",
+                headers={"Retry-After": "1"},
+            )
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        result = handler()
+    except BaseException:
+        try:
+            cache.delete_if_equal(rkey, pending)
+        except Exception:
+            pass
+        raise
+    try:
+        cache.replace_if_equal(rkey, pending, _DONE + fp + cache.encode_note(result), RESULT_TTL)
+    except Exception:
+        pass
+    return result
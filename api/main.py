@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 
 from pathlib import Path
 
@@ -8,13 +10,150 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
+from starlette.concurrency import run_in_threadpool
+
+from . import admission, backends, cache, coalesce, db, events, profiling, tenants
 from .db import ensure_table_exists
-from .routes import router
+from .responses import ORJSONResponse
+from .routes import rebuild_tag_index, router
+
+TAGS_REBUILD_INTERVAL = int(os.getenv("TAGS_REBUILD_INTERVAL", "300"))  # секунд, 0 — отключить
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))  # журнал медленных запросов с запуска, 0 — выключен
+
+
+def _tags_rebuild_loop() -> None:
+    # снимок тегов в Redis правится инкрементально; периодическая пересборка
+    # по графу убирает накопившийся дрейф. Лок в Redis — один воркер на интервал.
+    while True:
+        time.sleep(TAGS_REBUILD_INTERVAL)
+        for name in tenants.known():
+            token = tenants.use(name)
+            try:
+                if cache.acquire_tag_rebuild_lock(TAGS_REBUILD_INTERVAL):
+                    rebuild_tag_index()
+            except Exception as exc:
+                print(f"[tags] rebuild failed for tenant {name!r}: {exc}")
+            finally:
+                tenants.reset(token)
+
+
+def _flush_pending(now=None) -> None:
+    for name in coalesce.pending_tenants():
+        token = tenants.use(name)
+        try:
+            coalesce.flush_all_due(now)
+        except Exception as exc:
+            print(f"[coalesce] flush failed for tenant {name!r}: {exc}")
+        finally:
+            tenants.reset(token)
+
+
+def _coalesce_flush_loop() -> None:
+    while True:
+        time.sleep(coalesce.FLUSH_INTERVAL)
+        _flush_pending()
+
+
+class TenantMiddleware:
+    """
+    Арендатор запроса из X-Tenant или префикса /t/<tenant>/ (см. api/tenants.py).
+    Для нового арендатора схема Postgres создаётся при первом запросе, дальше — проверка флага.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        raw = tenants.resolve(scope)
+        if raw is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            name = tenants.validate(raw)
+        except ValueError as exc:
+            await ORJSONResponse({"detail": str(exc)}, status_code=400)(scope, receive, send)
+            return
+        except LookupError as exc:
+            await ORJSONResponse({"detail": str(exc)}, status_code=404)(scope, receive, send)
+            return
+        token = tenants.use(name)
+        try:
+            if not db.schema_ready():
+                try:
+                    await run_in_threadpool(ensure_table_exists)
+                except Exception as exc:
+                    await ORJSONResponse({"detail": f"Failed to prepare tenant: {exc}"}, status_code=500)(
+                        scope, receive, send
+                    )
+                    return
+            await self.app(scope, receive, send)
+        finally:
+            tenants.reset(token)
+
+
+PRIMARY_COOKIE = "notes_primary_until"
+_WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class ReadYourWritesMiddleware:
+    """
+    После успешной записи клиент получает cookie с моментом, до которого его чтения
+    идут на primary Postgres; входящая cookie выставляет это окно для запроса (см. db.connection).
+    Работает между воркерами: состояние хранится у клиента, а не в процессе.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope.get("headers") or []:
+            if name == b"cookie":
+                for part in value.decode("latin-1").split(";"):
+                    key, _, raw = part.strip().partition("=")
+                    if key == PRIMARY_COOKIE:
+                        try:
+                            db.prefer_primary_until(float(raw))
+                        except ValueError:
+                            pass
+        if (
+            scope["method"] not in _WRITE_METHODS
+            or scope["path"] in admission.READ_POSTS
+            or db.READ_YOUR_WRITES_SECONDS <= 0
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = time.time() + db.READ_YOUR_WRITES_SECONDS
+                cookie = (
+                    f"{PRIMARY_COOKIE}={until:.3f}; Max-Age={int(db.READ_YOUR_WRITES_SECONDS) + 1}; "
+                    "Path=/; HttpOnly; SameSite=Lax"
+                )
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
 
 
 def create_app() -> FastAPI:
     load_dotenv()  # подтягиваем .env на старте
-    app = FastAPI(title="Notes Assistant API")
+    # orjson по умолчанию: заметно быстрее stdlib json и сам сериализует datetime
+    app = FastAPI(title="Notes Assistant API", default_response_class=ORJSONResponse)
+    # Сброс нагрузки по классам запросов; CORS добавляется позже и оборачивает его,
+    # поэтому и ответы 503/429 приходят с CORS-заголовками
+    app.add_middleware(ReadYourWritesMiddleware)
+    app.add_middleware(admission.AdmissionMiddleware)
+    # снаружи admission: время медленного запроса включает ожидание в очереди класса
+    app.add_middleware(profiling.ProfilingMiddleware)
+    # арендатор определяется раньше всего остального: префикс /t/<tenant> срезается до классификации запроса
+    app.add_middleware(TenantMiddleware)
     # Разрешаем CORS для локального теста UI
     app.add_middleware(
         CORSMiddleware,
@@ -22,12 +161,34 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["ETag", "X-Next-Cursor", "Idempotency-Replayed"],
     )
 
     @app.on_event("startup")
     def _init_db():
         ensure_table_exists()
 
+    @app.on_event("startup")
+    def _start_tags_rebuild():
+        if TAGS_REBUILD_INTERVAL > 0:
+            threading.Thread(target=_tags_rebuild_loop, name="tags-rebuild", daemon=True).start()
+
+    @app.on_event("startup")
+    def _start_slow_log():
+        if SLOW_REQUEST_MS > 0:
+            profiling.slow_log.configure(SLOW_REQUEST_MS)
+
+    @app.on_event("startup")
+    def _start_coalesce_flusher():
+        if coalesce.enabled():
+            threading.Thread(target=_coalesce_flush_loop, name="coalesce-flush", daemon=True).start()
+
+    @app.on_event("shutdown")
+    def _flush_coalesced():
+        # не ждать сроков: отложенное в памяти процесса (CACHE_BACKEND=memory) иначе потеряется
+        if coalesce.enabled():
+            _flush_pending(float("inf"))
+
     @app.get("/health")
     def health():
         return {
@@ -41,6 +202,10 @@ def create_app() -> FastAPI:
                 "neo4j_host": os.getenv("NEO4J_HOST", ""),
                 "rabbitmq_host": os.getenv("RABBITMQ_HOST", ""),
             },
+            "backends": backends.summary(),
+            "admission": admission.stats(),
+            "coalesce": coalesce.stats() if coalesce.enabled() else None,
+            "events": events.hub.stats(),
         }
 
     @app.get("/ping")
@@ -56,6 +221,7 @@ def create_app() -> FastAPI:
         return RedirectResponse(url="/web/")
 
     app.include_router(router)
+    app.include_router(profiling.router)
 
     return app
 
@@ -1,9 +1,13 @@
 import os
 import re
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from . import backends, tenants
+from .checksums import CHECKSUM_MOD, tags_digest
 
 
 def sanitize_suffix(name: str) -> str:
@@ -11,17 +15,16 @@ def sanitize_suffix(name: str) -> str:
 
 
 def get_db_and_collection() -> Dict[str, str]:
+    # база — общая для процесса (STUDENT_NAME), коллекция — своя у каждого арендатора
     base_db = os.getenv("MONGO_DB", "appdb")
     student = os.getenv("STUDENT_NAME", "").strip()
     db_name = f"{base_db}_{student}" if student else base_db
-    base_collection = "note_versions"
-    collection = (
-        f"{base_collection}_{sanitize_suffix(student.lower())}" if student else base_collection
-    )
-    return {"db_name": db_name, "collection": collection}
+    return {"db_name": db_name, "collection": tenants.current()["mongo_collection"]}
 
 
+@lru_cache(maxsize=1)
 def get_client() -> MongoClient:
+    """Общий клиент процесса (MongoClient держит свой пул); у арендаторов разные коллекции."""
     host = os.getenv("MONGO_HOST", "localhost")
     port = int(os.getenv("MONGO_PORT", "27017"))
     user = os.getenv("MONGO_USER", "root")
@@ -31,10 +34,23 @@ def get_client() -> MongoClient:
     return MongoClient(uri, serverSelectionTimeoutMS=3000)
 
 
+def ensure_indexes() -> None:
+    cfg = get_db_and_collection()
+    _ensure_indexes(cfg["db_name"], cfg["collection"])
+
+
+@lru_cache(maxsize=None)
+def _ensure_indexes(db_name: str, collection: str) -> None:
+    # все выборки идут по note_id с сортировкой по version
+    coll = get_client()[db_name][collection]
+    coll.create_index([("note_id", ASCENDING), ("version", DESCENDING)])
+
+
 def save_version(note: Dict[str, Any]) -> Dict[str, Any]:
     """
     note: dict with keys id, title, content, tags, created_at, updated_at
     """
+    ensure_indexes()
     cfg = get_db_and_collection()
     client = get_client()
     db = client[cfg["db_name"]]
@@ -51,6 +67,7 @@ def save_version(note: Dict[str, Any]) -> Dict[str, Any]:
         "title": note.get("title"),
         "content": note.get("content"),
         "tags": note.get("tags", []),
+        "tags_digest": tags_digest(note.get("tags") or []),
         "created_at": note.get("created_at"),
         "updated_at": note.get("updated_at"),
         "saved_at": datetime.utcnow(),
@@ -59,6 +76,37 @@ def save_version(note: Dict[str, Any]) -> Dict[str, Any]:
     return doc
 
 
+def backfill_initial_versions(notes: List[Dict[str, Any]]) -> int:
+    """Создать версию 1 для заметок из пачки, у которых версий нет вовсе. Возвращает число вставленных."""
+    if not notes:
+        return 0
+    ensure_indexes()
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    ids = [note["id"] for note in notes]
+    existing = set(coll.distinct("note_id", {"note_id": {"$in": ids}}))
+    now = datetime.utcnow()
+    docs = [
+        {
+            "note_id": note["id"],
+            "version": 1,
+            "title": note.get("title"),
+            "content": note.get("content"),
+            "tags": note.get("tags", []),
+            "tags_digest": tags_digest(note.get("tags") or []),
+            "created_at": note.get("created_at"),
+            "updated_at": note.get("updated_at"),
+            "saved_at": now,
+        }
+        for note in notes
+        if note["id"] not in existing
+    ]
+    if docs:
+        coll.insert_many(docs, ordered=False)
+    return len(docs)
+
+
 def get_versions(note_id: int, limit: int = 20) -> List[Dict[str, Any]]:
     cfg = get_db_and_collection()
     client = get_client()
@@ -76,6 +124,31 @@ def get_versions(note_id: int, limit: int = 20) -> List[Dict[str, Any]]:
     return versions
 
 
+def get_latest_version(note_id: int) -> int:
+    """Номер последней версии (0, если версий нет) — для ETag списка версий."""
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    last = coll.find_one({"note_id": note_id}, sort=[("version", -1)], projection={"version": 1, "_id": 0})
+    return int(last["version"]) if last and "version" in last else 0
+
+
+def get_versions_for_notes(note_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """Версии сразу для пачки заметок одним запросом: note_id -> версии по убыванию."""
+    result: Dict[int, List[Dict[str, Any]]] = {nid: [] for nid in note_ids}
+    if not note_ids:
+        return result
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    cursor = coll.find({"note_id": {"$in": list(note_ids)}}, projection={"_id": 0}).sort(
+        [("note_id", 1), ("version", -1)]
+    )
+    for doc in cursor:
+        result.setdefault(doc["note_id"], []).append(doc)
+    return result
+
+
 def get_version(note_id: int, version: int) -> Optional[Dict[str, Any]]:
     cfg = get_db_and_collection()
     client = get_client()
@@ -95,3 +168,67 @@ def delete_versions(note_id: int) -> int:
     coll = db[cfg["collection"]]
     res = coll.delete_many({"note_id": note_id})
     return res.deleted_count
+
+
+def delete_versions_for_notes(note_ids: List[int]) -> int:
+    if not note_ids:
+        return 0
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    return coll.delete_many({"note_id": {"$in": list(note_ids)}}).deleted_count
+
+
+def _latest_versions_pipeline(start_id: int, end_id: int) -> List[Dict[str, Any]]:
+    # последняя версия каждой заметки диапазона; индекс (note_id, version) покрывает match + sort
+    return [
+        {"$match": {"note_id": {"$gte": start_id, "$lt": end_id}}},
+        {"$sort": {"note_id": 1, "version": -1}},
+        {
+            "$group": {
+                "_id": "$note_id",
+                "updated_ms": {"$first": {"$toLong": "$updated_at"}},
+                "tags_digest": {"$first": {"$ifNull": ["$tags_digest", 0]}},
+            }
+        },
+    ]
+
+
+def range_checksums(start_id: int, end_id: int, width: int) -> Dict[int, Tuple[int, int, int, int]]:
+    """Контрольные суммы корзин по последним версиям, целиком на стороне Mongo."""
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    pipeline = _latest_versions_pipeline(start_id, end_id) + [
+        {
+            "$group": {
+                "_id": {"$toLong": {"$floor": {"$divide": [{"$subtract": ["$_id", start_id]}, width]}}},
+                "cnt": {"$sum": 1},
+                "ids": {"$sum": "$_id"},
+                "upd": {"$sum": {"$mod": [{"$ifNull": ["$updated_ms", 0]}, CHECKSUM_MOD]}},
+                "tags": {"$sum": "$tags_digest"},
+            }
+        }
+    ]
+    return {
+        int(doc["_id"]): (int(doc["cnt"]), int(doc["ids"]), int(doc["upd"]), int(doc["tags"]))
+        for doc in coll.aggregate(pipeline, allowDiskUse=True)
+    }
+
+
+def range_fingerprints(start_id: int, end_id: int) -> Dict[int, Tuple[int, int]]:
+    cfg = get_db_and_collection()
+    client = get_client()
+    coll = client[cfg["db_name"]][cfg["collection"]]
+    return {
+        int(doc["_id"]): (int(doc.get("updated_ms") or 0), int(doc["tags_digest"]))
+        for doc in coll.aggregate(_latest_versions_pipeline(start_id, end_id), allowDiskUse=True)
+    }
+
+
+# VERSIONS_BACKEND=sqlite: версии во встроенном SQLite (api/backends/sqlite_versions.py)
+BACKEND = backends.selected("versions")
+if BACKEND == "sqlite":
+    from .backends import sqlite_versions as _backend
+
+    backends.install(globals(), _backend)
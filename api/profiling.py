@@ -0,0 +1,454 @@
+"""
+Профилирование по запросу и журнал медленных запросов (эндпойнты /admin/*, нужен ADMIN_TOKEN).
+
+- cprofile: cProfile следующих N запросов к маршруту (или всех запросов за окно). На время
+  захвата обработчик маршрута подменяется обёрткой, после захвата возвращается исходный.
+- sample: сэмплер раз в interval_ms снимает стеки всех потоков процесса (sys._current_frames)
+  и копит их в свёрнутом виде «кадр;кадр;кадр N» — вход для flamegraph.pl и speedscope.
+- Медленные запросы: запрос дольше SLOW_REQUEST_MS пишется в лог с разбивкой времени по хранилищам
+  (db, cache, mongo_versions, qdrant_vectors, graph, queue). Пока журнал включён, публичные
+  функции этих модулей обёрнуты таймером; время считается по самому внешнему вызову хранилища.
+
+Выключенное ничего не стоит: нет обёрток, таймеров и потоков, middleware проверяет один флаг.
+"""
+import cProfile
+import contextvars
+import functools
+import hmac
+import inspect
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
+
+from . import cache, db, graph, mongo_versions, qdrant_vectors, tenants
+from . import queue as mq
+from .schemas import ProfileStart, SlowLogConfig
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+SLOW_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", "100"))  # последних медленных запросов в GET /admin/slow-requests
+MAX_SAMPLES = 1_000_000  # предел числа снятых стеков за сессию сэмплера
+
+BACKEND_MODULES = {
+    "db": db,
+    "cache": cache,
+    "mongo_versions": mongo_versions,
+    "qdrant_vectors": qdrant_vectors,
+    "graph": graph,
+    "queue": mq,
+}
+
+
+# --- время по хранилищам ---------------------------------------------------------------------
+
+
+class _Timings:
+    """Время запроса по хранилищам; общий объект для потоков запроса (ветки гибридного поиска)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.backends: Dict[str, List[float]] = {}
+
+    def add(self, backend: str, seconds: float) -> None:
+        with self.lock:
+            item = self.backends.setdefault(backend, [0, 0.0])
+            item[0] += 1
+            item[1] += seconds
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {name: {"calls": int(calls), "ms": round(total * 1000, 2)} for name, (calls, total) in self.backends.items()}
+
+
+_timings: contextvars.ContextVar[Optional[_Timings]] = contextvars.ContextVar("request_timings", default=None)
+_nesting = threading.local()  # вызовы хранилищ внутри вызова хранилища не считаем второй раз
+_originals: Dict[Tuple[str, str], Callable] = {}
+_wrap_lock = threading.Lock()
+
+
+def _timed(backend: str, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        timings = _timings.get()
+        if timings is None or getattr(_nesting, "depth", 0):
+            return fn(*args, **kwargs)
+        _nesting.depth = 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _nesting.depth = 0
+            timings.add(backend, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _instrumentable(module, name: str, value: Any) -> bool:
+    # только свои (или установленного встроенного бэкенда) синхронные функции модуля;
+    # корутины и генераторы обёртка измерила бы неправильно, lru_cache-объекты не трогаем
+    if name.startswith("_") or not inspect.isfunction(value):
+        return False
+    if inspect.iscoroutinefunction(value) or inspect.isgeneratorfunction(value):
+        return False
+    return value.__module__ == module.__name__ or value.__module__.startswith("api.backends.")
+
+
+def _instrument() -> None:
+    with _wrap_lock:
+        if _originals:
+            return
+        for backend, module in BACKEND_MODULES.items():
+            for name, value in list(vars(module).items()):
+                if _instrumentable(module, name, value):
+                    _originals[(backend, name)] = value
+                    setattr(module, name, _timed(backend, value))
+
+
+def _uninstrument() -> None:
+    with _wrap_lock:
+        for (backend, name), value in _originals.items():
+            setattr(BACKEND_MODULES[backend], name, value)
+        _originals.clear()
+
+
+# --- журнал медленных запросов ---------------------------------------------------------------
+
+
+class _SlowLog:
+    def __init__(self) -> None:
+        self.threshold_ms = 0.0
+        self.entries: Deque[Dict[str, Any]] = deque(maxlen=SLOW_LOG_SIZE)
+
+    def configure(self, threshold_ms: float) -> None:
+        if threshold_ms > 0:
+            _instrument()
+            self.threshold_ms = threshold_ms
+        else:
+            self.threshold_ms = 0.0
+            _uninstrument()
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        self.entries.append(entry)
+        print(f"[slow] {entry['method']} {entry['route']} {entry['status']} {entry['ms']}ms backends={entry['backends']}")
+
+
+slow_log = _SlowLog()
+
+
+class ProfilingMiddleware:
+    """Замер запроса для журнала медленных; при выключенном журнале — одна проверка флага."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        threshold_ms = slow_log.threshold_ms
+        if not threshold_ms or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = _Timings()
+        token = _timings.set(timings)
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _timings.reset(token)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms >= threshold_ms:
+                route = scope.get("route")
+                slow_log.record(
+                    {
+                        "at": time.time(),
+                        "method": scope["method"],
+                        "route": getattr(route, "path", None) or scope["path"],
+                        "path": scope["path"],
+                        "query": scope.get("query_string", b"").decode("latin-1"),
+                        "tenant": tenants.current()["name"],
+                        "status": status["code"],
+                        "ms": round(elapsed_ms, 2),
+                        "backends": timings.summary(),
+                    }
+                )
+
+
+# --- сессии профилирования -------------------------------------------------------------------
+
+
+class _Session:
+    def __init__(self, spec: ProfileStart):
+        self.mode = spec.mode
+        self.route = spec.route
+        self.method = spec.method.upper() if spec.method else None
+        self.seconds = spec.seconds
+        self.requests = spec.requests
+        self.interval = spec.interval_ms / 1000.0
+        self.started = time.time()
+        self.ended: Optional[float] = None
+        self.captured = 0
+        self.skipped = 0  # запросы, пришедшие, пока профилировался другой (cProfile — один на процесс)
+        self.stats: Optional[pstats.Stats] = None
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.patched: List[Tuple[APIRoute, Callable]] = []
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "route": self.route,
+            "method": self.method,
+            "active": self.ended is None,
+            "started_at": self.started,
+            "ended_at": self.ended,
+            "seconds": self.seconds,
+            "requests": self.requests,
+            "captured_requests": self.captured if self.mode == "cprofile" else None,
+            "skipped_requests": self.skipped if self.mode == "cprofile" else None,
+            "samples": self.sample_count if self.mode == "sample" else None,
+        }
+
+
+_session: Optional[_Session] = None
+_session_lock = threading.Lock()
+_profiler_lock = threading.Lock()
+
+
+def _api_routes(routes) -> Iterator[Any]:
+    """
+    Маршруты с обработчиком (dependant) с учётом вложенных роутеров. Новые версии FastAPI держат
+    include_router как отдельный узел, у которого на каждое включение свой экземпляр маршрута
+    со своим dependant — подменять обработчик надо именно в нём, а не в APIRoute роутера.
+    """
+    for route in routes:
+        if isinstance(route, APIRoute):
+            yield route
+        elif hasattr(route, "effective_candidates"):
+            for candidate in route.effective_candidates():
+                if hasattr(candidate, "effective_candidates"):
+                    yield from _api_routes([candidate])
+                elif getattr(candidate, "dependant", None) is not None and candidate.methods:
+                    yield candidate
+
+
+def _matches(route: APIRoute, session: _Session) -> bool:
+    # async-обработчики выполняются в event loop вперемешку с другими запросами — cProfile их не разделит
+    if route.path.startswith("/admin") or inspect.iscoroutinefunction(route.dependant.call):
+        return False
+    if session.route and route.path != session.route:
+        return False
+    return not session.method or session.method in route.methods
+
+
+def _profiled(session: _Session, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # cProfile видит только свой поток; второй профилировщик одновременно не включить
+        if not _profiler_lock.acquire(blocking=False):
+            session.skipped += 1
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            _profiler_lock.release()
+            _collect(session, profile)
+
+    return wrapper
+
+
+def _collect(session: _Session, profile: cProfile.Profile) -> None:
+    with session.lock:
+        if session.ended is not None:
+            return
+        if session.stats is None:
+            session.stats = pstats.Stats(profile)
+        else:
+            session.stats.add(profile)
+        session.captured += 1
+        done = session.requests is not None and session.captured >= session.requests
+    if done:
+        threading.Thread(target=_finish, args=(session,), daemon=True).start()
+
+
+def _is_idle(frame) -> bool:
+    # потоки пула и event loop большую часть времени ждут работы — такие стеки только шум
+    code = frame.f_code
+    return code.co_name in ("wait", "select", "poll", "_worker", "get") and os.path.basename(code.co_filename) in (
+        "threading.py",
+        "selectors.py",
+        "queue.py",
+        "thread.py",
+        "_thread.py",
+    )
+
+
+def _stack(frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def _sample_loop(session: _Session) -> None:
+    own = threading.get_ident()
+    while not session.stop_event.wait(session.interval):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        with session.lock:
+            for ident, frame in sys._current_frames().items():
+                if ident == own or _is_idle(frame):
+                    continue
+                session.samples[f"{names.get(ident, ident)};{_stack(frame)}"] += 1
+            session.sample_count += 1
+            full = session.sample_count >= MAX_SAMPLES
+        if full:
+            break
+    _finish(session)
+
+
+def _finish(session: _Session) -> None:
+    with session.lock:
+        if session.ended is not None:
+            return
+        session.ended = time.time()
+        for route, original in session.patched:
+            route.dependant.call = original
+        session.patched.clear()
+    session.stop_event.set()
+
+
+def start(app, spec: ProfileStart) -> _Session:
+    global _session
+    with _session_lock:
+        if _session is not None and _session.ended is None:
+            raise RuntimeError("A profiling session is already running")
+        session = _Session(spec)
+        if spec.mode == "cprofile":
+            routes = [r for r in _api_routes(app.routes) if _matches(r, session)]
+            if not routes:
+                raise LookupError(f"No synchronous route matches {spec.method or '*'} {spec.route or '*'}")
+            for route in routes:
+                # обработчик берётся из route.dependant при каждом запросе — подмена действует сразу
+                session.patched.append((route, route.dependant.call))
+                route.dependant.call = _profiled(session, route.dependant.call)
+        else:
+            threading.Thread(target=_sample_loop, args=(session,), name="profiling-sampler", daemon=True).start()
+        timer = threading.Timer(spec.seconds, _finish, args=(session,))
+        timer.daemon = True
+        timer.start()
+        _session = session
+    return session
+
+
+def stop() -> Optional[_Session]:
+    session = _session
+    if session is not None:
+        _finish(session)
+    return session
+
+
+# --- эндпойнты -------------------------------------------------------------------------------
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token")) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")  # без ADMIN_TOKEN эндпойнтов как бы нет
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@router.post("/profile")
+def start_profile(spec: ProfileStart, request: Request):
+    try:
+        session = start(request.app, spec)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    except LookupError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return session.info()
+
+
+@router.get("/profile")
+def profile_status():
+    if _session is None:
+        raise HTTPException(status_code=404, detail="No profiling session")
+    return _session.info()
+
+
+@router.delete("/profile")
+def stop_profile():
+    session = stop()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profiling session")
+    return session.info()
+
+
+@router.get("/profile/result")
+def profile_result(
+    fmt: str = Query("text", alias="format", pattern="^(text|pstats|collapsed)$"),
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|ncalls)$"),
+    limit: int = Query(50, ge=1, le=1000),
+):
+    """text/pstats — для cprofile (pstats: файл для snakeviz / pstats.Stats), collapsed — стеки сэмплера."""
+    session = _session
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profiling session")
+    with session.lock:
+        if session.mode == "sample":
+            if fmt != "collapsed":
+                raise HTTPException(status_code=400, detail="sample sessions support format=collapsed")
+            body = "\n".join(f"{stack} {count}" for stack, count in session.samples.most_common())
+            return Response(content=body + "\n", media_type="text/plain; charset=utf-8")
+        if fmt == "collapsed":
+            raise HTTPException(status_code=400, detail="cprofile sessions support format=text|pstats")
+        if session.stats is None:
+            raise HTTPException(status_code=404, detail="No requests captured yet")
+        if fmt == "pstats":
+            return Response(
+                content=marshal.dumps(session.stats.stats),
+                media_type="application/octet-stream",
+                headers={"Content-Disposition": 'attachment; filename="profile.pstats"'},
+            )
+        out = io.StringIO()
+        # копия: сортировка и поток вывода не должны трогать накопленную статистику сессии
+        stats = pstats.Stats(stream=out)
+        stats.add(session.stats)
+        stats.sort_stats(sort).print_stats(limit)
+    return Response(content=out.getvalue(), media_type="text/plain; charset=utf-8")
+
+
+@router.get("/slow-requests")
+def slow_requests(limit: int = Query(SLOW_LOG_SIZE, ge=1, le=1000)):
+    return {"threshold_ms": slow_log.threshold_ms, "requests": list(slow_log.entries)[-limit:][::-1]}
+
+
+@router.put("/slow-requests")
+def configure_slow_requests(config: SlowLogConfig):
+    """threshold_ms > 0 включает журнал (и таймеры хранилищ) в этом воркере, 0 — выключает."""
+    slow_log.configure(config.threshold_ms)
+    return {"threshold_ms": slow_log.threshold_ms}
@@ -1,17 +1,51 @@
 import hashlib
 import os
 import re
-from typing import Any, Dict, List, Optional
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as rest
+from qdrant_client.http.exceptions import UnexpectedResponse
+
+from . import backends, cache, tenants
+from .checksums import fold_checksums, tags_digest, updated_ms
+
+
+QUERY_CACHE_SIZE = int(os.getenv("QDRANT_QUERY_CACHE_SIZE", "1024"))
+NOTE_VECTOR_CACHE_SIZE = int(os.getenv("QDRANT_NOTE_VECTOR_CACHE_SIZE", "4096"))
+TOKEN_RE = re.compile(r"[a-zA-Z0-9а-яА-ЯёЁ]+")
+
+# Параметры индекса применяются при создании коллекции; для существующей —
+# пересобрать её через scripts/reindex.py --target-collection ... --alias ...
+HNSW_M = int(os.getenv("QDRANT_HNSW_M", "16"))
+HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", "100"))
+HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", "0"))  # ef при поиске; 0 — значение Qdrant по умолчанию
+QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none").lower()  # none | int8
+ON_DISK = os.getenv("QDRANT_ON_DISK", "0") == "1"  # исходные векторы на диске, в памяти — квантованные
+# Индексы payload: фильтры по тегам и времени выполняются внутри HNSW-поиска, а не после него
+PAYLOAD_INDEXES = {
+    "tags": rest.PayloadSchemaType.KEYWORD,
+    "note_id": rest.PayloadSchemaType.INTEGER,
+    "updated_ms": rest.PayloadSchemaType.INTEGER,
+}
+
+# Коллекции, для которых в этом процессе уже проверены существование и индексы payload
+_ready_collections: Dict[str, bool] = {}
+# Размерность коллекций для проверки векторов из кэша процесса (сбрасывается при ошибке поиска)
+_collection_sizes: Dict[str, int] = {}
 
 
 def sanitize_suffix(name: str) -> str:
     return re.sub(r"[^a-zA-Z0-9_]", "_", name)
 
 
+@lru_cache(maxsize=1)
 def get_client() -> QdrantClient:
+    """Общий клиент процесса; у арендаторов разные коллекции."""
     return QdrantClient(
         host=os.getenv("QDRANT_HOST", "localhost"),
         port=int(os.getenv("QDRANT_PORT", "6333")),
@@ -20,14 +54,8 @@ def get_client() -> QdrantClient:
 
 
 def get_collection_name() -> str:
-    # Можно принудительно указать коллекцию в .env (например, выданную преподавателем)
-    override = os.getenv("QDRANT_COLLECTION")
-    if override:
-        return override
-
-    base = "notes_vectors"
-    student = os.getenv("STUDENT_NAME", "").strip()
-    return f"{base}_{sanitize_suffix(student.lower())}" if student else base
+    # QDRANT_COLLECTION из .env (например, выданная преподавателем) действует для арендатора по умолчанию
+    return tenants.current()["qdrant_collection"]
 
 
 def _get_existing_vector_size(client: QdrantClient, col: str) -> Optional[int]:
@@ -57,22 +85,111 @@ def get_vector_size(client: Optional[QdrantClient] = None) -> int:
     return 128
 
 
-def ensure_collection() -> None:
+def collection_names(client: QdrantClient) -> List[str]:
+    """Имена коллекций и алиасов (при blue/green переключении QDRANT_COLLECTION может быть алиасом)."""
+    names = [c.name for c in client.get_collections().collections]
+    try:
+        names.extend(a.alias_name for a in client.get_aliases().aliases)
+    except Exception:
+        pass
+    return names
+
+
+def _quantization_config() -> Optional[rest.ScalarQuantization]:
+    if QUANTIZATION != "int8":
+        return None
+    return rest.ScalarQuantization(
+        scalar=rest.ScalarQuantizationConfig(type=rest.ScalarType.INT8, quantile=0.99, always_ram=True)
+    )
+
+
+def search_params() -> Optional[rest.SearchParams]:
+    """hnsw_ef и пересчёт по исходным векторам, если коллекция квантована."""
+    if not HNSW_EF and QUANTIZATION == "none":
+        return None
+    quantization = rest.QuantizationSearchParams(rescore=True) if QUANTIZATION != "none" else None
+    return rest.SearchParams(hnsw_ef=HNSW_EF or None, quantization=quantization)
+
+
+def ensure_payload_indexes(client: QdrantClient, col: str) -> None:
+    try:
+        existing = set((client.get_collection(col).payload_schema or {}).keys())
+    except Exception:
+        existing = set()
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field not in existing:
+            client.create_payload_index(collection_name=col, field_name=field, field_schema=schema, wait=True)
+
+
+def ensure_collection(collection: Optional[str] = None, size: Optional[int] = None) -> None:
     client = get_client()
-    col = get_collection_name()
-    existing = client.get_collections()
-    names = [c.name for c in existing.collections]
-    if col in names:
+    col = collection or get_collection_name()
+    if _ready_collections.get(col):
         return
-    # Если указана коллекция явно и её нет — не создаём новую, а сигнализируем ошибку
-    if os.getenv("QDRANT_COLLECTION"):
-        raise ValueError(f"Qdrant collection '{col}' not found. Please create it or fix QDRANT_COLLECTION.")
+    if col not in collection_names(client):
+        # Коллекцию из QDRANT_COLLECTION (арендатор по умолчанию) не создаём, а сигнализируем ошибку;
+        # коллекции notes_vectors_<tenant> остальных арендаторов создаются при первом обращении
+        if collection is None and tenants.current()["is_default"] and os.getenv("QDRANT_COLLECTION"):
+            raise ValueError(f"Qdrant collection '{col}' not found. Please create it or fix QDRANT_COLLECTION.")
 
-    size = get_vector_size(client)
-    client.create_collection(
-        collection_name=col,
-        vectors_config=rest.VectorParams(size=size, distance=rest.Distance.COSINE),
+        size = size or get_vector_size(client)
+        client.create_collection(
+            collection_name=col,
+            vectors_config=rest.VectorParams(size=size, distance=rest.Distance.COSINE, on_disk=ON_DISK or None),
+            hnsw_config=rest.HnswConfigDiff(m=HNSW_M, ef_construct=HNSW_EF_CONSTRUCT),
+            quantization_config=_quantization_config(),
+        )
+    ensure_payload_indexes(client, col)
+    _ready_collections[col] = True
+
+
+def _collection_missing(exc: Exception) -> bool:
+    return isinstance(exc, UnexpectedResponse) and exc.status_code == 404
+
+
+def _retry_if_dropped(collection: Optional[str], call: Callable[[], Any]) -> Any:
+    """
+    Вызов к коллекции с одной повторной попыткой, если её удалили или пересоздали после проверки
+    (Qdrant перезапущен без хранилища, blue/green уборка): флаг «готова» снимается, коллекция
+    проверяется и создаётся заново, как при первом обращении.
+    """
+    try:
+        return call()
+    except Exception as exc:
+        if not _collection_missing(exc):
+            raise
+        _ready_collections.pop(collection or get_collection_name(), None)
+        _collection_sizes.pop(collection or get_collection_name(), None)
+        ensure_collection(collection=collection)
+        return call()
+
+
+def serves_live(collection: Optional[str]) -> bool:
+    """Из collection сейчас читает API (это рабочая коллекция или на неё указывает рабочий алиас)."""
+    live = get_collection_name()
+    if collection is None or collection == live:
+        return True
+    try:
+        aliases = get_client().get_aliases().aliases
+    except Exception:
+        return False
+    return any(a.alias_name == live and a.collection_name == collection for a in aliases)
+
+
+def switch_alias(alias: str, collection: str) -> None:
+    """Атомарно направить алиас на новую коллекцию (blue/green)."""
+    client = get_client()
+    operations: List[Any] = []
+    if alias in [a.alias_name for a in client.get_aliases().aliases]:
+        operations.append(rest.DeleteAliasOperation(delete_alias=rest.DeleteAlias(alias_name=alias)))
+    operations.append(
+        rest.CreateAliasOperation(create_alias=rest.CreateAlias(collection_name=collection, alias_name=alias))
     )
+    client.update_collection_aliases(change_aliases_operations=operations)
+    # за алиасом теперь другая коллекция (возможно, другой размерности) — векторы процесса устарели
+    _note_vectors.clear()
+    _collection_sizes.clear()
+    _vectors_changed()
 
 
 def embed_text(text: str, size: int) -> List[float]:
@@ -83,7 +200,7 @@ def embed_text(text: str, size: int) -> List[float]:
     - Получаем "мешок слов" фиксированной длины.
     - Нормализуем вектор до длины 1 (если все нули, оставляем).
     """
-    tokens = re.findall(r"[a-zA-Z0-9а-яА-ЯёЁ]+", text.lower())
+    tokens = TOKEN_RE.findall(text.lower())
     vec = [0.0] * size
     for tok in tokens:
         h = hashlib.md5(tok.encode("utf-8")).digest()
@@ -97,46 +214,176 @@ def embed_text(text: str, size: int) -> List[float]:
     return vec
 
 
-def embed_note(note: Dict[str, Any]) -> List[float]:
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_tokens(normalized: str, size: int) -> Tuple[float, ...]:
+    return tuple(embed_text(normalized, size))
+
+
+def embed_query(text: str, size: int) -> List[float]:
+    """
+    embed_text для поисковых запросов с LRU-кэшем. Ключ — токены запроса в нижнем регистре:
+    регистр, пунктуация и лишние пробелы на эмбеддинг не влияют, поэтому не дробят кэш.
+    """
+    return list(_embed_tokens(" ".join(TOKEN_RE.findall(text.lower())), size))
+
+
+class _NoteVectorCache:
+    """
+    LRU векторов заметок, записанных этим процессом: (коллекция, id) -> (updated_ms, вектор).
+    Коллекция в ключе разводит арендаторов с одинаковыми id. Вектор отдаётся, только если updated_ms
+    совпадает с версией заметки у вызывающего, так что обновление из другого процесса просто даёт промах.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: "OrderedDict[Tuple[str, int], Tuple[Optional[int], List[float]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, col: str, note_id: int, version: Optional[int]) -> Optional[List[float]]:
+        with self.lock:
+            item = self.items.get((col, note_id))
+            if item is None or version is None or item[0] != version:
+                return None
+            self.items.move_to_end((col, note_id))
+            return item[1]
+
+    def put(self, col: str, note_id: int, version: Optional[int], vector: List[float]) -> None:
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.items[(col, note_id)] = (version, vector)
+            self.items.move_to_end((col, note_id))
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def discard(self, col: str, note_ids: Sequence[int]) -> None:
+        with self.lock:
+            for note_id in note_ids:
+                self.items.pop((col, note_id), None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+
+_note_vectors = _NoteVectorCache(NOTE_VECTOR_CACHE_SIZE)
+
+
+def _collection_size(client: QdrantClient, col: str) -> int:
+    size = _collection_sizes.get(col)
+    if size is None:
+        size = _collection_sizes[col] = get_vector_size(client)
+    return size
+
+
+def _note_version(note: Dict[str, Any]) -> Optional[int]:
+    return updated_ms(note["updated_at"]) if note.get("updated_at") is not None else None
+
+
+def _vectors_changed() -> None:
+    # сбрасывает закэшированные ответы /similar; недоступный Redis не должен ломать запись векторов
+    try:
+        cache.bump_vector_epoch()
+    except Exception:
+        pass
+
+
+def note_text(note: Dict[str, Any]) -> str:
     parts = [
         note.get("title", ""),
         note.get("content", ""),
         " ".join(note.get("tags", []) or []),
     ]
-    text = "\n".join(parts)
+    return "\n".join(parts)
+
+
+def embed_note(note: Dict[str, Any]) -> List[float]:
     client = get_client()
     size = get_vector_size(client)
-    return embed_text(text, size)
+    return embed_text(note_text(note), size)
 
 
-def upsert_note_vector(note: Dict[str, Any]) -> None:
-    ensure_collection()
-    client = get_client()
-    col = get_collection_name()
-    vec = embed_note(note)
+def build_payload(note: Dict[str, Any]) -> Dict[str, Any]:
     payload = {
         "note_id": note["id"],
         "title": note.get("title"),
         "tags": note.get("tags", []),
+        # отпечаток для сверки с Postgres (scripts/reconcile.py)
+        "tags_digest": tags_digest(note.get("tags") or []),
     }
-    client.upsert(
-        collection_name=col,
-        points=[
-            rest.PointStruct(
-                id=note["id"],
-                vector=vec,
-                payload=payload,
-            )
-        ],
-    )
+    if note.get("updated_at") is not None:
+        payload["updated_ms"] = updated_ms(note["updated_at"])
+    return payload
+
 
+def build_point(note: Dict[str, Any], size: int) -> rest.PointStruct:
+    payload = build_payload(note)
+    return rest.PointStruct(id=note["id"], vector=embed_text(note_text(note), size), payload=payload)
 
-def search_similar(note: Dict[str, Any], limit: int = 5) -> List[Dict[str, Any]]:
+
+def upsert_note_vector(note: Dict[str, Any]) -> None:
     ensure_collection()
     client = get_client()
     col = get_collection_name()
-    vec = embed_note(note)
-    res = client.search(collection_name=col, query_vector=vec, limit=limit)
+    point = build_point(note, get_vector_size(client))
+    _retry_if_dropped(None, lambda: client.upsert(collection_name=col, points=[point]))
+    _note_vectors.put(col, note["id"], _note_version(note), point.vector)
+    _vectors_changed()
+
+
+def upsert_note_vectors(
+    notes: List[Dict[str, Any]],
+    collection: Optional[str] = None,
+    size: Optional[int] = None,
+) -> None:
+    """Пакетный upsert: размер вектора определяем один раз, все точки — одним запросом."""
+    if not notes:
+        return
+    client = get_client()
+    col = collection or get_collection_name()
+    size = size or get_vector_size(client)
+    points = [build_point(note, size) for note in notes]
+    _retry_if_dropped(collection, lambda: client.upsert(collection_name=col, points=points, wait=True))
+    # переиндексация прямо в рабочую коллекцию (или за рабочим алиасом) меняет ответы /similar
+    if serves_live(collection):
+        _note_vectors.discard(get_collection_name(), [note["id"] for note in notes])
+        _vectors_changed()
+
+
+def build_filter(
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+    exclude_ids: Optional[Sequence[int]] = None,
+) -> Optional[rest.Filter]:
+    """
+    Фильтр payload с той же семантикой, что у db.build_filters: tags any — хотя бы один тег,
+    all — все; updated_from <= updated_at < updated_to. Выполняется внутри поиска по индексам payload.
+    """
+    must: List[Any] = []
+    if tags:
+        if tags_mode == "all":
+            must.extend(rest.FieldCondition(key="tags", match=rest.MatchValue(value=t)) for t in tags)
+        else:
+            must.append(rest.FieldCondition(key="tags", match=rest.MatchAny(any=list(tags))))
+    if updated_from is not None or updated_to is not None:
+        must.append(
+            rest.FieldCondition(
+                key="updated_ms",
+                range=rest.Range(
+                    gte=updated_ms(updated_from) if updated_from is not None else None,
+                    lt=updated_ms(updated_to) if updated_to is not None else None,
+                ),
+            )
+        )
+    must_not: List[Any] = [rest.HasIdCondition(has_id=list(exclude_ids))] if exclude_ids else []
+    if not must and not must_not:
+        return None
+    return rest.Filter(must=must or None, must_not=must_not or None)
+
+
+def _hits(res) -> List[Dict[str, Any]]:
     results: List[Dict[str, Any]] = []
     for r in res:
         # note_id: берем из payload, если нет — из id точки
@@ -159,6 +406,92 @@ def search_similar(note: Dict[str, Any], limit: int = 5) -> List[Dict[str, Any]]
     return results
 
 
+def search_similar(
+    note: Dict[str, Any],
+    limit: int = 5,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Похожие на заметку по её уже сохранённому вектору; сама заметка в выдачу не попадает.
+    Вектор берём из кэша процесса, иначе просим Qdrant искать по id точки (recommend) —
+    без повторного эмбеддинга. Если точки ещё нет, эмбеддим заметку как раньше.
+    Вектор из кэша другой размерности или отвергнутый Qdrant выбрасывается (коллекцию под
+    алиасом пересобрали с другим --vector-size), и поиск идёт через recommend.
+    """
+    client = get_client()
+    col = get_collection_name()
+    query_filter = build_filter(tags, tags_mode, updated_from, updated_to, exclude_ids=[note["id"]])
+    vec = _note_vectors.get(col, note["id"], _note_version(note))
+    if vec is not None and len(vec) == _collection_size(client, col):
+        try:
+            res = client.search(
+                collection_name=col,
+                query_vector=vec,
+                query_filter=query_filter,
+                search_params=search_params(),
+                limit=limit,
+            )
+            return _hits(res)
+        except Exception:
+            _collection_sizes.pop(col, None)
+    if vec is not None:
+        _note_vectors.discard(col, [note["id"]])
+    try:
+        res = client.recommend(
+            collection_name=col,
+            positive=[note["id"]],
+            query_filter=query_filter,
+            search_params=search_params(),
+            limit=limit,
+        )
+        return _hits(res)
+    except Exception as exc:
+        if _collection_missing(exc):
+            _ready_collections.pop(col, None)
+        ensure_collection()
+        vec = embed_note(note)
+    res = _retry_if_dropped(
+        None,
+        lambda: client.search(
+            collection_name=col,
+            query_vector=vec,
+            query_filter=query_filter,
+            search_params=search_params(),
+            limit=limit,
+        ),
+    )
+    return _hits(res)
+
+
+def search_text(
+    q: str,
+    limit: int = 50,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    """Поиск по вектору произвольного запроса (тот же хэш-эмбеддинг, что и у заметок)."""
+    client = get_client()
+    col = get_collection_name()
+    vec = embed_query(q, get_vector_size(client))
+    res = _retry_if_dropped(
+        None,
+        lambda: client.search(
+            collection_name=col,
+            query_vector=vec,
+            query_filter=build_filter(tags, tags_mode, updated_from, updated_to),
+            search_params=search_params(),
+            limit=limit,
+            with_payload=["note_id"],
+        ),
+    )
+    return _hits(res)
+
+
 def delete_note_vector(note_id: int) -> None:
     client = get_client()
     col = get_collection_name()
@@ -167,3 +500,60 @@ def delete_note_vector(note_id: int) -> None:
     except Exception:
         # Если коллекции нет или точка не найдена — просто игнорируем
         pass
+    _note_vectors.discard(col, [note_id])
+    _vectors_changed()
+
+
+def delete_note_vectors(note_ids: List[int], collection: Optional[str] = None) -> None:
+    if not note_ids:
+        return
+    client = get_client()
+    col = collection or get_collection_name()
+    client.delete(collection_name=col, points_selector=rest.PointIdsList(points=list(note_ids)))
+    if serves_live(collection):
+        _note_vectors.discard(get_collection_name(), note_ids)
+        _vectors_changed()
+
+
+def iter_range_fingerprints(
+    start_id: int, end_id: int, collection: Optional[str] = None, batch: int = 1000
+) -> Iterator[Tuple[int, Tuple[int, int]]]:
+    """
+    (id, (updated_ms, tags_digest)) для точек с start_id <= id < end_id по возрастанию id.
+    Агрегаций у Qdrant нет, поэтому листаем scroll по возрастанию id точки (id точки = id заметки),
+    забирая только два поля payload без векторов.
+    """
+    client = get_client()
+    col = collection or get_collection_name()
+    offset: Any = start_id
+    while offset is not None:
+        points, offset = client.scroll(
+            collection_name=col,
+            offset=offset,
+            limit=batch,
+            with_payload=["updated_ms", "tags_digest"],
+            with_vectors=False,
+        )
+        for p in points:
+            pid = int(p.id)
+            if pid >= end_id:
+                return
+            payload = p.payload or {}
+            yield pid, (int(payload.get("updated_ms") or 0), int(payload.get("tags_digest") or 0))
+
+
+def range_fingerprints(start_id: int, end_id: int, collection: Optional[str] = None, batch: int = 1000) -> Dict[int, Tuple[int, int]]:
+    """id -> (updated_ms, tags_digest) для точек с start_id <= id < end_id."""
+    return dict(iter_range_fingerprints(start_id, end_id, collection=collection, batch=batch))
+
+
+def range_checksums(start_id: int, end_id: int, width: int, collection: Optional[str] = None) -> Dict[int, Tuple[int, int, int, int]]:
+    return fold_checksums(range_fingerprints(start_id, end_id, collection=collection), start_id, width)
+
+
+# VECTORS_BACKEND=numpy: точный поиск по матрице в памяти процесса (api/backends/numpy_vectors.py)
+BACKEND = backends.selected("vectors")
+if BACKEND == "numpy":
+    from .backends import numpy_vectors as _backend
+
+    backends.install(globals(), _backend)
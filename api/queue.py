@@ -1,38 +1,42 @@
 import json
 import os
+import threading
+import time
+import uuid
 from functools import lru_cache
-from typing import Dict
+from typing import Callable, Dict
 
 import pika
 
+from . import backends, tenants
 
-@lru_cache(maxsize=1)
-def get_connection():
+# Копия каждого события уходит в fanout exchange: из него читают ленты изменений воркеров
+# (api/events.py), не забирая сообщения у консюмеров рабочей очереди. routing key — имя очереди арендатора.
+EVENTS_EXCHANGE = os.getenv("RABBITMQ_EVENTS_EXCHANGE", "notes_events")
+
+
+def _connection_params() -> pika.ConnectionParameters:
     host = os.getenv("RABBITMQ_HOST", "zorin.space")
     port = int(os.getenv("RABBITMQ_PORT", "10009"))
     user = os.getenv("RABBITMQ_USER", "guest")
     password = os.getenv("RABBITMQ_PASSWORD", "guest")
-    params = pika.ConnectionParameters(
+    return pika.ConnectionParameters(
         host=host,
         port=port,
         credentials=pika.PlainCredentials(user, password),
         heartbeat=30,
         blocked_connection_timeout=5,
     )
-    return pika.BlockingConnection(params)
 
 
-def _default_queue_name() -> str:
-    student = os.getenv("STUDENT_NAME", "").strip().lower()
-    if student:
-        return f"notes_tasks_{student}"
-    return "notes_tasks"
+@lru_cache(maxsize=1)
+def get_connection():
+    return pika.BlockingConnection(_connection_params())
 
 
-@lru_cache(maxsize=1)
 def get_queue_name() -> str:
-    # Если явно указана очередь, берём её. Иначе формируем notes_tasks_<student>.
-    return os.getenv("RABBITMQ_QUEUE") or _default_queue_name()
+    # RABBITMQ_QUEUE или notes_tasks_<student> для арендатора по умолчанию, notes_tasks_<tenant> — для остальных
+    return tenants.current()["queue"]
 
 
 def publish_note_event(action: str, note: Dict) -> None:
@@ -46,13 +50,72 @@ def publish_note_event(action: str, note: Dict) -> None:
     queue_name = get_queue_name()
     channel.queue_declare(queue=queue_name, durable=True)
 
-    payload = json.dumps({"action": action, "note": note}, default=str)
+    body = encode_event(action, note)
     channel.basic_publish(
         exchange="",
         routing_key=queue_name,
-        body=payload.encode("utf-8"),
+        body=body,
         properties=pika.BasicProperties(
             delivery_mode=2,  # persistent
             content_type="application/json",
         ),
     )
+    channel.exchange_declare(exchange=EVENTS_EXCHANGE, exchange_type="fanout", durable=True)
+    channel.basic_publish(exchange=EVENTS_EXCHANGE, routing_key=queue_name, body=body)
+
+
+def encode_event(action: str, note: Dict) -> bytes:
+    """
+    Тело события. id уникален между воркерами (по нему SSE-клиент продолжает ленту
+    через Last-Event-ID), ts — миллисекунды публикации.
+    """
+    ts = int(time.time() * 1000)
+    event = {"id": f"{ts}-{uuid.uuid4().hex[:8]}", "ts": ts, "action": action, "note": note}
+    return json.dumps(event, default=str).encode("utf-8")
+
+
+def subscribe(callback: Callable[[str, bytes], None]) -> Callable[[], None]:
+    """
+    callback(queue_name, body) на каждое событие всех арендаторов — из отдельного потока
+    со своим соединением и временной очередью на EVENTS_EXCHANGE. При обрыве переподключается;
+    события, опубликованные за время обрыва, этой подписке не достаются.
+    Возвращает функцию отписки.
+    """
+    stop = threading.Event()
+
+    def consume() -> None:
+        backoff = 1.0
+        while not stop.is_set():
+            try:
+                connection = pika.BlockingConnection(_connection_params())
+                try:
+                    channel = connection.channel()
+                    channel.exchange_declare(exchange=EVENTS_EXCHANGE, exchange_type="fanout", durable=True)
+                    queue = channel.queue_declare(queue="", exclusive=True, auto_delete=True).method.queue
+                    channel.queue_bind(queue=queue, exchange=EVENTS_EXCHANGE)
+                    channel.basic_consume(
+                        queue=queue,
+                        on_message_callback=lambda ch, method, props, body: callback(method.routing_key, body),
+                        auto_ack=True,
+                    )
+                    backoff = 1.0
+                    while not stop.is_set():
+                        connection.process_data_events(time_limit=1)
+                finally:
+                    if connection.is_open:
+                        connection.close()
+            except Exception as exc:
+                print(f"[rabbitmq] events subscription lost: {exc}")
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    threading.Thread(target=consume, name="events-subscription", daemon=True).start()
+    return stop.set
+
+
+# QUEUE_BACKEND=memory: события внутри процесса (api/backends/memory_queue.py)
+BACKEND = backends.selected("queue")
+if BACKEND == "memory":
+    from .backends import memory_queue as _backend
+
+    backends.install(globals(), _backend)
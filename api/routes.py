@@ -1,15 +1,87 @@
-from typing import List, Optional
-
-from fastapi import APIRouter, HTTPException, Query
-
-from . import cache, db, graph, qdrant_vectors
+import itertools
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+
+from . import cache, coalesce, db, etags, events, export, graph, idempotency, mongo_versions, qdrant_vectors, search, tenants
 from . import queue as mq
-from .mongo_versions import delete_versions, get_version, get_versions, save_version
-from .schemas import NoteCreate, NoteOut, NoteRestore, NoteUpdate
+from .responses import ORJSONResponse
+from .schemas import NoteBatchGet, NoteCreate, NoteOut, NotePartialOut, NoteRestore, NoteUpdate
 
 router = APIRouter()
 
 
+IDEMPOTENCY_HEADER = Header(None, alias="Idempotency-Key", description="Retry-safe key: repeats replay the first response")
+FIELDS_QUERY = Query(None, description="Comma-separated fields to return, e.g. id,title,tags,preview")
+VIEW_QUERY = Query("full", pattern="^(full|summary)$", description="summary: title, tags, timestamps and a short preview")
+
+
+TAGS_QUERY = Query(None, description="Comma-separated tags to filter by")
+TAGS_MODE_QUERY = Query("any", pattern="^(any|all)$", description="any: at least one tag matches; all: every tag")
+
+
+def _parse_tags(tags: Optional[str]) -> Optional[List[str]]:
+    if not tags:
+        return None
+    return [t.strip() for t in tags.split(",") if t.strip()] or None
+
+
+def _parse_fields(fields: Optional[str], view: str) -> Optional[List[str]]:
+    """fields= важнее view=; None означает полную заметку."""
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+    elif view == "summary":
+        requested = list(db.SUMMARY_FIELDS)
+    else:
+        return None
+    try:
+        return db.normalize_fields(requested)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+def _remember_version(version_doc) -> None:
+    try:
+        cache.remember_latest_version(version_doc["note_id"], version_doc["version"])
+    except Exception:
+        pass  # ETag списка версий просто пересчитается из Mongo
+
+
+def _sync_tag_counts(old_tags, new_tags) -> None:
+    try:
+        cache.apply_tag_changes(old_tags, new_tags)
+    except Exception:
+        pass  # снимок тегов выровняется при периодической пересборке
+
+
+def rebuild_tag_index() -> None:
+    """Полная пересборка снимка тегов в Redis по графу Neo4j."""
+    cache.replace_tag_counts(graph.tag_counts())
+
+
+# Пока снимка тегов нет (холодный старт, вытеснен), его пересобирает один запрос — держатель лока;
+# остальные отвечают из счётчиков графа, которые воркер держит TAGS_FALLBACK_TTL секунд.
+TAGS_COLD_REBUILD_LOCK_TTL = int(os.getenv("TAGS_COLD_REBUILD_LOCK_TTL", "60"))
+TAGS_FALLBACK_TTL = float(os.getenv("TAGS_FALLBACK_TTL", "5"))
+_tag_fallback: Dict[str, Tuple[float, Dict[str, int]]] = {}
+_tag_fallback_lock = threading.Lock()
+
+
+def _fallback_tag_counts() -> Dict[str, int]:
+    name = tenants.current()["name"]
+    with _tag_fallback_lock:  # один проход по графу на воркер, параллельные запросы ждут его
+        cached = _tag_fallback.get(name)
+        if cached is None or cached[0] <= time.monotonic():
+            cached = _tag_fallback[name] = (time.monotonic() + TAGS_FALLBACK_TTL, graph.tag_counts())
+    return cached[1]
+
+
 def _safe_publish(action: str, payload):
     try:
         mq.publish_note_event(action, payload)
@@ -18,55 +90,178 @@ def _safe_publish(action: str, payload):
 
 
 @router.post("/notes", response_model=NoteOut)
-def create_note(payload: NoteCreate):
+def create_note(payload: NoteCreate, idempotency_key: Optional[str] = IDEMPOTENCY_HEADER):
+    return idempotency.run(idempotency_key, "create", payload.model_dump(), lambda: _create_note(payload))
+
+
+def _create_note(payload: NoteCreate):
     try:
         note = db.insert_note(payload.title, payload.content, payload.tags)
-        save_version(note)
-        try:
-            cache.cache_note(note)
-        except Exception:
-            pass  # кэш не критичен
-        qdrant_vectors.upsert_note_vector(note)  # если Qdrant недоступен — увидим ошибку в логах
-        try:
-            graph.upsert_note_with_tags(note)
-        except Exception:
-            pass
-        _safe_publish("note_created", note)
-        return note
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to create note: {exc}")
+    # Заметка уже в Postgres: дальше ошибки только логируем. Ответ 500 заставил бы клиента
+    # повторить POST (в том числе с Idempotency-Key — ключ после ошибки снимается) и создать дубль;
+    # недостающие версию и вектор досоздаёт scripts/reconcile.py.
+    try:
+        _remember_version(mongo_versions.save_version(note))
+    except Exception as exc:
+        print(f"[mongo] failed to save version of note {note['id']}: {exc}")
+    try:
+        cache.cache_note(note)
+    except Exception:
+        pass  # кэш не критичен
+    try:
+        qdrant_vectors.upsert_note_vector(note)
+    except Exception as exc:
+        print(f"[qdrant] failed to upsert note {note['id']}: {exc}")
+    try:
+        graph.upsert_note_with_tags(note)
+    except Exception:
+        pass
+    _sync_tag_counts(None, note.get("tags"))
+    _safe_publish("note_created", note)
+    return note
 
 
 @router.get("/notes/popular")
-def popular_notes(limit: int = 10):
+def popular_notes(limit: int = 10, fields: Optional[str] = FIELDS_QUERY, view: str = VIEW_QUERY):
+    projection = _parse_fields(fields, view)
     try:
         top = cache.get_top_popular(limit)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to read popularity: {exc}")
 
+    try:
+        # кэш читается под проекцию: без content в ней тело заметки из Redis не тянется
+        cached = cache.get_cached_notes([note_id for note_id, _ in top], projection)
+    except Exception:
+        cached = {}
+
     result = []
     for note_id, score in top:
         # берём из кэша или базы
-        note = cache.get_cached_note(note_id)
+        note = cached.get(note_id)
         if not note:
             note = db.fetch_note(note_id)
         if note:
-            result.append({"note": note, "score": score})
+            result.append({"note": db.project_note(note, projection), "score": score})
         else:
             result.append({"note_id": note_id, "score": score, "error": "not found"})
     return result
 
 
+@router.get("/notes/export")
+def export_notes(
+    fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    q: Optional[str] = Query(None, description="Search query"),
+    tag: Optional[str] = None,
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+    include_versions: bool = False,
+    gzip: bool = False,
+):
+    rows = db.iter_notes(q=q, tag=tag, updated_from=updated_from, updated_to=updated_to)
+    # первую строку читаем заранее: ошибка подключения должна стать 500, а не оборванным потоком
+    try:
+        first = next(rows, None)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to export notes: {exc}")
+
+    batches = export.batched(itertools.chain([first] if first else [], rows))
+    if include_versions:
+        batches = export.with_versions(batches)
+    if fmt == "csv":
+        chunks = export.csv_chunks(batches, include_versions=include_versions)
+        media_type, filename = "text/csv; charset=utf-8", "notes.csv"
+    else:
+        chunks = export.ndjson_chunks(batches)
+        media_type, filename = "application/x-ndjson", "notes.ndjson"
+
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if gzip:
+        chunks = export.gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+@router.get("/notes/facets")
+def note_facets(
+    q: Optional[str] = Query(None, description="Search query"),
+    tags: Optional[str] = TAGS_QUERY,
+    tags_mode: str = TAGS_MODE_QUERY,
+    limit: int = 50,
+):
+    try:
+        return db.tag_facets(q, tags=_parse_tags(tags), tags_mode=tags_mode, limit=limit)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to count tags: {exc}")
+
+
+@router.post("/notes/batch-get")
+def batch_get_notes(payload: NoteBatchGet, fields: Optional[str] = FIELDS_QUERY, view: str = VIEW_QUERY):
+    """
+    Несколько заметок за один запрос: один MGET в Redis, один SELECT ... ANY() по промахам,
+    дозапись кэша и счётчиков популярности pipeline-ами. Порядок как в ids, повторы убираются.
+    """
+    projection = _parse_fields(fields, view)
+    note_ids = list(dict.fromkeys(payload.ids))
+    try:
+        # полные заметки — готовым JSON, проекции — словарями (без content тело из кэша не читается)
+        if projection is None:
+            cached = cache.get_cached_notes_raw(note_ids)
+        else:
+            cached = cache.get_cached_notes(note_ids, projection)
+    except Exception:
+        cached = {}
+    misses = [nid for nid in note_ids if nid not in cached]
+    try:
+        fetched = {note["id"]: note for note in db.fetch_notes_by_ids(misses)} if misses else {}
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch notes: {exc}")
+
+    found = [nid for nid in note_ids if nid in cached or nid in fetched]
+    missing = [nid for nid in note_ids if nid not in cached and nid not in fetched]
+    try:
+        cache.cache_notes(list(fetched.values()))
+        cache.bump_popularity_many(found)
+    except Exception:
+        pass
+
+    if projection is None:
+        # полные заметки: JSON из кэша вклеивается в ответ без промежуточного разбора
+        parts = [cached[nid] if nid in cached else cache.encode_note(fetched[nid]) for nid in found]
+        body = b'{"notes":[' + b",".join(parts) + b'],"missing":' + orjson.dumps(missing) + b"}"
+        return Response(content=body, media_type="application/json")
+    notes = [db.project_note(cached[nid] if nid in cached else fetched[nid], projection) for nid in found]
+    return {"notes": notes, "missing": missing}
+
+
 @router.get("/notes/{note_id}", response_model=NoteOut)
-def get_note(note_id: int):
-    # сначала пробуем кэш
-    cached = cache.get_cached_note(note_id)
+def get_note(note_id: int, response: Response, if_none_match: Optional[str] = Header(None)):
+    # условный GET: если у клиента актуальная версия, хватает одного GET ETag из Redis
+    if if_none_match:
+        try:
+            cached_etag = cache.get_cached_etag(note_id)
+        except Exception:
+            cached_etag = None
+        if etags.etag_matches(if_none_match, cached_etag):
+            try:
+                cache.bump_popularity(note_id)
+            except Exception:
+                pass
+            return Response(status_code=304, headers=etags.cache_headers(cached_etag))
+
+    # сначала пробуем кэш: JSON из него уходит в ответ без validate/encode через NoteOut
+    try:
+        cached, cached_etag = cache.get_cached_note_with_etag(note_id)
+    except Exception:
+        cached, cached_etag = None, None
     if cached:
         try:
             cache.bump_popularity(note_id)
         except Exception:
             pass
-        return cached
+        return Response(content=cached, media_type="application/json", headers=etags.cache_headers(cached_etag))
 
     try:
         note = db.fetch_note(note_id)
@@ -80,64 +275,128 @@ def get_note(note_id: int):
         cache.bump_popularity(note_id)
     except Exception:
         pass
+    etag = etags.note_etag(note)
+    if etags.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=etags.cache_headers(etag))
+    response.headers.update(etags.cache_headers(etag))
     return note
 
 
 @router.put("/notes/{note_id}", response_model=NoteOut)
-def update_note(note_id: int, payload: NoteUpdate):
+def update_note(note_id: int, payload: NoteUpdate, idempotency_key: Optional[str] = IDEMPOTENCY_HEADER):
+    return idempotency.run(
+        idempotency_key, f"update:{note_id}", payload.model_dump(), lambda: _update_note(note_id, payload)
+    )
+
+
+def _update_note(note_id: int, payload: NoteUpdate):
     try:
-        note = db.update_note(note_id, payload.title, payload.content, payload.tags)
+        note, previous_tags = db.update_note_with_previous_tags(note_id, payload.title, payload.content, payload.tags)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to update note: {exc}")
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
+    if coalesce.enabled() and coalesce.defer(note_id):
+        # версия, вектор, граф и событие — одной синхронизацией после серии правок (api/coalesce.py)
+        try:
+            cache.cache_note(note)
+        except Exception:
+            pass
+        _sync_tag_counts(previous_tags, note.get("tags"))
+        return note
+    # правка уже в Postgres — ошибки хранилищ ниже только логируем, как в _create_note
     try:
-        save_version(note)
+        _remember_version(mongo_versions.save_version(note))
     except Exception as exc:
-        # не ломаем основной ответ, просто логируем деталь в detail
-        raise HTTPException(status_code=500, detail=f"Note updated, but failed to save version: {exc}")
+        print(f"[mongo] failed to save version of note {note_id}: {exc}")
     try:
         cache.cache_note(note)
     except Exception:
         pass
-    qdrant_vectors.upsert_note_vector(note)
+    try:
+        qdrant_vectors.upsert_note_vector(note)
+    except Exception as exc:
+        print(f"[qdrant] failed to upsert note {note_id}: {exc}")
     try:
         graph.upsert_note_with_tags(note)
     except Exception:
         pass
+    _sync_tag_counts(previous_tags, note.get("tags"))
     _safe_publish("note_updated", note)
     return note
 
 
-@router.get("/notes", response_model=List[NoteOut])
-def list_notes(q: Optional[str] = Query(None, description="Search query"), limit: int = 20, offset: int = 0):
+@router.get("/notes", response_model=List[NotePartialOut])
+def list_notes(
+    q: Optional[str] = Query(None, description="Search query"),
+    limit: int = 20,
+    offset: int = 0,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: str = VIEW_QUERY,
+    tags: Optional[str] = TAGS_QUERY,
+    tags_mode: str = TAGS_MODE_QUERY,
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page (keyset pagination)"),
+):
+    projection = _parse_fields(fields, view)
     try:
-        notes = db.search_notes(q, limit=limit, offset=offset)
-        return notes
+        notes = db.search_notes(
+            q,
+            limit=limit,
+            offset=offset,
+            fields=projection,
+            tags=_parse_tags(tags),
+            tags_mode=tags_mode,
+            cursor=cursor,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to list notes: {exc}")
+    # строки из Postgres уже в форме NoteOut — сериализуем напрямую, без повторной валидации
+    headers = {}
+    if len(notes) == limit and notes and "created_at" in notes[-1]:
+        headers["X-Next-Cursor"] = db.encode_cursor(notes[-1])
+    return ORJSONResponse(notes, headers=headers)
 
 
 @router.get("/notes/{note_id}/versions")
-def list_versions(note_id: int, limit: int = 20):
+def list_versions(note_id: int, response: Response, limit: int = 20, if_none_match: Optional[str] = Header(None)):
+    try:
+        latest = cache.get_latest_version(note_id)
+    except Exception:
+        latest = None
     try:
-        versions = get_versions(note_id, limit=limit)
-        return versions
+        if latest is None:
+            latest = mongo_versions.get_latest_version(note_id)
+            if latest:
+                _remember_version({"note_id": note_id, "version": latest})
+        etag = etags.versions_etag(note_id, latest, limit)
+        if etags.etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=etags.cache_headers(etag))
+        versions = mongo_versions.get_versions(note_id, limit=limit)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to fetch versions: {exc}")
+    response.headers.update(etags.cache_headers(etag))
+    return versions
 
 
 @router.post("/notes/{note_id}/restore", response_model=NoteOut)
-def restore_note(note_id: int, payload: NoteRestore):
+def restore_note(note_id: int, payload: NoteRestore, idempotency_key: Optional[str] = IDEMPOTENCY_HEADER):
+    return idempotency.run(
+        idempotency_key, f"restore:{note_id}", payload.model_dump(), lambda: _restore_note(note_id, payload)
+    )
+
+
+def _restore_note(note_id: int, payload: NoteRestore):
     try:
-        version_doc = get_version(note_id, payload.version)
+        version_doc = mongo_versions.get_version(note_id, payload.version)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to read version: {exc}")
     if not version_doc:
         raise HTTPException(status_code=404, detail="Version not found")
 
     try:
-        restored = db.update_note(
+        restored, previous_tags = db.update_note_with_previous_tags(
             note_id,
             version_doc.get("title"),
             version_doc.get("content"),
@@ -147,100 +406,287 @@ def restore_note(note_id: int, payload: NoteRestore):
         raise HTTPException(status_code=500, detail=f"Failed to restore note: {exc}")
     if not restored:
         raise HTTPException(status_code=404, detail="Note not found")
+    if coalesce.enabled():
+        coalesce.discard([note_id])  # восстановление синхронизируется сразу и целиком
 
+    # восстановление уже в Postgres: повтор после 500 записал бы ещё одну версию — только логируем
     try:
-        save_version(restored)
+        _remember_version(mongo_versions.save_version(restored))
     except Exception as exc:
-        raise HTTPException(
-            status_code=500, detail=f"Note restored, but failed to save new version: {exc}"
-        )
+        print(f"[mongo] failed to save version of note {note_id}: {exc}")
     try:
         cache.cache_note(restored)
     except Exception:
         pass
-    qdrant_vectors.upsert_note_vector(restored)
+    try:
+        qdrant_vectors.upsert_note_vector(restored)
+    except Exception as exc:
+        print(f"[qdrant] failed to upsert note {note_id}: {exc}")
     try:
         graph.upsert_note_with_tags(restored)
     except Exception:
         pass
+    _sync_tag_counts(previous_tags, restored.get("tags"))
     _safe_publish("note_updated", restored)
     return restored
 
 
 @router.get("/notes/{note_id}/similar")
-def similar_notes(note_id: int, limit: int = 5):
+def similar_notes(
+    note_id: int,
+    limit: int = 5,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: str = VIEW_QUERY,
+    tags: Optional[str] = TAGS_QUERY,
+    tags_mode: str = TAGS_MODE_QUERY,
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+):
+    projection = _parse_fields(fields, view)
+    tag_list = _parse_tags(tags)
+    # исходная заметка обычно уже в Redis (вместе с ней читаем эпоху векторов); Postgres — только при промахе
     try:
-        note = db.fetch_note(note_id)
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch note: {exc}")
+        note, epoch = cache.get_cached_note_and_epoch(note_id)
+    except Exception:
+        note, epoch = None, None
+    if note is None:
+        try:
+            note = db.fetch_note(note_id)
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Failed to fetch note: {exc}")
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
+
+    key = None
+    if epoch is not None:
+        params = repr((limit, projection, tag_list, tags_mode, updated_from, updated_to))
+        key = cache.similar_key(epoch, note, params)
+        try:
+            cached = cache.get_cached_similar(key)
+        except Exception:
+            cached = None
+        if cached:
+            return Response(content=cached, media_type="application/json")
+
     try:
-        raw = qdrant_vectors.search_similar(note, limit=limit + 1)  # +1, чтобы можно было потом отфильтровать саму заметку
-        filtered = []
-        for r in raw:
-            rid = r.get("note_id")
-            if rid is None:
-                continue
-            # пропускаем саму заметку, если она попала в выдачу
-            if rid == note_id:
-                continue
-            # пробуем подтянуть детали заметки
-            details = db.fetch_note(int(rid))
-            if not details:
-                continue
-            filtered.append({"score": r.get("score"), "note": details})
-            if len(filtered) == limit:
-                break
-        return {"source": note, "similar": filtered}
+        # саму заметку Qdrant из выдачи уже исключил
+        raw = qdrant_vectors.search_similar(
+            note,
+            limit=limit,
+            tags=tag_list,
+            tags_mode=tags_mode,
+            updated_from=updated_from,
+            updated_to=updated_to,
+        )
+        hits = [r for r in raw if r.get("note_id") is not None]
+        result = {"source": db.project_note(note, projection), "similar": _hydrate_hits(hits, projection, limit)}
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to search similar: {exc}")
+    response = ORJSONResponse(result)
+    if key is not None:
+        try:
+            cache.cache_similar(key, response.body)
+        except Exception:
+            pass
+    return response
+
+
+def _hydrate_hits(hits, projection, limit: int):
+    # детали подтягиваем одним запросом, только нужные поля
+    details = db.fetch_notes_by_ids([int(r["note_id"]) for r in hits], fields=projection)
+    by_id = {d["id"]: d for d in details}
+    result = []
+    for r in hits:
+        found = by_id.get(int(r["note_id"]))
+        if not found:
+            continue
+        result.append({"score": r.get("score"), "note": found})
+        if len(result) == limit:
+            break
+    return result
+
+
+@router.get("/notes/{note_id}/related")
+def related_notes(
+    note_id: int,
+    limit: int = 10,
+    method: str = Query("adamic_adar", pattern="^(adamic_adar|jaccard)$"),
+    per_tag: int = Query(200, ge=1, le=5000),
+    fields: Optional[str] = FIELDS_QUERY,
+    view: str = VIEW_QUERY,
+):
+    projection = _parse_fields(fields, view)
+    try:
+        ranked = graph.related_notes(note_id, limit=limit, per_tag=per_tag, method=method)
+        details = db.fetch_notes_by_ids([r["note_id"] for r in ranked], fields=projection)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch related notes: {exc}")
+    by_id = {d["id"]: d for d in details}
+    return [
+        {
+            "score": r[method],
+            "jaccard": r["jaccard"],
+            "adamic_adar": r["adamic_adar"],
+            "shared_tags": r["shared_tags"],
+            "note": by_id[r["note_id"]],
+        }
+        for r in ranked
+        if r["note_id"] in by_id
+    ]
+
+
+@router.get("/tags/{tag}/related")
+def related_tags(tag: str, limit: int = 10):
+    try:
+        return graph.related_tags(tag, limit=limit)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch related tags: {exc}")
+
+
+@router.get("/search")
+def hybrid_search(
+    q: str = Query(..., min_length=1, description="Search query"),
+    mode: str = Query("hybrid", pattern="^(hybrid|text|vector)$"),
+    limit: int = Query(20, ge=1, le=200),
+    tags: Optional[str] = TAGS_QUERY,
+    tags_mode: str = TAGS_MODE_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: str = VIEW_QUERY,
+    text_limit: int = Query(search.TEXT_LIMIT, ge=1, le=1000, description="Candidates from the full-text branch"),
+    vector_limit: int = Query(search.VECTOR_LIMIT, ge=1, le=1000, description="Candidates from the vector branch"),
+):
+    projection = _parse_fields(fields, view)
+    try:
+        return search.search(
+            q,
+            mode=mode,
+            limit=limit,
+            tags=_parse_tags(tags),
+            tags_mode=tags_mode,
+            fields=projection,
+            text_limit=text_limit,
+            vector_limit=vector_limit,
+        )
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to search: {exc}")
+
+
+@router.get("/search/semantic")
+def semantic_search(
+    q: str = Query(..., min_length=1, description="Search query"),
+    limit: int = Query(10, ge=1, le=200),
+    tags: Optional[str] = TAGS_QUERY,
+    tags_mode: str = TAGS_MODE_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: str = VIEW_QUERY,
+    updated_from: Optional[datetime] = None,
+    updated_to: Optional[datetime] = None,
+):
+    projection = _parse_fields(fields, view)
+    try:
+        hits = qdrant_vectors.search_text(
+            q,
+            limit=limit,
+            tags=_parse_tags(tags),
+            tags_mode=tags_mode,
+            updated_from=updated_from,
+            updated_to=updated_to,
+        )
+        return _hydrate_hits(hits, projection, limit)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Failed to search: {exc}")
 
 
 @router.get("/graph/tags/{tag}")
-def notes_by_tag(tag: str, limit: int = 20):
+def notes_by_tag(tag: str, limit: int = 20, fields: Optional[str] = FIELDS_QUERY, view: str = VIEW_QUERY):
+    projection = _parse_fields(fields, view)
+    # один запрос по GIN-индексу на tags вместо обхода Neo4j и догрузки из Postgres
     try:
-        note_ids = graph.get_notes_by_tag(tag, limit=limit)
+        return db.search_notes(None, limit=limit, fields=projection, tags=[tag], tags_mode="all")
     except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to query graph: {exc}")
-    result = []
-    for nid in note_ids:
-        note = db.fetch_note(int(nid))
-        if note:
-            result.append(note)
-    return result
+        raise HTTPException(status_code=500, detail=f"Failed to fetch notes: {exc}")
 
 
 @router.get("/tags")
-def list_tags(limit: int = 100):
+def list_tags(
+    limit: int = 100,
+    with_counts: bool = False,
+    prefix: Optional[str] = Query(None, description="Autocomplete: tags starting with this prefix"),
+    sort: str = Query("name", pattern="^(name|count)$"),
+):
     try:
-        tags = graph.list_tags(limit=limit)
-        return tags
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to list tags: {exc}")
+        ready = cache.tag_index_ready()
+        if not ready and cache.acquire_tag_rebuild_lock(TAGS_COLD_REBUILD_LOCK_TTL):
+            rebuild_tag_index()
+            ready = True
+        if ready:
+            items = cache.get_tags(limit=limit, prefix=prefix, sort=sort)
+        else:
+            items = cache.select_tags(_fallback_tag_counts().items(), limit=limit, prefix=prefix, sort=sort)
+    except Exception:
+        # без Redis — как раньше, прямо из графа (только имена)
+        if prefix or sort != "name" or with_counts:
+            raise HTTPException(status_code=503, detail="Tag index is unavailable")
+        try:
+            return graph.list_tags(limit=limit)
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Failed to list tags: {exc}")
+    if with_counts:
+        return [{"tag": name, "count": count} for name, count in items]
+    return [name for name, _ in items]
+
+
+@router.get("/events/stream")
+async def events_stream(
+    tags: Optional[str] = TAGS_QUERY,
+    ids: Optional[str] = Query(None, description="Comma-separated note ids"),
+    actions: Optional[str] = Query(None, description="Comma-separated: note_created,note_updated,note_deleted"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    since: Optional[str] = Query(None, description="Event id to resume after (when Last-Event-ID can't be sent)"),
+):
+    """Лента изменений (Server-Sent Events) вместо опроса; см. api/events.py."""
+    try:
+        note_ids = [int(i) for i in ids.split(",") if i.strip()] if ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    try:
+        frames = events.open_stream(
+            tags=_parse_tags(tags),
+            ids=note_ids,
+            actions=_parse_tags(actions),
+            last_event_id=last_event_id or since,
+        )
+    except OverflowError as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "5"})
+    return StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.delete("/notes/{note_id}")
 def delete_note(note_id: int):
     # сначала попробуем удалить из Postgres
     try:
-        deleted = db.delete_note(note_id)
+        deleted_tags = db.delete_note_returning_tags(note_id)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to delete note: {exc}")
-    if not deleted:
+    if deleted_tags is None:
         raise HTTPException(status_code=404, detail="Note not found")
+    _sync_tag_counts(deleted_tags, None)
+    if coalesce.enabled():
+        coalesce.discard([note_id])
 
     # чистим версии в Mongo (не обязательно, но полезно)
     try:
-        delete_versions(note_id)
+        mongo_versions.delete_versions(note_id)
     except Exception:
         pass
 
-    # чистим кэш
+    # чистим кэш (заметка, ETag, номер последней версии)
     try:
-        cache_key = f"note:{note_id}"
-        client = cache.get_client()
-        client.delete(cache_key)
+        cache.invalidate_note(note_id)
     except Exception:
         pass
 
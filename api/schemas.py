@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from pydantic import BaseModel, Field
 
@@ -20,6 +20,10 @@ class NoteRestore(BaseModel):
     version: int = Field(..., ge=1)
 
 
+class NoteBatchGet(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=500)
+
+
 class NoteOut(BaseModel):
     id: int
     title: str
@@ -27,3 +31,30 @@ class NoteOut(BaseModel):
     tags: List[str]
     created_at: datetime
     updated_at: datetime
+
+
+class NotePartialOut(BaseModel):
+    """Заметка с проекцией полей (fields= / view=summary): присутствуют только запрошенные поля."""
+
+    id: int
+    title: Optional[str] = None
+    content: Optional[str] = None
+    preview: Optional[str] = None
+    tags: Optional[List[str]] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
+class ProfileStart(BaseModel):
+    """Сессия профилирования: cprofile — запросы маршрута, sample — стеки всего процесса."""
+
+    mode: Literal["cprofile", "sample"] = "sample"
+    seconds: float = Field(30, gt=0, le=3600)
+    requests: Optional[int] = Field(None, ge=1, le=100000, description="cprofile: stop after N captured requests")
+    route: Optional[str] = Field(None, description="cprofile: route template, e.g. /notes/{note_id}; empty — all")
+    method: Optional[str] = Field(None, description="cprofile: HTTP method filter")
+    interval_ms: float = Field(5, ge=1, le=1000, description="sample: sampling interval")
+
+
+class SlowLogConfig(BaseModel):
+    threshold_ms: float = Field(..., ge=0)
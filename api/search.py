@@ -0,0 +1,107 @@
+"""
+Гибридный поиск: полнотекстовый ранг Postgres + близость векторов в Qdrant,
+слитые через reciprocal rank fusion (RRF).
+
+Обе ветки запускаются параллельно, у каждой свой лимит кандидатов и таймаут.
+Если ветка упала или не уложилась в таймаут, выдача строится по оставшейся,
+а имя ветки попадает в degraded — клиент видит, что результат неполный.
+"""
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from . import db, qdrant_vectors
+
+RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+TEXT_LIMIT = int(os.getenv("SEARCH_TEXT_LIMIT", "50"))
+VECTOR_LIMIT = int(os.getenv("SEARCH_VECTOR_LIMIT", "50"))
+TEXT_TIMEOUT = float(os.getenv("SEARCH_TEXT_TIMEOUT", "1.0"))  # секунд
+VECTOR_TIMEOUT = float(os.getenv("SEARCH_VECTOR_TIMEOUT", "1.0"))
+
+# Общий пул на процесс: ветки не создают потоки на каждый запрос. Зависшая ветка
+# освобождает поток сама (statement_timeout в Postgres, timeout клиента Qdrant).
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_WORKERS", "16")), thread_name_prefix="search")
+
+
+def _text_branch(q: str, limit: int, tags: Optional[Sequence[str]], tags_mode: str, timeout: float) -> List[int]:
+    return [nid for nid, _ in db.rank_notes(q, limit, tags, tags_mode, timeout_ms=int(timeout * 1000))]
+
+
+def _vector_branch(q: str, limit: int, tags: Optional[Sequence[str]], tags_mode: str) -> List[int]:
+    hits = qdrant_vectors.search_text(q, limit, list(tags) if tags else None, tags_mode)
+    return [int(h["note_id"]) for h in hits]
+
+
+def rrf(rankings: Dict[str, List[int]], k: int = RRF_K) -> List[Tuple[int, float, Dict[str, int]]]:
+    """(id, score, {ветка: позиция с 1}) по убыванию score = sum 1 / (k + rank)."""
+    scores: Dict[int, float] = {}
+    ranks: Dict[int, Dict[str, int]] = {}
+    for branch, ids in rankings.items():
+        for rank, nid in enumerate(ids, start=1):
+            scores[nid] = scores.get(nid, 0.0) + 1.0 / (k + rank)
+            ranks.setdefault(nid, {})[branch] = rank
+    ordered = sorted(scores, key=lambda nid: (-scores[nid], -nid))
+    return [(nid, scores[nid], ranks[nid]) for nid in ordered]
+
+
+def search(
+    q: str,
+    mode: str = "hybrid",
+    limit: int = 20,
+    tags: Optional[Sequence[str]] = None,
+    tags_mode: str = "any",
+    fields: Optional[Sequence[str]] = None,
+    text_limit: int = TEXT_LIMIT,
+    vector_limit: int = VECTOR_LIMIT,
+    text_timeout: float = TEXT_TIMEOUT,
+    vector_timeout: float = VECTOR_TIMEOUT,
+) -> Dict[str, Any]:
+    started = time.monotonic()
+    futures = {}
+    # потоки пула не наследуют contextvars запроса (арендатор, окно чтения с primary) — передаём явно
+    if mode in ("hybrid", "text"):
+        futures["text"] = (
+            _pool.submit(contextvars.copy_context().run, _text_branch, q, text_limit, tags, tags_mode, text_timeout),
+            text_timeout,
+        )
+    if mode in ("hybrid", "vector"):
+        futures["vector"] = (
+            _pool.submit(contextvars.copy_context().run, _vector_branch, q, vector_limit, tags, tags_mode),
+            vector_timeout,
+        )
+
+    rankings: Dict[str, List[int]] = {}
+    degraded: List[str] = []
+    errors: Dict[str, str] = {}
+    for branch, (future, timeout) in futures.items():
+        try:
+            # таймаут отсчитывается от старта запроса, а не от конца ожидания предыдущей ветки
+            rankings[branch] = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
+        except FutureTimeout:
+            future.cancel()
+            degraded.append(branch)
+            errors[branch] = "timeout"
+        except Exception as exc:
+            degraded.append(branch)
+            errors[branch] = str(exc)
+    if not rankings:
+        raise RuntimeError("; ".join(f"{b}: {e}" for b, e in errors.items()))
+
+    fused = rrf(rankings)
+    # берём с запасом: кандидаты из Qdrant могут уже отсутствовать в Postgres
+    candidates = fused[: limit * 2]
+    details = db.fetch_notes_by_ids([nid for nid, _, _ in candidates], fields=fields)
+    by_id = {d["id"]: d for d in details}
+    results = []
+    for nid, score, ranks in candidates:
+        note = by_id.get(nid)
+        if note is None:
+            continue
+        results.append(
+            {"score": score, "text_rank": ranks.get("text"), "vector_rank": ranks.get("vector"), "note": note}
+        )
+        if len(results) == limit:
+            break
+    return {"mode": mode, "degraded": degraded, "results": results}
@@ -0,0 +1,114 @@
+"""
+Арендаторы (tenants): один процесс обслуживает несколько наборов заметок.
+
+Арендатор определяется на каждый запрос — заголовком X-Tenant (TENANT_HEADER) или
+префиксом пути /t/<tenant>/... — и по умолчанию равен STUDENT_NAME, как раньше.
+Имена таблицы, коллекций, очереди и префиксы ключей вычисляются один раз на арендатора
+и кэшируются; соединения и клиенты хранилищ общие для всех арендаторов.
+Для арендатора по умолчанию имена совпадают с прежними, поэтому данные не переезжают.
+"""
+import contextvars
+import os
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant").lower().encode("latin-1")
+PATH_PREFIX = "/t/"
+TENANT_RE = re.compile(r"^[a-z0-9_]{1,40}$")
+
+_current: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("tenant", default=None)
+
+
+def sanitize_suffix(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def default_name() -> str:
+    return os.getenv("STUDENT_NAME", "").strip()
+
+
+def allowed() -> List[str]:
+    """
+    Арендаторы из TENANTS. Пустой список — только арендатор по умолчанию: каждый новый арендатор
+    создаёт таблицы, коллекции и индексы, поэтому их заводят явно, а не по заголовку запроса.
+    """
+    return [t.strip().lower() for t in os.getenv("TENANTS", "").split(",") if t.strip()]
+
+
+def validate(name: str) -> str:
+    name = name.strip().lower()
+    default = default_name()
+    if name == default.lower():
+        return default  # STUDENT_NAME может не проходить TENANT_RE (ivan-ov)
+    if not TENANT_RE.match(name):
+        raise ValueError(f"Invalid tenant: {name!r}")
+    # имя, дающее ту же таблицу, что у арендатора по умолчанию, делило бы с ним Postgres,
+    # но не Redis и Neo4j (STUDENT_NAME=ivan-ov и арендатор ivan_ov)
+    if sanitize_suffix(name) == sanitize_suffix(default.lower()):
+        raise ValueError(f"Tenant {name!r} collides with the default tenant")
+    if name not in allowed():
+        raise LookupError(f"Unknown tenant: {name}")
+    return name
+
+
+@lru_cache(maxsize=1024)
+def resources(name: str) -> Dict[str, Any]:
+    """Имена ресурсов арендатора; для арендатора по умолчанию учитываются прежние переопределения из .env."""
+    is_default = name == default_name()
+    suffix = sanitize_suffix(name.lower())
+    return {
+        "name": name,
+        "table": f"notes_{suffix}" if name else "notes",
+        "mongo_collection": f"note_versions_{suffix}" if name else "note_versions",
+        "qdrant_collection": (os.getenv("QDRANT_COLLECTION") if is_default else None)
+        or (f"notes_vectors_{suffix}" if name else "notes_vectors"),
+        "queue": (os.getenv("RABBITMQ_QUEUE") if is_default else None)
+        or (f"notes_tasks_{name.lower()}" if name else "notes_tasks"),
+        # ключи Redis арендатора по умолчанию остаются без префикса
+        "redis_prefix": "" if is_default else f"t:{suffix}:",
+        # метки узлов Neo4j: Note/Tag для арендатора по умолчанию, Note_<t>/Tag_<t> для остальных
+        "neo4j_suffix": "" if is_default else f"_{suffix}",
+        "is_default": is_default,
+    }
+
+
+def current() -> Dict[str, Any]:
+    res = _current.get()
+    if res is None:
+        return resources(default_name())
+    return res
+
+
+def use(name: str) -> contextvars.Token:
+    return _current.set(resources(name))
+
+
+def reset(token: contextvars.Token) -> None:
+    _current.reset(token)
+
+
+def known() -> List[str]:
+    """Арендаторы для фоновых задач: по умолчанию и перечисленные в TENANTS."""
+    names = [default_name()]
+    default_suffix = sanitize_suffix(default_name().lower())
+    names.extend(t for t in allowed() if sanitize_suffix(t) != default_suffix)
+    return names
+
+
+def resolve(scope: Dict[str, Any]) -> Optional[str]:
+    """
+    Имя арендатора из запроса (или None — арендатор по умолчанию). Префикс /t/<tenant>
+    срезается с пути, чтобы дальше работали обычные маршруты.
+    """
+    path = scope.get("path", "")
+    if path.startswith(PATH_PREFIX):
+        name, _, rest = path[len(PATH_PREFIX):].partition("/")
+        scope["path"] = "/" + rest
+        if scope.get("raw_path"):
+            scope["raw_path"] = scope["path"].encode("utf-8")
+        return name
+    for key, value in scope.get("headers") or []:
+        if key == TENANT_HEADER:
+            return value.decode("latin-1")
+    return None
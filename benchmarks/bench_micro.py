@@ -0,0 +1,119 @@
+"""
+Микробенчмарки горячих функций без сети: эмбеддинг, сериализация, кодирование кэша (JSON и packed),
+кэш и векторный поиск на встроенных хранилищах (CACHE_BACKEND=memory, VECTORS_BACKEND=numpy).
+
+    python benchmarks/bench_micro.py --iterations 5000 --vectors 20000 --out micro.json
+
+Результат — процессорное время на вызов (мкс); --out сохраняет JSON для benchmarks/compare.py.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# встроенные хранилища выбираются при импорте модулей api — окружение задаём до импорта
+os.environ.setdefault("CACHE_BACKEND", "memory")
+os.environ.setdefault("VECTORS_BACKEND", "numpy")
+os.environ.setdefault("LOCAL_DATA_DIR", tempfile.mkdtemp(prefix="notes-bench-"))
+os.environ["VECTORS_DIR"] = ""
+
+import orjson  # noqa: E402
+
+from api import cache, cache_codec, qdrant_vectors  # noqa: E402
+from api.responses import ORJSONResponse  # noqa: E402
+from common import run_meta, write_results  # noqa: E402
+
+WORDS = (
+    "python postgres redis mongo qdrant neo4j rabbitmq index query cache vector graph "
+    "note tag search latency throughput replica shard cursor version event worker"
+).split()
+
+
+def make_note(note_id: int, content_size: int, rng: random.Random) -> Dict[str, Any]:
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=note_id)
+    words: List[str] = []
+    while sum(len(w) + 1 for w in words) < content_size:
+        words.append(rng.choice(WORDS))
+    return {
+        "id": note_id,
+        "title": f"Заметка {note_id} {rng.choice(WORDS)}",
+        "content": " ".join(words)[:content_size],
+        "tags": rng.sample(WORDS[:12], 3),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def cpu_per_call(fn: Callable[[], Any], iterations: int) -> float:
+    """Среднее процессорное время на вызов, мкс."""
+    fn()  # прогрев
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--content-size", type=int, default=2000, help="длина content в символах")
+    parser.add_argument("--list-size", type=int, default=20, help="сколько заметок в ответе GET /notes")
+    parser.add_argument("--vectors", type=int, default=10000, help="размер векторного индекса для search_similar")
+    parser.add_argument("--vector-size", type=int, default=128)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда сохранить результаты (JSON)")
+    args = parser.parse_args()
+    os.environ["QDRANT_VECTOR_SIZE"] = str(args.vector_size)
+
+    rng = random.Random(args.seed)
+    note = make_note(1, args.content_size, rng)
+    rows = [make_note(i, args.content_size, rng) for i in range(args.list_size)]
+    encoded = cache.encode_note(note)
+    packed = cache_codec.pack(note)
+    text = qdrant_vectors.note_text(note)
+    query = " ".join(rng.sample(WORDS, 3))
+
+    corpus = [make_note(i, 200, rng) for i in range(1, args.vectors + 1)]
+    for start in range(0, len(corpus), 1000):
+        qdrant_vectors.upsert_note_vectors(corpus[start : start + 1000])
+    cache.cache_note(note)
+
+    benches: Dict[str, Callable[[], Any]] = {
+        "embed_text": lambda: qdrant_vectors.embed_text(text, args.vector_size),
+        "embed_query (cached)": lambda: qdrant_vectors.embed_query(query, args.vector_size),
+        "cache encode_note": lambda: cache.encode_note(note),
+        "cache decode (orjson.loads)": lambda: orjson.loads(encoded),
+        "cache_codec pack": lambda: cache_codec.pack(note),
+        "cache_codec unpack": lambda: cache_codec.unpack(packed),
+        "cache_codec to_json": lambda: cache_codec.to_json(packed),
+        f"render GET /notes ({args.list_size} rows)": lambda: ORJSONResponse(rows).body,
+        "memory cache_note": lambda: cache.cache_note(note),
+        "memory get_cached_note_with_etag": lambda: cache.get_cached_note_with_etag(1),
+        f"numpy search_similar ({args.vectors} vectors)": lambda: qdrant_vectors.search_similar(
+            corpus[rng.randrange(len(corpus))], limit=10
+        ),
+        f"numpy search_text ({args.vectors} vectors)": lambda: qdrant_vectors.search_text(query, limit=10),
+    }
+
+    print(f"iterations={args.iterations} content_size={args.content_size} vectors={args.vectors}")
+    results: Dict[str, Any] = {}
+    for name, fn in benches.items():
+        # векторный поиск на порядки дороже остального — ему хватает меньшего числа итераций
+        iterations = max(args.iterations // 20, 10) if "search" in name else args.iterations
+        us = cpu_per_call(fn, iterations)
+        results[name] = {"cpu_us": round(us, 3), "iterations": iterations}
+        print(f"{name:<44} {us:11.1f} us")
+    results["cache encoded bytes"] = {"bytes": len(encoded)}
+    results["cache packed bytes"] = {"bytes": len(packed)}
+    write_results(args.out, run_meta("micro", args), results)
+
+
+if __name__ == "__main__":
+    main()
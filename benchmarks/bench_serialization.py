@@ -0,0 +1,98 @@
+"""
+Сравнение CPU на сериализацию ответа для GET /notes/{id} и GET /notes:
+старый путь (json -> NoteOut -> jsonable_encoder -> json.dumps) против
+orjson и ответа из записи кэша в текущем формате (CACHE_NOTE_FORMAT: json отдаётся как есть,
+packed собирается в JSON на каждом попадании).
+
+    python benchmarks/bench_serialization.py --iterations 20000 --content-size 4000
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api import cache_codec  # noqa: E402
+from api.cache import NOTE_FORMAT, encode_cached_note  # noqa: E402
+from api.responses import ORJSONResponse  # noqa: E402
+from api.schemas import NoteOut  # noqa: E402
+
+
+def make_note(note_id: int, content_size: int) -> Dict[str, Any]:
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=note_id)
+    return {
+        "id": note_id,
+        "title": f"Заметка {note_id}",
+        "content": ("lorem ipsum dolor sit amet " * (content_size // 27 + 1))[:content_size],
+        "tags": ["study", "demo", f"tag{note_id % 7}"],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def stdlib_render(content: Any) -> bytes:
+    # то же, что делает starlette.responses.JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def cpu_per_call(fn: Callable[[], Any], iterations: int) -> float:
+    """Среднее процессорное время на вызов, мкс."""
+    fn()  # прогрев
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def report(name: str, before: float, after: float) -> None:
+    saved = before - after
+    ratio = before / after if after else float("inf")
+    print(f"{name:<32} before {before:9.1f} us   after {after:9.1f} us   saved {saved:9.1f} us ({ratio:.1f}x)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--content-size", type=int, default=2000, help="длина content в символах")
+    parser.add_argument("--list-size", type=int, default=20, help="сколько заметок в ответе GET /notes")
+    args = parser.parse_args()
+
+    note = make_note(1, args.content_size)
+    cached_old = json.dumps(note, default=str)  # прежний формат кэша
+    cached_new = encode_cached_note(note)  # текущий формат кэша (CACHE_NOTE_FORMAT)
+    rows: List[Dict[str, Any]] = [make_note(i, args.content_size) for i in range(args.list_size)]
+    list_adapter = TypeAdapter(List[NoteOut])
+
+    def get_note_before() -> bytes:
+        model = NoteOut.model_validate(json.loads(cached_old))
+        return stdlib_render(jsonable_encoder(model))
+
+    def get_note_after() -> bytes:
+        # тот же путь, что у GET /notes/{id}: cache.get_cached_note_with_etag -> to_json -> Response
+        return Response(content=cache_codec.to_json(cached_new), media_type="application/json").body
+
+    def list_before() -> bytes:
+        models = list_adapter.validate_python(rows)
+        return stdlib_render(jsonable_encoder(models))
+
+    def list_after() -> bytes:
+        return ORJSONResponse(rows).body
+
+    print(f"iterations={args.iterations} content_size={args.content_size} list_size={args.list_size} cache_format={NOTE_FORMAT}")
+    report("GET /notes/{id} (cache hit)", cpu_per_call(get_note_before, args.iterations), cpu_per_call(get_note_after, args.iterations))
+    report(f"GET /notes ({args.list_size} rows)", cpu_per_call(list_before, args.iterations), cpu_per_call(list_after, args.iterations))
+    print(f"encode_note vs json.dumps:        {cpu_per_call(lambda: json.dumps(note, default=str), args.iterations):9.1f} us   "
+          f"{cpu_per_call(lambda: orjson.dumps(note, default=str), args.iterations):9.1f} us")
+
+
+if __name__ == "__main__":
+    main()
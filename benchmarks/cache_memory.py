@@ -0,0 +1,166 @@
+"""
+Сколько памяти занимает заметка в кэше в разных форматах записи (api/cache_codec.py).
+
+    python benchmarks/cache_memory.py --count 2000 --content-sizes 200,2000,20000
+    python benchmarks/cache_memory.py --from-db 5000 --redis --out mem.json
+
+Форматы: прежний json.dumps(default=str), JSON через orjson (CACHE_NOTE_FORMAT=json), packed без сжатия,
+packed со сжатием content от каждого порога из --thresholds, раскладка hash (поля m, p, c).
+Для каждого — средний размер записи и CPU на превращение записи в ответ GET /notes/{id} (мкс).
+--from-db N берёт первые N заметок из настроенного хранилища заметок (Postgres или SQLite) —
+сжатие сильно зависит от текста, синтетика из повторяющихся слов сжимается лучше настоящих заметок.
+--redis дополнительно пишет записи во временные ключи и суммирует MEMORY USAGE (с накладными
+расходами Redis на ключ), после замера ключи удаляются.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api import cache, cache_codec  # noqa: E402
+from common import run_meta, write_results  # noqa: E402
+
+WORDS = (
+    "заметка конспект лекция задача решение индекс запрос кэш вектор граф очередь версия "
+    "python postgres redis mongo qdrant neo4j rabbitmq latency throughput replica shard cursor"
+).split()
+KEY_PREFIX = "bench:cache_memory"
+
+
+def make_note(note_id: int, content_size: int, rng: random.Random) -> Dict[str, Any]:
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=note_id, microseconds=rng.randrange(10**6))
+    words: List[str] = []
+    while sum(len(w) + 1 for w in words) < content_size:
+        words.append(rng.choice(WORDS))
+    return {
+        "id": note_id,
+        "title": f"Заметка {note_id} {rng.choice(WORDS)}",
+        "content": " ".join(words)[:content_size],
+        "tags": rng.sample(WORDS[:12], 3),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def load_notes(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    if args.from_db:
+        from api import db
+
+        rows = db.iter_notes()
+        try:
+            return [note for _, note in zip(range(args.from_db), rows)]
+        finally:
+            rows.close()
+    rng = random.Random(args.seed)
+    sizes = [int(s) for s in args.content_sizes.split(",")]
+    return [make_note(i, sizes[i % len(sizes)], rng) for i in range(1, args.count + 1)]
+
+
+def packed(threshold: float) -> Callable[[Dict[str, Any]], bytes]:
+    def encode(note: Dict[str, Any]) -> bytes:
+        saved = cache_codec.COMPRESS_MIN_BYTES
+        cache_codec.COMPRESS_MIN_BYTES = threshold
+        try:
+            return cache_codec.pack(note)
+        finally:
+            cache_codec.COMPRESS_MIN_BYTES = saved
+
+    return encode
+
+
+def redis_usage(client, name: str, entries: List[Any]) -> int:
+    """Суммарный MEMORY USAGE записей одного формата; ключи удаляются сразу после замера."""
+    keys = [f"{KEY_PREFIX}:{name}:{i}" for i in range(len(entries))]
+    total = 0
+    for start in range(0, len(keys), 1000):
+        chunk = list(zip(keys[start : start + 1000], entries[start : start + 1000]))
+        pipe = client.pipeline(transaction=False)
+        for key, entry in chunk:
+            if isinstance(entry, dict):
+                pipe.hset(key, mapping=entry)
+            else:
+                pipe.set(key, entry)
+        for key, _ in chunk:
+            pipe.memory_usage(key, samples=0)
+        pipe.delete(*[key for key, _ in chunk])
+        replies = pipe.execute()
+        total += sum(int(n or 0) for n in replies[len(chunk) : 2 * len(chunk)])
+    return total
+
+
+def cpu_per_entry(fn: Callable[[Any], Any], entries: List[Any], rounds: int) -> float:
+    """Среднее процессорное время на запись, мкс."""
+    start = time.process_time()
+    for _ in range(rounds):
+        for entry in entries:
+            fn(entry)
+    return (time.process_time() - start) / (rounds * len(entries)) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000, help="сколько синтетических заметок")
+    parser.add_argument("--content-sizes", default="200,2000,20000", help="длины content по кругу, символов")
+    parser.add_argument("--from-db", type=int, default=0, metavar="N", help="взять N заметок из хранилища")
+    parser.add_argument("--thresholds", default="256,1024,4096", help="пороги сжатия content, байт")
+    parser.add_argument("--rounds", type=int, default=3, help="повторов при замере CPU")
+    parser.add_argument("--redis", action="store_true", help="замерить MEMORY USAGE в Redis (REDIS_HOST/...)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда сохранить результаты (JSON)")
+    args = parser.parse_args()
+
+    notes = load_notes(args)
+    if not notes:
+        raise SystemExit("no notes to measure")
+
+    encodings: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+        "json.dumps(default=str)": lambda note: json.dumps(note, default=str).encode("utf-8"),
+        "json (orjson)": cache.encode_note,
+        "packed": packed(float("inf")),
+    }
+    for threshold in args.thresholds.split(","):
+        encodings[f"packed+zlib >= {threshold}"] = packed(int(threshold))
+    encodings[f"hash m+p+c (zlib >= {cache_codec.COMPRESS_MIN_BYTES})"] = cache.note_fields
+
+    client = cache.get_client(decode_responses=False) if args.redis else None
+    print(f"notes={len(notes)} avg content={sum(len(n.get('content') or '') for n in notes) / len(notes):.0f} chars")
+    results: Dict[str, Any] = {}
+    baseline = None
+    for name, encode in encodings.items():
+        entries = [encode(note) for note in notes]
+        if name.startswith("hash"):
+            size = sum(len(v) for entry in entries for v in entry.values())
+            # ответ GET собирается из m + c; краткие чтения берут только m + p
+            to_response = lambda entry: cache_codec.to_json(entry["m"] + entry["c"])  # noqa: E731
+        elif name.startswith("json.dumps"):
+            size = sum(len(entry) for entry in entries)
+            to_response = lambda entry: entry  # noqa: E731
+        else:
+            size = sum(len(entry) for entry in entries)
+            to_response = cache_codec.to_json
+        row: Dict[str, Any] = {
+            "bytes": round(size / len(notes), 1),
+            "total_bytes": size,
+            "cpu_us": round(cpu_per_entry(to_response, entries, args.rounds), 3),
+        }
+        if baseline is None:
+            baseline = size
+        row["ratio"] = round(size / baseline, 3)
+        line = f"{name:<34} {row['bytes']:10.1f} B/note  x{row['ratio']:.3f}  to-response {row['cpu_us']:8.2f} us"
+        if client is not None:
+            usage = redis_usage(client, str(len(results)), entries)
+            row["redis_bytes"] = round(usage / len(notes), 1)
+            line += f"  redis {row['redis_bytes']:10.1f} B/note"
+        results[name] = row
+        print(line)
+    write_results(args.out, run_meta("cache_memory", args), results)
+
+
+if __name__ == "__main__":
+    main()
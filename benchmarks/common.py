@@ -0,0 +1,66 @@
+"""
+Общее для бенчмарков: перцентили, метаданные прогона и сохранение результатов в JSON,
+чтобы прогоны можно было сравнить через benchmarks/compare.py.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(sorted_values: Sequence[float], p: float) -> float:
+    """Перцентиль по уже отсортированной выборке (линейная интерполяция)."""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, float]:
+    values = sorted(latencies_ms)
+    return {
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3) if values else 0.0,
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_meta(kind: str, args: Any) -> Dict[str, Any]:
+    return {
+        "kind": kind,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k != "out"},
+    }
+
+
+def write_results(path: Optional[str], meta: Dict[str, Any], results: Dict[str, Any]) -> None:
+    if not path:
+        return
+    doc = {"meta": meta, "results": results}
+    Path(path).write_text(json.dumps(doc, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"results saved to {path}", file=sys.stderr)
+
@@ -0,0 +1,64 @@
+"""
+Сравнение двух прогонов bench_micro.py, cache_memory.py или loadgen.py (файлы из --out).
+
+    python benchmarks/compare.py base.json new.json --threshold 10
+
+Для задержек, CPU и размеров рост — регрессия, для rps — падение. С --threshold код выхода 1,
+если какая-то метрика ухудшилась больше чем на столько процентов.
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Tuple
+
+# метрика -> True, если больше — лучше
+METRICS = {"cpu_us": False, "bytes": False, "redis_bytes": False, "rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any]) -> List[Tuple[str, str, float, float, float, bool]]:
+    rows = []
+    for name, new_row in new["results"].items():
+        base_row = base["results"].get(name)
+        if not base_row:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in new_row or metric not in base_row or not base_row[metric]:
+                continue
+            before, after = float(base_row[metric]), float(new_row[metric])
+            change = (after - before) / before * 100
+            worse = change < 0 if higher_is_better else change > 0
+            rows.append((name, metric, before, after, change, worse))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, help="допустимое ухудшение, %%")
+    args = parser.parse_args()
+
+    base, new = load(args.base), load(args.new)
+    if base["meta"]["kind"] != new["meta"]["kind"]:
+        raise SystemExit(f"different benchmark kinds: {base['meta']['kind']} vs {new['meta']['kind']}")
+    print(f"base {base['meta'].get('git')} {base['meta']['started_at']}")
+    print(f"new  {new['meta'].get('git')} {new['meta']['started_at']}")
+
+    regressions = 0
+    for name, metric, before, after, change, worse in compare(base, new):
+        flag = ""
+        if args.threshold is not None and worse and abs(change) > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<44} {metric:<7} {before:12.2f} -> {after:12.2f}  {change:+7.1f}%{flag}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
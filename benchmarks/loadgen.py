@@ -0,0 +1,381 @@
+"""
+Нагрузочный генератор HTTP для горячих путей API.
+
+Операции смеси (--mix op=вес,...):
+    get_hit   GET /notes/{id} по заметке, которая уже в кэше
+    get_miss  GET /notes/{id} по заметке, которой ещё нет в кэше (каждый id — один раз)
+    create    POST /notes (запись в Postgres и раздача в Mongo/Qdrant/Neo4j/Redis/очередь)
+    list_q    GET /notes?q=...
+    search    GET /search?q=... (гибридный поиск)
+    similar   GET /notes/{id}/similar
+
+По умолчанию (--spawn) поднимает свой uvicorn с STORAGE_BACKEND=local во временном каталоге,
+так что прогон не требует ни сети, ни внешних сервисов:
+
+    python benchmarks/loadgen.py --duration 30 --concurrency 16 --out run.json
+    python benchmarks/loadgen.py --url http://127.0.0.1:8000 --mix get_hit=80,create=20
+
+Заметки для get_miss при --spawn записываются прямо в SQLite до старта сервера, поэтому в кэше их нет.
+С --url промахи берутся из --cold-range START:END — id, которые заведомо не в кэше.
+Клиент — потоки с keep-alive соединениями (только стандартная библиотека); при очень высоком RPS
+упор может быть в сам генератор, это видно по загрузке CPU его процесса.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import ROOT, latency_summary, run_meta, write_results  # noqa: E402
+
+DEFAULT_MIX = "get_hit=50,get_miss=10,create=10,list_q=15,search=5,similar=10"
+WORDS = (
+    "python postgres redis mongo qdrant neo4j rabbitmq index query cache vector graph "
+    "note tag search latency throughput replica shard cursor version event worker"
+).split()
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPS:
+            raise SystemExit(f"unknown operation {name!r}; known: {', '.join(OPS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def random_note(rng: random.Random, content_size: int) -> Dict[str, Any]:
+    words = [rng.choice(WORDS) for _ in range(max(content_size // 7, 1))]
+    return {
+        "title": " ".join(rng.sample(WORDS, 3)),
+        "content": " ".join(words)[:content_size],
+        "tags": rng.sample(WORDS[:12], 2),
+    }
+
+
+class Target:
+    """Общее состояние прогона: адрес, id прогретых заметок и очередь id для промахов кэша."""
+
+    def __init__(self, url: str, hot_ids: List[int], cold_ids: List[int], content_size: int):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.hot_ids = hot_ids
+        self.cold_ids = cold_ids
+        self.content_size = content_size
+        self.lock = threading.Lock()
+
+    def next_cold(self) -> Optional[int]:
+        with self.lock:
+            return self.cold_ids.pop() if self.cold_ids else None
+
+
+class Client:
+    def __init__(self, target: Target, seed: int):
+        self.target = target
+        self.rng = random.Random(seed)
+        self.conn = http.client.HTTPConnection(target.host, target.port, timeout=30)
+
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes]:
+        headers = {"Connection": "keep-alive"}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for attempt in (0, 1):
+            try:
+                self.conn.request(method, self.target.prefix + path, body=payload, headers=headers)
+                resp = self.conn.getresponse()
+                return resp.status, resp.read()
+            except (http.client.HTTPException, OSError):
+                # сервер закрыл keep-alive соединение — одна повторная попытка на новом
+                self.conn.close()
+                self.conn = http.client.HTTPConnection(self.target.host, self.target.port, timeout=30)
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    def hot_id(self) -> int:
+        return self.rng.choice(self.target.hot_ids)
+
+    def query(self) -> str:
+        return quote(" ".join(self.rng.sample(WORDS, 2)))
+
+
+def op_get_hit(c: Client) -> Optional[int]:
+    return c.request("GET", f"/notes/{c.hot_id()}")[0]
+
+
+def op_get_miss(c: Client) -> Optional[int]:
+    note_id = c.target.next_cold()
+    if note_id is None:
+        return None
+    return c.request("GET", f"/notes/{note_id}")[0]
+
+
+def op_create(c: Client) -> Optional[int]:
+    status, body = c.request("POST", "/notes", random_note(c.rng, c.target.content_size))
+    if status == 200:
+        note_id = json.loads(body)["id"]
+        with c.target.lock:
+            c.target.hot_ids.append(note_id)
+    return status
+
+
+def op_list_q(c: Client) -> Optional[int]:
+    return c.request("GET", f"/notes?q={c.query()}&limit=20")[0]
+
+
+def op_search(c: Client) -> Optional[int]:
+    return c.request("GET", f"/search?q={c.query()}&limit=20")[0]
+
+
+def op_similar(c: Client) -> Optional[int]:
+    return c.request("GET", f"/notes/{c.hot_id()}/similar?limit=10")[0]
+
+
+OPS: Dict[str, Callable[[Client], Optional[int]]] = {
+    "get_hit": op_get_hit,
+    "get_miss": op_get_miss,
+    "create": op_create,
+    "list_q": op_list_q,
+    "search": op_search,
+    "similar": op_similar,
+}
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.skipped: Dict[str, int] = defaultdict(int)
+
+    def add(self, op: str, status: Optional[int], latency_ms: float) -> None:
+        with self.lock:
+            if status is None:
+                self.skipped[op] += 1
+                return
+            self.statuses[op][str(status)] += 1
+            if 200 <= status < 400:
+                self.latencies[op].append(latency_ms)
+
+
+def worker(target: Target, mix: Dict[str, float], seed: int, deadline: float, warmup_until: float, rec: Recorder) -> None:
+    client = Client(target, seed)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        op = client.rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            status = OPS[op](client)
+        except (http.client.HTTPException, OSError):
+            status = 599
+        latency_ms = (time.perf_counter() - start) * 1000
+        if start >= warmup_until:
+            rec.add(op, status, latency_ms)
+    client.conn.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def local_env(data_dir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "STORAGE_BACKEND": "local",
+            "LOCAL_DATA_DIR": data_dir,
+            "VECTORS_DIR": os.path.join(data_dir, "vectors"),
+            "TAGS_REBUILD_INTERVAL": env.get("TAGS_REBUILD_INTERVAL", "0"),
+        }
+    )
+    return env
+
+
+def seed_cold_notes(env: Dict[str, str], count: int, content_size: int, seed: int) -> List[int]:
+    """Записать заметки прямо в SQLite (отдельным процессом) — в кэш сервера они не попадут."""
+    if count <= 0:
+        return []
+    notes = [random_note(random.Random(seed + i), content_size) for i in range(count)]
+    code = (
+        "import json, sys\n"
+        "from api import db\n"
+        "db.ensure_table_exists()\n"
+        "ids = [db.insert_note(n['title'], n['content'], n['tags'])['id'] for n in json.load(sys.stdin)]\n"
+        "print(json.dumps(ids))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], input=json.dumps(notes), env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def spawn_server(env: Dict[str, str], port: int) -> subprocess.Popen:
+    # memory-бэкенды живут в процессе — один воркер
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", "1", "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT,
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("server did not become healthy in 30s")
+
+
+def seed_hot_notes(target: Target, count: int, seed: int) -> None:
+    """Прогреть: создать заметки через API (они попадают в кэш и во все хранилища) и прочитать их."""
+    client = Client(target, seed)
+    for _ in range(count):
+        op_create(client)
+    for note_id in list(target.hot_ids):
+        client.request("GET", f"/notes/{note_id}")
+    client.conn.close()
+
+
+def health(target: Target) -> Dict[str, Any]:
+    client = Client(target, 0)
+    try:
+        status, body = client.request("GET", "/health")
+        return json.loads(body) if status == 200 else {}
+    except (OSError, ValueError, http.client.HTTPException):
+        return {}
+    finally:
+        client.conn.close()
+
+
+def parse_cold_range(value: Optional[str]) -> List[int]:
+    if not value:
+        return []
+    start, _, end = value.partition(":")
+    return list(range(int(end) - 1, int(start) - 1, -1))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="адрес работающего API; без него поднимается локальный сервер (--spawn)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"веса операций (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="секунд измерения")
+    parser.add_argument("--warmup", type=float, default=2.0, help="секунд в начале, которые не учитываются")
+    parser.add_argument("--hot-notes", type=int, default=500, help="заметок, создаваемых и прогреваемых до прогона")
+    parser.add_argument("--cold-notes", type=int, default=5000, help="заметок для get_miss (только при локальном сервере)")
+    parser.add_argument("--cold-range", help="START:END — id не из кэша для get_miss при --url")
+    parser.add_argument("--content-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-data", action="store_true", help="не удалять каталог данных локального сервера")
+    parser.add_argument("--out", help="куда сохранить результаты (JSON)")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    proc = None
+    tmp = None
+    cold_ids = parse_cold_range(args.cold_range)
+    url = args.url
+    if not url:
+        tmp = tempfile.TemporaryDirectory(prefix="notes-loadgen-")
+        env = local_env(tmp.name)
+        if "get_miss" in mix:
+            cold_ids = seed_cold_notes(env, args.cold_notes, args.content_size, args.seed)[::-1]
+        port = free_port()
+        proc = spawn_server(env, port)
+        url = f"http://127.0.0.1:{port}"
+    elif "get_miss" in mix and not cold_ids:
+        print("get_miss needs --cold-range with --url; dropping it from the mix", file=sys.stderr)
+        mix.pop("get_miss")
+
+    try:
+        target = Target(url, [], cold_ids, args.content_size)
+        seed_hot_notes(target, args.hot_notes, args.seed)
+        if not target.hot_ids:
+            raise SystemExit("could not create any notes; is the API healthy?")
+        info = health(target)
+        rec = Recorder()
+        start = time.perf_counter()
+        warmup_until = start + args.warmup
+        deadline = warmup_until + args.duration
+        threads = [
+            threading.Thread(target=worker, args=(target, mix, args.seed * 1000 + i, deadline, warmup_until, rec), daemon=True)
+            for i in range(args.concurrency)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if tmp is not None:
+            if args.keep_data:
+                print(f"data kept in {tmp.name}", file=sys.stderr)
+            else:
+                tmp.cleanup()
+
+    results: Dict[str, Any] = {}
+    total_ok = 0
+    all_latencies: List[float] = []
+    print(f"{'operation':<10} {'ok':>8} {'errors':>7} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for op in mix:
+        lat = rec.latencies.get(op, [])
+        errors = sum(n for code, n in rec.statuses[op].items() if not 200 <= int(code) < 400)
+        row = {
+            "ok": len(lat),
+            "errors": errors,
+            "statuses": dict(rec.statuses[op]),
+            "skipped": rec.skipped.get(op, 0),
+            "rps": round(len(lat) / args.duration, 2),
+            **latency_summary(lat),
+        }
+        results[op] = row
+        total_ok += len(lat)
+        all_latencies.extend(lat)
+        print(
+            f"{op:<10} {row['ok']:>8} {errors:>7} {row['rps']:>9.1f} {row['p50_ms']:>9.2f} "
+            f"{row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}"
+        )
+        if row["skipped"]:
+            print(f"  {op}: {row['skipped']} skipped (no uncached ids left; raise --cold-notes)")
+    results["total"] = {"ok": total_ok, "rps": round(total_ok / args.duration, 2), **latency_summary(all_latencies)}
+    print(f"total: {total_ok} ok, {results['total']['rps']:.1f} req/s, p99 {results['total']['p99_ms']:.2f} ms")
+
+    meta = run_meta("http", args)
+    meta["server"] = {"url": args.url or "spawned", "backends": info.get("backends")}
+    write_results(args.out, meta, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Сверка производных хранилищ (Qdrant, Neo4j, Mongo, Redis) с Postgres.
+
+Диапазон id делится на корзины; для каждой корзины хранилище само считает
+контрольную сумму (count, sum(id), sum(updated_ms), sum(tags_digest)) — см. api/checksums.py.
+Совпавшие корзины пропускаются целиком, разошедшиеся дробятся (--fanout) до листьев
+(--leaf-width), и только для листьев сравниваются отпечатки отдельных заметок.
+Найденные расхождения чинятся пачками: missing/stale — запись из Postgres, orphaned — удаление.
+Qdrant агрегировать не умеет: его диапазон читается одним scroll, отпечатки совпавших корзин
+верхнего уровня сразу отбрасываются, а спуск по разошедшимся идёт по памяти.
+
+Redis сверяется иначе: кэш живёт REDIS_NOTE_TTL секунд и невелик, поэтому просто
+проходим SCAN по ETag-ключам и удаляем устаревшие и осиротевшие записи.
+
+    python scripts/reconcile.py --stores qdrant,neo4j,mongo,redis --dry-run
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Set, Tuple
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api import cache, db, etags, graph, mongo_versions, qdrant_vectors, tenants  # noqa: E402
+from api.checksums import ScannedRange  # noqa: E402
+
+RANGE_STORES = {
+    "qdrant": (qdrant_vectors.range_checksums, qdrant_vectors.range_fingerprints),
+    "neo4j": (graph.range_checksums, graph.range_fingerprints),
+    "mongo": (mongo_versions.range_checksums, mongo_versions.range_fingerprints),
+}
+ALL_STORES = tuple(RANGE_STORES) + ("redis",)
+
+ChecksumFn = Callable[[int, int, int], Dict[int, Tuple[int, int, int, int]]]
+
+
+class Diff:
+    def __init__(self) -> None:
+        self.missing: Set[int] = set()
+        self.stale: Set[int] = set()
+        self.orphaned: Set[int] = set()
+        self.leaves = 0
+
+    def summary(self) -> str:
+        return f"missing {len(self.missing)}, stale {len(self.stale)}, orphaned {len(self.orphaned)}"
+
+
+def differing_ranges(
+    source: ChecksumFn, replica: ChecksumFn, start: int, end: int, width: int, fanout: int, leaf: int
+) -> Iterator[Tuple[int, int]]:
+    """Листовые диапазоны [a, b), в которых контрольные суммы источника и реплики расходятся."""
+    src = source(start, end, width)
+    dst = replica(start, end, width)
+    for bucket in sorted(set(src) | set(dst)):
+        if src.get(bucket) == dst.get(bucket):
+            continue
+        bstart = start + bucket * width
+        bend = min(bstart + width, end)
+        if width <= leaf:
+            yield bstart, bend
+        else:
+            yield from differing_ranges(source, replica, bstart, bend, max(width // fanout, leaf), fanout, leaf)
+
+
+def diff_store(name: str, low: int, high: int, args: argparse.Namespace) -> Diff:
+    checksums, fingerprints = RANGE_STORES[name]
+    diff = Diff()
+    span = high - low + 1
+    top_width = max(args.leaf_width, -(-span // args.top_buckets))
+    if name == "qdrant":
+        # Qdrant не агрегирует: один scroll по всему диапазону, дальше спуск по памяти (api/checksums.py)
+        reference = db.range_checksums(low, high + 1, top_width)
+        scanned = ScannedRange(qdrant_vectors.iter_range_fingerprints(low, high + 1), low, top_width, reference)
+        checksums, fingerprints = scanned.checksums, scanned.fingerprints
+    for start, end in differing_ranges(
+        db.range_checksums, checksums, low, high + 1, top_width, args.fanout, args.leaf_width
+    ):
+        diff.leaves += 1
+        src = db.range_fingerprints(start, end)
+        dst = fingerprints(start, end)
+        diff.missing.update(set(src) - set(dst))
+        diff.orphaned.update(set(dst) - set(src))
+        diff.stale.update(nid for nid in set(src) & set(dst) if src[nid] != dst[nid])
+    return diff
+
+
+def chunks(ids: List[int], size: int) -> Iterator[List[int]]:
+    for i in range(0, len(ids), size):
+        yield ids[i : i + size]
+
+
+def repair_store(name: str, diff: Diff, batch: int) -> None:
+    to_write = sorted(diff.missing | diff.stale)
+    for ids in chunks(to_write, batch):
+        notes = db.fetch_notes_by_ids(ids)
+        if name == "qdrant":
+            qdrant_vectors.upsert_note_vectors(notes)
+        elif name == "neo4j":
+            graph.upsert_notes_with_tags(notes)
+        elif name == "mongo":
+            for note in notes:
+                doc = mongo_versions.save_version(note)
+                try:
+                    # иначе ETag списка версий в кэше указывает на прежнюю последнюю версию
+                    cache.remember_latest_version(doc["note_id"], doc["version"])
+                except Exception:
+                    pass
+    for ids in chunks(sorted(diff.orphaned), batch):
+        if name == "qdrant":
+            qdrant_vectors.delete_note_vectors(ids)
+        elif name == "neo4j":
+            graph.delete_notes(ids)
+        elif name == "mongo":
+            mongo_versions.delete_versions_for_notes(ids)
+
+
+def reconcile_redis(batch: int, dry_run: bool) -> Diff:
+    """Устаревшие и осиротевшие записи кэша и счётчика популярности."""
+    diff = Diff()
+    for cached in cache.iter_cached_etags(batch):
+        current = {
+            n["id"]: etags.note_etag(n)
+            for n in db.fetch_notes_by_ids(list(cached), fields=["id", "updated_at"])
+        }
+        for note_id, etag in cached.items():
+            if note_id not in current:
+                diff.orphaned.add(note_id)
+            elif etag is not None and etag != current[note_id]:
+                diff.stale.add(note_id)
+    popular = cache.get_popular_ids()
+    for ids in chunks(popular, batch):
+        present = {n["id"] for n in db.fetch_notes_by_ids(ids, fields=["id"])}
+        diff.orphaned.update(nid for nid in ids if nid not in present)
+    if not dry_run:
+        for ids in chunks(sorted(diff.stale | diff.orphaned), batch):
+            cache.invalidate_notes(ids)
+        cache.remove_popular(sorted(diff.orphaned))
+    return diff
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stores", default=",".join(ALL_STORES), help="через запятую: qdrant,neo4j,mongo,redis")
+    parser.add_argument("--top-buckets", type=int, default=256, help="число корзин на верхнем уровне")
+    parser.add_argument("--fanout", type=int, default=16, help="во сколько раз дробить разошедшуюся корзину")
+    parser.add_argument("--leaf-width", type=int, default=512, help="ширина диапазона, где сравниваются отдельные заметки")
+    parser.add_argument("--batch", type=int, default=500, help="размер пачки при починке")
+    parser.add_argument("--end-id", type=int, default=None, help="верхняя граница id (по умолчанию max id Postgres с запасом)")
+    parser.add_argument("--dry-run", action="store_true", help="только отчёт, без починки")
+    parser.add_argument("--tenant", default=None, help="арендатор (по умолчанию STUDENT_NAME)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db.disable_replicas()  # сравниваем и копируем только актуальные данные с primary
+    if args.tenant is not None:
+        # свой арендатор со своими именами ресурсов; пространства арендатора по умолчанию не трогаются
+        tenants.use(tenants.validate(args.tenant))
+    stores = [s.strip() for s in args.stores.split(",") if s.strip()]
+    unknown = set(stores) - set(ALL_STORES)
+    if unknown:
+        parser.error(f"unknown stores: {', '.join(sorted(unknown))}")
+
+    _, high = db.get_id_bounds()
+    # осиротевшие записи могут лежать и за пределами id из Postgres (удалены последние заметки),
+    # поэтому начинаем с нуля и захватываем ещё одну корзину верхнего уровня сверху
+    low = 0
+    if args.end_id is not None:
+        high = args.end_id
+    else:
+        high += max(args.leaf_width, -(-(high + 1) // args.top_buckets))
+    failed = False
+    for name in stores:
+        started = time.monotonic()
+        try:
+            if name == "redis":
+                diff = reconcile_redis(args.batch, args.dry_run)
+            else:
+                diff = diff_store(name, low, high, args)
+                if not args.dry_run:
+                    repair_store(name, diff, args.batch)
+        except Exception as exc:
+            failed = True
+            print(f"{name:<8} FAIL - {exc}")
+            continue
+        action = "found" if args.dry_run else "repaired"
+        print(
+            f"{name:<8} {action}: {diff.summary()}; "
+            f"{diff.leaves} leaf ranges drilled, {time.monotonic() - started:.2f}s"
+        )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Перестроение производных хранилищ (Qdrant, Neo4j, Mongo, Redis) из Postgres.
+
+Заметки читаются диапазонами id и обрабатываются пулом потоков; прогресс пишется
+в checkpoint-файл, поэтому прерванный запуск можно продолжить с --resume.
+
+Примеры:
+    python scripts/reindex.py --targets qdrant,neo4j --workers 8
+    # blue/green: собрать векторы в новую коллекцию и переключить на неё алиас
+    python scripts/reindex.py --targets qdrant --target-collection notes_vectors_v2 \
+        --vector-size 256 --alias notes_vectors
+    # пересчитать счётчики тегов и рёбра CO_OCCURS в графе, собранном до их появления
+    python scripts/reindex.py --targets neo4j --tag-stats
+"""
+import argparse
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api import cache, db, graph, mongo_versions, qdrant_vectors, tenants  # noqa: E402
+
+ALL_TARGETS = ("qdrant", "neo4j", "mongo", "redis")
+
+
+class Checkpoint:
+    """Набор завершённых диапазонов; файл перезаписывается атомарно после каждого диапазона."""
+
+    def __init__(self, path: Path, params: Dict[str, Any], resume: bool):
+        self.path = path
+        self.params = params
+        self.done: Set[int] = set()
+        self.lock = threading.Lock()
+        if resume and path.exists():
+            data = json.loads(path.read_text())
+            if data.get("params") != params:
+                raise SystemExit(f"Checkpoint {path} was written with other parameters: {data.get('params')}")
+            self.done = set(data.get("done", []))
+
+    def mark(self, start_id: int) -> None:
+        with self.lock:
+            self.done.add(start_id)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"params": self.params, "done": sorted(self.done)}))
+            os.replace(tmp, self.path)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.notes = 0
+        self.chunks = 0
+        self.errors = 0
+
+    def add(self, notes: int) -> None:
+        with self.lock:
+            self.notes += notes
+            self.chunks += 1
+
+    def line(self, total_chunks: int) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.notes / elapsed if elapsed > 0 else 0.0
+        return (
+            f"chunks {self.chunks}/{total_chunks}  notes {self.notes}  "
+            f"errors {self.errors}  {rate:,.0f} notes/s  {elapsed:,.1f}s"
+        )
+
+
+def process_chunk(start_id: int, end_id: int, targets: List[str], collection: Optional[str], size: int) -> int:
+    notes = db.fetch_notes_in_range(start_id, end_id)
+    if not notes:
+        return 0
+    if "qdrant" in targets:
+        qdrant_vectors.upsert_note_vectors(notes, collection=collection, size=size)
+    if "neo4j" in targets:
+        graph.upsert_notes_with_tags(notes)
+    if "mongo" in targets:
+        mongo_versions.backfill_initial_versions(notes)
+    if "redis" in targets:
+        cache.cache_notes(notes)
+    return len(notes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default=",".join(ALL_TARGETS), help="через запятую: qdrant,neo4j,mongo,redis")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="ширина диапазона id на одну задачу")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--start-id", type=int, default=None)
+    parser.add_argument("--end-id", type=int, default=None, help="включительно")
+    parser.add_argument("--checkpoint", default=None, help="файл прогресса (по умолчанию .reindex_<table>.json)")
+    parser.add_argument("--resume", action="store_true", help="пропустить диапазоны, отмеченные в checkpoint")
+    parser.add_argument("--target-collection", default=None, help="писать векторы в эту коллекцию (blue/green)")
+    parser.add_argument("--vector-size", type=int, default=None, help="размер вектора для новой коллекции")
+    parser.add_argument("--alias", default=None, help="после успешной сборки направить алиас на --target-collection")
+    parser.add_argument("--tag-stats", action="store_true", help="после прохода пересчитать Tag.note_count и CO_OCCURS")
+    parser.add_argument("--tenant", default=None, help="арендатор (по умолчанию STUDENT_NAME)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db.disable_replicas()  # сравниваем и копируем только актуальные данные с primary
+    if args.tenant is not None:
+        # свой арендатор со своими именами ресурсов; пространства арендатора по умолчанию не трогаются
+        tenants.use(tenants.validate(args.tenant))
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = set(targets) - set(ALL_TARGETS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    if args.alias and not args.target_collection:
+        parser.error("--alias requires --target-collection")
+
+    collection = args.target_collection or qdrant_vectors.get_collection_name()
+    size = args.vector_size or qdrant_vectors.get_vector_size()
+    if "qdrant" in targets:
+        qdrant_vectors.ensure_collection(collection=args.target_collection, size=size)
+
+    low, high = db.get_id_bounds()
+    low = args.start_id if args.start_id is not None else low
+    high = args.end_id if args.end_id is not None else high
+    ranges = [(start, min(start + args.chunk_size, high + 1)) for start in range(low, high + 1, args.chunk_size)]
+
+    table = db.get_table_name()
+    checkpoint_path = Path(args.checkpoint or f".reindex_{table}.json")
+    params = {
+        "table": table,
+        "targets": sorted(targets),
+        "collection": collection,
+        "chunk_size": args.chunk_size,
+    }
+    checkpoint = Checkpoint(checkpoint_path, params, args.resume)
+    pending = [r for r in ranges if r[0] not in checkpoint.done]
+    print(f"Reindex {table} ids {low}..{high} -> {', '.join(targets)}; collection {collection} (size {size})")
+    print(f"{len(ranges)} chunks, {len(ranges) - len(pending)} already done, {args.workers} workers")
+
+    stats = Stats()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            # контекст с арендатором из --tenant — в каждый поток пула
+            pool.submit(contextvars.copy_context().run, process_chunk, start, end, targets, collection, size): (start, end)
+            for start, end in pending
+        }
+        for future in as_completed(futures):
+            start, end = futures[future]
+            try:
+                count = future.result()
+            except Exception as exc:
+                stats.errors += 1
+                print(f"[error] ids {start}..{end - 1}: {exc}")
+                continue
+            checkpoint.mark(start)
+            stats.add(count)
+            if stats.chunks % 10 == 0 or stats.chunks == len(pending):
+                print(stats.line(len(pending)))
+
+    print(f"Done: {stats.line(len(pending))}")
+    if stats.errors:
+        print(f"{stats.errors} chunks failed; rerun with --resume to retry them.")
+        sys.exit(1)
+    if args.tag_stats:
+        graph.rebuild_tag_stats()
+        print("Tag stats rebuilt")
+    if args.alias:
+        qdrant_vectors.switch_alias(args.alias, collection)
+        print(f"Alias {args.alias} -> {collection}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nStopped; rerun with --resume to continue.")
+        sys.exit(130)